@@ -1,9 +1,9 @@
 import asyncio
-from types import GeneratorType
+from types import GeneratorType, CoroutineType
 from functools import wraps
 import logging
 
-from xudd.tools import split_id
+from xudd.tools import actor_ref
 
 
 _log = logging.getLogger(__name__)
@@ -30,25 +30,77 @@ def autoreply(func):
     return wrapper
 
 
+############
+# exceptions
+############
+
+class MessageTimeout(asyncio.TimeoutError):
+    """
+    Raised when a reply we're waiting on doesn't show up in time.
+    """
+    pass
+
+
 ####################
 # Main actor classes
 ####################
 
 
+class MessageGather(object):
+    """
+    A batch of messages that a coroutine is waiting on replies to, all
+    at once.  See Actor.wait_on_all() and Actor.wait_on_any().
+    """
+    def __init__(self, id, message_ids, wait_for_all=True, timeout=None):
+        # Our own id, which the gather as a whole waits (and possibly
+        # times out) under
+        self.id = id
+        self.message_ids = message_ids
+        self.wait_for_all = wait_for_all
+        self.timeout = timeout
+
+        # message id -> reply, in the order they come in
+        self.replies = {}
+        # Whatever gets resumed with our results (a generator or future)
+        self.waiter = None
+
+    def add_reply(self, message):
+        """
+        Collect a reply; returns True if we're done waiting.
+        """
+        self.replies[message.in_reply_to] = message
+        return not self.wait_for_all \
+            or len(self.replies) == len(self.message_ids)
+
+    def result(self):
+        """
+        For wait_on_all(), a list of replies in the same order as the
+        requests (with None for any we gave up on); for wait_on_any(),
+        the first reply (or None if we gave up on all of them).
+        """
+        if self.wait_for_all:
+            return [self.replies.get(message_id)
+                    for message_id in self.message_ids]
+
+        return next(iter(self.replies.values()), None)
+
+
 class Actor(object):
     """
     Basic XUDD actor.
     """
     def __init__(self, hive, id):
         self.hive = hive
-        self.id = id
-        self.local_id = split_id(id)[0]
+        self.id = actor_ref(id)
+        self.local_id = self.id.local_id
 
         # Routing of messages to handler functions
         self.message_routing = {}
 
         # Registry on coroutines that are currently waiting for a response
         self._waiting_coroutines = {}
+        # ... and the hive's deadline entries for those that can time out
+        self._wait_deadlines = {}
 
     @autoreply
     def handle_message(self, message):
@@ -62,15 +114,10 @@ class Actor(object):
         # handle that.
         if message.in_reply_to is not None \
            and message.in_reply_to in self._waiting_coroutines:
-            coroutine = self._waiting_coroutines.pop(message.in_reply_to)
-
-            # Send this message reply to this coroutine
-            _log.debug("Sending reply: %s", message)
-            try:
-                coroutine_result = coroutine.send(message)
-            except StopIteration:
-                # And our job is done
-                return
+            self._resume_coroutine(
+                self._pop_waiting(message.in_reply_to),
+                message)
+            return
 
         else:
             # Otherwise, this is a new message to handle.
@@ -87,7 +134,19 @@ class Actor(object):
                         # Guess this coroutine ended without any yields
                         return None
 
+                elif isinstance(result, CoroutineType):
+                    # An "async def" handler; let asyncio drive it
+                    self._run_async_handler(result, message)
+
             except KeyError:
+                if message.in_reply_to is not None \
+                   and message.directive not in self.message_routing:
+                    # Most likely a straggler replying to something we
+                    # gave up waiting on (timed out, or wait_on_any()
+                    # already got its answer)
+                    _log.debug(u'Ignoring late reply: {!r}'.format(message))
+                    return
+
                 _log.error(u'Unregistered directive {!r}.'.format(
                     message.directive))
                 _log.debug(u'Message details: {!r}, {!r}'.format(
@@ -101,15 +160,153 @@ class Actor(object):
             self._handle_coroutine_result(
                 coroutine_result, coroutine)
 
+    def _run_async_handler(self, coroutine, message):
+        """
+        Run an "async def" message handler as an asyncio task.
+
+        Unlike generator handlers, these are replied to automatically
+        when they *finish* (if they haven't replied already), so there's
+        no need to defer_reply() while awaiting things.  If the handler
+        raises, that reply is an "error.handler_failed" instead.
+        """
+        message.defer_reply()
+
+        def handler_done(task):
+            if task.cancelled():
+                return
+            elif task.exception() is not None:
+                _log.error(
+                    u'Handler for {!r} failed'.format(message.directive),
+                    exc_info=task.exception())
+                if message.wants_reply and not message.replied:
+                    # Don't leave whoever's waiting on us hanging
+                    message.reply(
+                        {"error": repr(task.exception())},
+                        directive=u"error.handler_failed")
+            elif message.wants_reply and not message.replied:
+                message.reply()
+
+        task = self.hive.loop.create_task(coroutine)
+        task.add_done_callback(handler_done)
+        return task
+
+    def _resume_coroutine(self, coroutine, message):
+        """
+        Send a reply message to the coroutine that was waiting on it.
+
+        (The hive may call this directly for replies it knows are
+        headed to a waiting coroutine; see Hive.reply_fast_path.)
+        """
+        if isinstance(coroutine, asyncio.Future):
+            # Someone's awaiting this via ask(); no need to route
+            # anything, just hand over the reply.
+            if not coroutine.done():
+                coroutine.set_result(message)
+            return
+
+        elif isinstance(coroutine, MessageGather):
+            if coroutine.add_reply(message):
+                self._finish_gather(coroutine)
+            return
+
+        _log.debug("Sending reply: %s", message)
+        try:
+            coroutine_result = coroutine.send(message)
+        except StopIteration:
+            # And our job is done
+            return
+
+        self._handle_coroutine_result(coroutine_result, coroutine)
+
+    def _pop_waiting(self, message_id):
+        """
+        Stop waiting on a reply to MESSAGE_ID, returning whatever was
+        waiting on it (or None).
+        """
+        if self._wait_deadlines:
+            self._forget_wait_deadline(message_id)
+        return self._waiting_coroutines.pop(message_id, None)
+
+    def _forget_wait_deadline(self, message_id):
+        deadline = self._wait_deadlines.pop(message_id, None)
+        if deadline is not None:
+            self.hive.cancel_wait_deadline(deadline)
+
+    def _expire_wait(self, message_id, timeout):
+        """
+        Called by the hive when a reply to MESSAGE_ID didn't make it
+        within TIMEOUT seconds.
+
+        Whatever was waiting on it gets a MessageTimeout raised at it.
+        """
+        self._wait_deadlines.pop(message_id, None)
+        waiting = self._waiting_coroutines.pop(message_id, None)
+        if waiting is None:
+            return
+
+        if isinstance(waiting, MessageGather):
+            # Gathers don't fail on timeout, they just make do with
+            # whatever replies they've got
+            self._finish_gather(waiting)
+            return
+
+        error = MessageTimeout(
+            u"No reply to message {} within {}s".format(message_id, timeout))
+
+        if isinstance(waiting, asyncio.Future):
+            if not waiting.done():
+                waiting.set_exception(error)
+            return
+
+        try:
+            coroutine_result = waiting.throw(error)
+        except StopIteration:
+            # Guess it handled that and called it a day
+            return
+
+        self._handle_coroutine_result(coroutine_result, waiting)
+
+    def _wait_on_gather(self, gather, waiter):
+        """
+        Have WAITER (a generator or future) wait on GATHER's replies.
+        """
+        gather.waiter = waiter
+
+        if not gather.message_ids:
+            # Well, that was easy
+            self._resume_coroutine(waiter, gather.result())
+            return
+
+        for message_id in gather.message_ids:
+            self._waiting_coroutines[message_id] = gather
+        self._waiting_coroutines[gather.id] = gather
+        self.hive.add_wait_deadline(gather.id, gather.timeout)
+
+    def _finish_gather(self, gather):
+        """
+        Stop waiting on anything else for GATHER, and hand its results
+        over to whoever was waiting on it.
+        """
+        self._pop_waiting(gather.id)
+        for message_id in gather.message_ids:
+            if self._waiting_coroutines.get(message_id) is gather:
+                del self._waiting_coroutines[message_id]
+
+        self._resume_coroutine(gather.waiter, gather.result())
+
     def _handle_coroutine_result(self, coroutine_result, original_coroutine):
         if coroutine_result is None:
             return
-        elif isinstance(coroutine_result, str):
+        elif isinstance(coroutine_result, (int, str)):
             # since the coroutine returned a message_id that was sent,
             # we should add this message's id to the registry
             message_id = coroutine_result
             self._waiting_coroutines[message_id] = original_coroutine
             return
+        elif isinstance(coroutine_result, MessageGather):
+            # Waiting on a whole bunch of replies at once
+            self._wait_on_gather(coroutine_result, original_coroutine)
+            return
         else:
             # It's probably something asyncio'able... presumably! :)
             # ... It'd better be!
@@ -124,33 +321,135 @@ class Actor(object):
 
                 self._handle_coroutine_result(
                     coroutine_result, original_coroutine)
-            task = asyncio.async(coroutine_result)
+            task = asyncio.ensure_future(
+                coroutine_result, loop=self.hive.loop)
             task.add_done_callback(asyncio_resume)
 
     def send_message(self, *args, **kwargs):
         return self.hive.send_message(*args, **kwargs)
 
     def wait_on_message(self, to, directive, from_id=None,
-                        id=None, body=None, in_reply_to=None):
+                        id=None, body=None, in_reply_to=None,
+                        timeout=None):
         """
         Send a message that we'll wait for a reply to.
+
+        If no reply comes within TIMEOUT seconds (or the hive's
+        wait_timeout, if TIMEOUT isn't given), the waiting coroutine
+        gets a MessageTimeout raised at it instead.
         """
-        return self.hive.send_message(
+        message_id = self.hive.send_message(
             to, directive,
             from_id=from_id,
             body=body, in_reply_to=in_reply_to, id=id,
             wants_reply=True)
+        self.hive.add_wait_deadline(message_id, timeout)
+        return message_id
+
+    def ask(self, to, directive, body=None, timeout=None):
+        """
+        Send a message and return a future for its reply.
+
+        This is the "async def" handler equivalent of
+        wait_on_message()::
+
+            response = await self.ask(to=droid, directive="get_shot")
+
+        The future's result is the reply message itself.  If TIMEOUT
+        (in seconds, defaulting to the hive's wait_timeout) passes
+        without a reply, it raises MessageTimeout instead.
+        """
+        message_id = self.wait_on_message(
+            to, directive, body=body, timeout=timeout)
+        future = self.hive.loop.create_future()
+        self._waiting_coroutines[message_id] = future
+
+        def cleanup(future):
+            # If whoever was awaiting us got cancelled, there's no
+            # point waiting around any more
+            if self._waiting_coroutines.get(message_id) is future:
+                self._pop_waiting(message_id)
+
+        future.add_done_callback(cleanup)
+        return future
+
+    def _gather(self, requests, wait_for_all, timeout):
+        message_ids = [
+            self.hive.send_message(wants_reply=True, **request)
+            for request in requests]
+
+        return MessageGather(
+            self.hive.gen_message_id(), message_ids,
+            wait_for_all=wait_for_all, timeout=timeout)
+
+    def wait_on_all(self, requests, timeout=None):
+        """
+        Send off a batch of messages and wait on all of their replies
+        at once, rather than one round trip at a time::
+
+            replies = yield self.wait_on_all(
+                [{"to": droid, "directive": "infection_expose"}
+                 for droid in droids])
+
+        Each request is a dictionary of keyword arguments, as for
+        wait_on_message().  The coroutine gets resumed once, with a
+        list of replies in the same order as the requests.
+
+        If TIMEOUT (or the hive's wait_timeout) passes first, the
+        coroutine gets resumed with whatever replies came in, and None
+        in place of the rest.
+        """
+        return self._gather(requests, True, timeout)
+
+    def wait_on_any(self, requests, timeout=None):
+        """
+        Like wait_on_all(), but the coroutine gets resumed with the
+        first reply to come in (or None, if TIMEOUT passes first).
+        """
+        return self._gather(requests, False, timeout)
+
+    def _ask_gather(self, requests, wait_for_all, timeout):
+        future = self.hive.loop.create_future()
+        gather = self._gather(requests, wait_for_all, timeout)
+        self._wait_on_gather(gather, future)
+
+        def cleanup(future):
+            # If whoever was awaiting us got cancelled, there's no
+            # point waiting around any more
+            if self._waiting_coroutines.get(gather.id) is gather:
+                self._finish_gather(gather)
+
+        future.add_done_callback(cleanup)
+        return future
 
-    def wait_on_self(self):
+    def ask_all(self, requests, timeout=None):
+        """
+        The "async def" handler equivalent of wait_on_all(); returns a
+        future for the list of replies.
+        """
+        return self._ask_gather(requests, True, timeout)
+
+    def ask_any(self, requests, timeout=None):
+        """
+        The "async def" handler equivalent of wait_on_any(); returns a
+        future for the first reply.
+        """
+        return self._ask_gather(requests, False, timeout)
+
+    def wait_on_self(self, delay=None):
         """
         Send a message that's actually just going to reply to itself!
         Useful for while loops.
+
+        If DELAY is given, the message won't arrive until DELAY seconds
+        from now, so polling loops can sleep in between checks rather
+        than spinning.
         """
         # Kinda evil.  This message is going to reply to itself, so
         # it's actually generating its own id ahead of time...
         this_message_id = self.hive.gen_message_id()
 
-        return self.hive.send_message(
+        message_kwargs = dict(
             to=self.id, directive="self_reply",
             from_id=self.id,
             id=this_message_id, in_reply_to=this_message_id,
@@ -161,6 +460,36 @@ class Actor(object):
             # it is, by definition, already replying!
             wants_reply=False)
 
+        if delay is None:
+            return self.hive.send_message(**message_kwargs)
+
+        self.hive.send_after(delay, **message_kwargs)
+        return this_message_id
+
+    def wait_on_readable(self, fileobj):
+        """
+        Wait until FILEOBJ (a socket, or anything else with a fileno())
+        has something to read, without polling it:
+
+            yield self.wait_on_readable(sock)
+            data = sock.recv(4096)
+        """
+        return self._wait_on_ready(self.hive.send_when_readable, fileobj)
+
+    def wait_on_writable(self, fileobj):
+        """
+        Wait until FILEOBJ can be written to without blocking.
+        """
+        return self._wait_on_ready(self.hive.send_when_writable, fileobj)
+
+    def _wait_on_ready(self, send_when_ready, fileobj):
+        # Same trick as wait_on_self(): this replies to itself
+        this_message_id = self.hive.gen_message_id()
+        return send_when_ready(
+            fileobj, to=self.id, directive="self_reply",
+            id=this_message_id, in_reply_to=this_message_id,
+            wants_reply=False)
+
     def wait_on_future(self, future):
         """
         Set up a future to call us back when things are done.
@@ -0,0 +1,146 @@
+"""
+Hive throughput benchmark.
+
+Runs a bunch of Professor/Assistant pairs from the lotsamessages demo
+and reports how many messages per second the hive got through.  Also
+runs the same workload on hives that do things the way the hive used
+to (scheduling each message as its own event loop callback, building
+a string for every message id, or sending every reply back through
+handle_message()) so you can see the difference.
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import time
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.demos.lotsamessages import Professor, Assistant
+
+
+class CallSoonHive(Hive):
+    """
+    A hive that pays for one loop.call_soon() per message, like the
+    hive did before it grew its own run queue.
+    """
+    def _queue_message(self, message):
+        self.loop.call_soon(self._deliver_message, message)
+
+    def _deliver_message(self, message):
+        mailbox, message = self._route_message(message)
+        if mailbox is not None:
+            mailbox.actor.handle_message(message)
+
+
+class StringIdHive(Hive):
+    """
+    A hive that formats a "<uuid>:<counter>" string for every message
+    id, like the hive did before message ids became plain integers.
+    """
+    def gen_message_id(self):
+        return u"%s:%s" % (self.message_uuid, next(self.message_counter))
+
+
+class SlowReplyHive(Hive):
+    """
+    A hive without the reply fast path, so every reply goes back
+    through the recipient's handle_message().
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs["reply_fast_path"] = False
+        super(SlowReplyHive, self).__init__(*args, **kwargs)
+
+
+class Timekeeper(Actor):
+    """
+    Kicks off the experiments and shuts the hive down once they're done.
+    """
+    def __init__(self, hive, id, num_pairs, num_steps):
+        super(Timekeeper, self).__init__(hive, id)
+        self.message_routing.update(
+            {"start": self.start,
+             "experiment_is_done": self.experiment_is_done})
+        self.num_pairs = num_pairs
+        self.num_steps = num_steps
+        self.remaining = num_pairs
+
+    def start(self, message):
+        for i in range(self.num_pairs):
+            professor = self.hive.create_actor(Professor)
+            assistant = self.hive.create_actor(Assistant)
+            self.hive.send_message(
+                to=professor,
+                directive="run_experiments",
+                body={
+                    "assistant_id": assistant,
+                    "numtimes": self.num_steps,
+                    "slacker_time": 0})
+
+    def experiment_is_done(self, message):
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.hive.send_shutdown()
+
+
+def run_benchmark(hive_class=Hive, num_pairs=20, num_steps=5000):
+    """
+    Run the benchmark on a fresh hive of HIVE_CLASS.
+
+    Returns (number of messages, seconds elapsed).
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        hive = hive_class(loop=loop)
+        timekeeper = hive.create_actor(
+            Timekeeper, num_pairs=num_pairs, num_steps=num_steps)
+        hive.send_message(to=timekeeper, directive="start")
+
+        start = time.time()
+        hive.run()
+        elapsed = time.time() - start
+    finally:
+        loop.close()
+
+    # Every step is a request plus its reply
+    num_messages = num_pairs * num_steps * 2
+    return num_messages, elapsed
+
+
+def report(label, num_messages, elapsed):
+    print("%-16s %10d messages in %7.3fs: %10.0f messages/sec" % (
+        label, num_messages, elapsed, num_messages / elapsed))
+
+
+BENCHMARK_HIVES = [
+    ("call_soon", CallSoonHive),
+    ("string ids", StringIdHive),
+    ("slow replies", SlowReplyHive),
+    ("hive", Hive)]
+
+
+def main(num_pairs=20, num_steps=5000):
+    for label, hive_class in BENCHMARK_HIVES:
+        num_messages, elapsed = run_benchmark(
+            hive_class, num_pairs, num_steps)
+        report(label, num_messages, elapsed)
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Hive message throughput benchmark")
+    parser.add_argument(
+        "-e", "--experiments",
+        help="Number of professor/assistant pairs to run",
+        default=20, type=int)
+    parser.add_argument(
+        "-s", "--steps",
+        help="Number of steps each experiment should require",
+        default=5000, type=int)
+
+    args = parser.parse_args()
+    main(args.experiments, args.steps)
+
+
+if __name__ == "__main__":
+    cli()
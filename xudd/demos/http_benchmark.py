@@ -0,0 +1,170 @@
+"""
+HTTP server benchmark.
+
+Starts an HTTP server (ConnectionServer + HTTP + a handler that says
+hello) in a child process, then hammers it from this one with a
+little asyncio load generator and reports requests per second:
+
+- with a new connection for every request, like before the server
+  could keep connections alive,
+- with every client keeping its connection alive, and
+- with every client pipelining several requests at a time.
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.tcp import ConnectionServer
+from xudd.lib.http import HTTP
+
+
+HELLO = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n' \
+        b'Content-Length: 12\r\n\r\nHello World!'
+
+
+class Hello(Actor):
+    def __init__(self, hive, id):
+        super(Hello, self).__init__(hive, id)
+        self.message_routing.update(
+            {'handle_request': self.handle_request})
+
+    def handle_request(self, message):
+        message.reply(directive='respond', body={'response': HELLO})
+
+
+def serve(port):
+    hive = Hive()
+    hello = hive.create_actor(Hello)
+    http = hive.create_actor(HTTP, request_handler=hello)
+    server = hive.create_actor(ConnectionServer, handler=http)
+    hive.send_message(
+        to=server, directive='listen',
+        body={'port': port, 'backlog': 1024})
+    hive.run()
+
+
+def request(keep_alive):
+    return (b'GET / HTTP/1.1\r\nHost: localhost\r\n'
+            + (b'' if keep_alive else b'Connection: close\r\n')
+            + b'\r\n')
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            await reader.readexactly(int(line.split(b':', 1)[1]))
+            break
+
+
+async def client(port, num_requests, keep_alive, pipeline):
+    if not keep_alive:
+        for i in range(num_requests):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request(False))
+            await read_response(reader)
+            writer.close()
+        return
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    remaining = num_requests
+    while remaining:
+        batch = min(pipeline, remaining)
+        writer.write(request(True) * batch)
+        for i in range(batch):
+            await read_response(reader)
+        remaining -= batch
+    writer.close()
+
+
+async def run_clients(port, num_clients, num_requests, keep_alive, pipeline):
+    await asyncio.gather(*[
+        client(port, num_requests, keep_alive, pipeline)
+        for i in range(num_clients)])
+
+
+async def wait_for_server(port):
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(.05)
+        else:
+            writer.close()
+            return
+
+
+def run_benchmark(port, num_clients, num_requests, keep_alive=True,
+                  pipeline=1):
+    """
+    Run NUM_CLIENTS clients making NUM_REQUESTS requests each against
+    the server on PORT.
+
+    Returns (number of requests, seconds elapsed).
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(wait_for_server(port))
+        start = time.time()
+        loop.run_until_complete(run_clients(
+            port, num_clients, num_requests, keep_alive, pipeline))
+        elapsed = time.time() - start
+    finally:
+        loop.close()
+
+    return num_clients * num_requests, elapsed
+
+
+def report(label, num_requests, elapsed):
+    print("%-16s %8d requests in %7.3fs: %8.0f requests/sec" % (
+        label, num_requests, elapsed, num_requests / elapsed))
+
+
+def main(port=8642, num_clients=50, num_requests=200, pipeline=8):
+    server = multiprocessing.Process(target=serve, args=(port,))
+    server.daemon = True
+    server.start()
+    try:
+        for label, keep_alive, depth in [
+                ("close", False, 1),
+                ("keep-alive", True, 1),
+                ("pipelined x%d" % pipeline, True, pipeline)]:
+            num, elapsed = run_benchmark(
+                port, num_clients, num_requests, keep_alive, depth)
+            report(label, num, elapsed)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="HTTP server benchmark")
+    parser.add_argument(
+        "-p", "--port",
+        help="Port to run the server on",
+        default=8642, type=int)
+    parser.add_argument(
+        "-c", "--clients",
+        help="Number of concurrent clients",
+        default=50, type=int)
+    parser.add_argument(
+        "-n", "--requests",
+        help="Number of requests each client makes",
+        default=200, type=int)
+    parser.add_argument(
+        "--pipeline",
+        help="How many requests to pipeline at a time",
+        default=8, type=int)
+
+    args = parser.parse_args()
+    main(args.port, args.clients, args.requests, args.pipeline)
+
+
+if __name__ == "__main__":
+    cli()
@@ -37,14 +37,14 @@ class IrcBot(Actor):
         self.message_routing.update(
             {"connect_and_run": self.connect_and_run})
 
-    def connect_and_run(self, message):
-        self.reader, self.writer = yield from asyncio.open_connection(
+    async def connect_and_run(self, message):
+        self.reader, self.writer = await asyncio.open_connection(
             message.body.get("hostname", self.connect_hostname),
             message.body.get("port", self.connect_port))
 
         self.login()
         while True:
-            line = yield from self.reader.readline()
+            line = await self.reader.readline()
             line = line.decode("utf-8")
             self.handle_line(line)
 
@@ -1,4 +1,4 @@
-from xudd.lib.server import Server
+from xudd.lib.tcp import ConnectionServer
 from xudd.lib.http import HTTP
 from xudd.lib.wsgi import WSGI
 from xudd.hive import Hive
@@ -21,9 +21,10 @@ def serve():
 
     hive = Hive()
 
-    wsgi_id = hive.create_actor(WSGI, app=wsgi_app)
+    # Werkzeug apps are free to block, so give them their own threads
+    wsgi_id = hive.create_actor(WSGI, app=wsgi_app, threads=8)
     http_id = hive.create_actor(HTTP, request_handler=wsgi_id)
-    server_id = hive.create_actor(Server, request_handler=http_id)
+    server_id = hive.create_actor(ConnectionServer, handler=http_id)
 
     hive.send_message(
         to=server_id,
@@ -1,4 +1,4 @@
-from xudd.lib.server import Server
+from xudd.lib.tcp import ConnectionServer
 from xudd.lib.http import HTTP
 from xudd.lib.wsgi import WSGI
 from xudd.hive import Hive
@@ -6,7 +6,7 @@ from xudd.hive import Hive
 import logging
 
 def wsgi_app(environ, start_response):
-    response = start_response(200, {'Content-Type': 'text/plain'}.items())
+    response = start_response('200 OK', [('Content-Type', 'text/plain')])
     response('Hello World!')
 
 def serve():
@@ -20,7 +20,7 @@ def serve():
 
     wsgi_id = hive.create_actor(WSGI, app=wsgi_app)
     http_id = hive.create_actor(HTTP, request_handler=wsgi_id)
-    server_id = hive.create_actor(Server, request_handler=http_id)
+    server_id = hive.create_actor(ConnectionServer, handler=http_id)
 
     hive.send_message(
         to=server_id,
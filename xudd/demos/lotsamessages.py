@@ -44,7 +44,8 @@ class DepartmentChair(Actor):
     Actor that initializes the world of this demo, starts the mission,
     and sends information about what's going on back to the user.
     """
-    def __init__(self, hive, id, num_worker_processes=0):
+    def __init__(self, hive, id, num_worker_processes=0,
+                 cross_process=False, shared_memory=False):
         super(DepartmentChair, self).__init__(hive, id)
 
         self.message_routing.update(
@@ -54,6 +55,11 @@ class DepartmentChair(Actor):
         self.experiments_in_progress = set()
         self.success_tracker = None
         self.num_worker_processes = num_worker_processes
+        # Whether to keep the assistants here, away from their
+        # professors, so every errand crosses between processes
+        self.cross_process = cross_process
+        # Whether to talk to the worker hives over shared memory
+        self.shared_memory = shared_memory
         # we set this up in setup()
         self.worker_hives = []
 
@@ -76,7 +82,8 @@ class DepartmentChair(Actor):
             # set up worker processes, record hive ids
             for i in range(self.num_worker_processes):
                 # Create the delegate
-                ambassador = self.hive.create_actor(MultiProcessAmbassador)
+                ambassador = self.hive.create_actor(
+                    MultiProcessAmbassador, shared_memory=self.shared_memory)
                 response = yield self.wait_on_message(
                     to=ambassador,
                     directive="setup")
@@ -108,24 +115,28 @@ class DepartmentChair(Actor):
         # A lazy hack to avoid race conditions
         run_experiments = []
 
+        # Ask every hive to create all its professors and assistants at
+        # once, rather than waiting on each one in turn
         allocation = worker_allocation(
             range(num_experiments), self.worker_hives)
+        create_requests = []
         for i, hive_id in allocation:
-            response = yield self.wait_on_message(
-                to=join_id("hive", hive_id),
-                directive="create_actor",
-                body={
-                    "class": "xudd.demos.lotsamessages:Professor"})
-            professor = response.body['actor_id']
-
-            response = yield self.wait_on_message(
-                to=join_id("hive", hive_id),
-                directive="create_actor",
-                body={
-                    "class": "xudd.demos.lotsamessages:Assistant"})
-            assistant = response.body['actor_id']
+            for actor_class in ("Professor", "Assistant"):
+                if actor_class == "Assistant" and self.cross_process:
+                    actor_hive_id = self.hive.hive_id
+                else:
+                    actor_hive_id = hive_id
+                create_requests.append({
+                    "to": join_id("hive", actor_hive_id),
+                    "directive": "create_actor",
+                    "body": {
+                        "class": "xudd.demos.lotsamessages:" + actor_class}})
+
+        responses = yield self.wait_on_all(create_requests)
+        actor_ids = [response.body['actor_id'] for response in responses]
+
+        for professor, assistant in zip(actor_ids[::2], actor_ids[1::2]):
             self.experiments_in_progress.add(professor)
-
             run_experiments.append((professor, assistant))
 
         # We do this on a separate loop to avoid the race conditions where some
@@ -206,7 +217,8 @@ DEFAULT_NUM_STEPS = 5000
 
 
 def main(num_experiments=DEFAULT_NUM_STEPS, num_steps=DEFAULT_NUM_STEPS,
-         subprocesses=None, slacker_time=0):
+         subprocesses=None, slacker_time=0, cross_process=False,
+         timing=False, shared_memory=False):
     """
     Returns True if the experiment was a success.
     """
@@ -215,7 +227,8 @@ def main(num_experiments=DEFAULT_NUM_STEPS, num_steps=DEFAULT_NUM_STEPS,
     hive = Hive()
 
     department_chair = hive.create_actor(
-        DepartmentChair, num_worker_processes=subprocesses or 0)
+        DepartmentChair, num_worker_processes=subprocesses or 0,
+        cross_process=cross_process, shared_memory=shared_memory)
 
     hive.send_message(
         to=department_chair,
@@ -226,7 +239,15 @@ def main(num_experiments=DEFAULT_NUM_STEPS, num_steps=DEFAULT_NUM_STEPS,
             "success_tracker": success_tracker,
             "slacker_time": slacker_time})
 
+    start = time.time()
     hive.run()
+    elapsed = time.time() - start
+
+    if timing:
+        # (Setting up the child hives counts against us too)
+        num_messages = num_experiments * num_steps * 2
+        print("%d errand messages in %.3fs: %.0f messages/sec" % (
+            num_messages, elapsed, num_messages / elapsed))
 
     return success_tracker.success
 
@@ -250,11 +271,26 @@ def cli():
         "-t", "--slacker-time",
         help="Number of seconds for assistants to slack off each task",
         default=0, type=float)
+    parser.add_argument(
+        "-x", "--cross-process",
+        help="Keep the assistants in the main hive, so that every errand "
+             "goes between processes",
+        action="store_true")
+    parser.add_argument(
+        "-m", "--shared-memory",
+        help="Talk to the subprocesses through shared memory rather than "
+             "over sockets",
+        action="store_true")
+    parser.add_argument(
+        "--timing",
+        help="Report how many messages per second we managed",
+        action="store_true")
 
     args = parser.parse_args()
     main(
         args.experiments, args.steps, args.subprocesses,
-        args.slacker_time)
+        args.slacker_time, args.cross_process, args.timing,
+        args.shared_memory)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+"""
+Message memory benchmark.
+
+Keeps a whole lot of messages "in flight" at once (by holding onto
+them in a list) and reports how much memory and how many allocations
+that took, compared to the plain __dict__-backed message class XUDD
+used to have.
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from xudd.message import Message
+
+
+class DictMessage(object):
+    """
+    The old, unslotted Message: an instance __dict__ per message and
+    a fresh empty body for every message that doesn't have one.
+    """
+    def __init__(self, to, directive, from_id, id, body=None, in_reply_to=None,
+                 wants_reply=False, hive_proxy=None):
+        self.to = to
+        self.directive = directive
+        self.from_id = from_id
+        self.body = body or {}
+        self.id = id
+        self.in_reply_to = in_reply_to
+        self.wants_reply = wants_reply
+
+        self.replied = False
+        self.deferred_reply = False
+        self.hive_proxy = hive_proxy
+
+
+def run_benchmark(message_class=Message, num_messages=1000000):
+    """
+    Create NUM_MESSAGES messages of MESSAGE_CLASS, half of them bare
+    replies without a body, and keep them all alive at once.
+
+    Returns (bytes allocated, number of allocations, seconds elapsed)
+    """
+    # Build the ids and bodies up front so they don't count against
+    # the messages themselves
+    ids = list(range(num_messages))
+    body = {"did_your_grunt_work": True}
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+
+    in_flight = []
+    for message_id in ids:
+        if message_id % 2:
+            in_flight.append(message_class(
+                to="professor@hive", directive="reply",
+                from_id="assistant@hive", id=message_id,
+                in_reply_to=message_id - 1))
+        else:
+            in_flight.append(message_class(
+                to="assistant@hive", directive="run_errand",
+                from_id="professor@hive", id=message_id,
+                body=body, wants_reply=True))
+
+    elapsed = time.time() - start
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = snapshot.statistics("filename")
+    allocated = sum(stat.size for stat in stats)
+    allocations = sum(stat.count for stat in stats)
+
+    del in_flight
+    return allocated, allocations, elapsed
+
+
+BENCHMARK_CLASSES = [
+    ("__dict__", DictMessage),
+    ("__slots__", Message)]
+
+
+def main(num_messages=1000000):
+    print("%s messages in flight:" % num_messages)
+    for label, message_class in BENCHMARK_CLASSES:
+        allocated, allocations, elapsed = run_benchmark(
+            message_class, num_messages)
+        print("%-10s %8.1f MiB in %9d allocations (%6.1f bytes/message), "
+              "%.3fs" % (
+                  label, allocated / (1024.0 * 1024.0), allocations,
+                  float(allocated) / num_messages, elapsed))
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Message memory benchmark")
+    parser.add_argument(
+        "-n", "--messages",
+        help="Number of messages to keep in flight",
+        default=1000000, type=int)
+
+    args = parser.parse_args()
+    main(args.messages)
+
+
+if __name__ == "__main__":
+    cli()
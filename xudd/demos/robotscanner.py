@@ -57,6 +57,7 @@ class Overseer(Actor):
         # Add rooms and droids
         last_room = None
         first_room = None
+        registrations = []
 
         for clean_droids, infected_droids in ROOM_STRUCTURE:
             room = self.hive.create_actor(WarehouseRoom)
@@ -75,22 +76,23 @@ class Overseer(Actor):
                 droid = self.hive.create_actor(
                     Droid, infected=False, room=room)
                 _log.debug('New droid created')
-                yield self.wait_on_message(
-                    to=droid,
-                    directive="register_with_room")
-                _log.debug('I guess this never really happens')
+                registrations.append(
+                    {"to": droid, "directive": "register_with_room"})
 
             for droid_num in range(infected_droids):
                 droid = self.hive.create_actor(
                     Droid, infected=True, room=room)
-                yield self.wait_on_message(
-                    to=droid,
-                    directive="register_with_room")
+                registrations.append(
+                    {"to": droid, "directive": "register_with_room"})
 
             last_room = room
             if first_room == None:
                 first_room = room
 
+        # Wait for all the droids to finish registering with their rooms
+        yield self.wait_on_all(registrations)
+        _log.debug('All droids registered')
+
         # Add security robot
         security_robot = self.hive.create_actor(SecurityRobot)
 
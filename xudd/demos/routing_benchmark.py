@@ -0,0 +1,206 @@
+"""
+URL routing benchmark.
+
+Sets up a few hundred routes and reports how many lookups per second
+the Router's trie manages, compared to the usual approach of trying
+a list of regexes in turn, and then how many requests per second a
+Router actor can pass on to a pool of handlers.
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import random
+import re
+import time
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.routing import Router, RouteTrie
+
+
+def make_routes(num_routes):
+    """
+    A mix of the sort of routes an API ends up with: plain ones, ones
+    with a parameter or two, and a few catch-alls.
+    """
+    routes = []
+    for i in range(num_routes):
+        kind = i % 4
+        if kind == 0:
+            routes.append('/api/v1/thing%d' % i)
+        elif kind == 1:
+            routes.append('/api/v1/thing%d/{thing_id}' % i)
+        elif kind == 2:
+            routes.append('/api/v1/thing%d/{thing_id}/parts/{part_id}' % i)
+        else:
+            routes.append('/files%d/{path:path}' % i)
+    return routes
+
+
+def make_paths(routes, num_paths):
+    paths = []
+    for i in range(num_paths):
+        pattern = random.choice(routes)
+        paths.append(pattern
+                     .replace('{thing_id}', str(i))
+                     .replace('{part_id}', 'p%d' % i)
+                     .replace('{path:path}', 'some/file%d.txt' % i))
+    return paths
+
+
+def compile_regexes(routes):
+    regexes = []
+    for pattern in routes:
+        regex = re.sub(r'\{(\w+):path\}', r'(?P<\1>.+)', pattern)
+        regex = re.sub(r'\{(\w+)\}', r'(?P<\1>[^/]+)', regex)
+        regexes.append((re.compile('^' + regex + '$'), pattern))
+    return regexes
+
+
+def match_regexes(regexes, path):
+    for regex, pattern in regexes:
+        match = regex.match(path)
+        if match:
+            return pattern, match.groupdict()
+    return None, {}
+
+
+def run_lookup_benchmark(num_routes=300, num_lookups=100000):
+    """
+    Returns (trie seconds, regex list seconds) for NUM_LOOKUPS lookups
+    among NUM_ROUTES routes.
+    """
+    routes = make_routes(num_routes)
+    paths = make_paths(routes, num_lookups)
+
+    trie = RouteTrie()
+    for pattern in routes:
+        trie.add(pattern, pattern)
+    regexes = compile_regexes(routes)
+
+    start = time.time()
+    for path in paths:
+        route, params = trie.match('GET', path)
+        assert route is not None
+    trie_elapsed = time.time() - start
+
+    start = time.time()
+    for path in paths:
+        pattern, params = match_regexes(regexes, path)
+        assert pattern is not None
+    regex_elapsed = time.time() - start
+
+    return trie_elapsed, regex_elapsed
+
+
+class Handler(Actor):
+    def __init__(self, hive, id):
+        super(Handler, self).__init__(hive, id)
+        self.message_routing.update(
+            {'handle_request': self.handle_request})
+
+    def handle_request(self, message):
+        message.reply(directive='respond', body={'status': '200 OK'})
+
+
+class Driver(Actor):
+    """
+    Plays the part of the HTTP actor, keeping CONCURRENCY requests
+    waiting on the router at a time.
+    """
+    def __init__(self, hive, id, router, paths, concurrency, done):
+        super(Driver, self).__init__(hive, id)
+        self.message_routing.update({
+            'start': self.start,
+            'respond': self.respond})
+        self.router = router
+        self.paths = iter(paths)
+        self.concurrency = concurrency
+        self.done = done
+        self.outstanding = 0
+
+    def start(self, message):
+        for i in range(self.concurrency):
+            self._send_next()
+
+    def respond(self, message):
+        self.outstanding -= 1
+        self._send_next()
+        if not self.outstanding:
+            self.done.append(time.time())
+            self.hive.send_shutdown()
+
+    def _send_next(self):
+        path = next(self.paths, None)
+        if path is None:
+            return
+        self.outstanding += 1
+        self.send_message(
+            to=self.router, directive='handle_request',
+            body={'options': {'method': 'GET', 'uri': path, 'headers': {}},
+                  'body': b'', 'streaming': False},
+            wants_reply=True)
+
+
+def run_dispatch_benchmark(num_routes=300, num_requests=50000,
+                           pool_size=4, concurrency=100):
+    """
+    Returns seconds taken for a Router to dispatch NUM_REQUESTS
+    requests to handlers (a pool of POOL_SIZE for every route).
+    """
+    routes = make_routes(num_routes)
+    paths = make_paths(routes, num_requests)
+
+    hive = Hive(loop=asyncio.new_event_loop())
+    pool = [hive.create_actor(Handler) for i in range(pool_size)]
+    router = hive.create_actor(
+        Router, routes=[(pattern, pool) for pattern in routes])
+    done = []
+    driver = hive.create_actor(
+        Driver, router=router, paths=paths, concurrency=concurrency,
+        done=done)
+
+    hive.send_message(to=driver, directive='start')
+    start = time.time()
+    hive.run()
+    hive.loop.close()
+    return done[0] - start
+
+
+def main(num_routes=300, num_lookups=100000, num_requests=50000):
+    trie_elapsed, regex_elapsed = run_lookup_benchmark(
+        num_routes, num_lookups)
+    print("%d routes, %d lookups:" % (num_routes, num_lookups))
+    for label, elapsed in [("trie", trie_elapsed),
+                           ("regex list", regex_elapsed)]:
+        print("%-12s %7.3fs: %10.0f lookups/sec" % (
+            label, elapsed, num_lookups / elapsed))
+
+    elapsed = run_dispatch_benchmark(num_routes, num_requests)
+    print("%-12s %7.3fs: %10.0f requests/sec through the Router actor" % (
+        "dispatch", elapsed, num_requests / elapsed))
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="URL routing benchmark")
+    parser.add_argument(
+        "-r", "--routes",
+        help="Number of routes",
+        default=300, type=int)
+    parser.add_argument(
+        "-l", "--lookups",
+        help="Number of lookups to time",
+        default=100000, type=int)
+    parser.add_argument(
+        "-n", "--requests",
+        help="Number of requests to send through the Router actor",
+        default=50000, type=int)
+
+    args = parser.parse_args()
+    main(args.routes, args.lookups, args.requests)
+
+
+if __name__ == "__main__":
+    cli()
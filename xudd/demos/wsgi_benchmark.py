@@ -0,0 +1,139 @@
+"""
+WSGI actor benchmark.
+
+Sends requests straight to a WSGI actor (no sockets, no HTTP parsing)
+from an actor playing the part of the HTTP actor, and reports how
+many requests per second it gets through, so the cost of building the
+environ and calling the app can be measured on its own.
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import time
+
+from tornado.httputil import HTTPHeaders
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.wsgi import WSGI
+
+
+# What a browser might send
+HEADERS = [
+    ('Host', 'localhost:8000'),
+    ('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64; rv:109.0) '
+                   'Gecko/20100101 Firefox/115.0'),
+    ('Accept', 'text/html,application/xhtml+xml,application/xml;'
+               'q=0.9,image/avif,image/webp,*/*;q=0.8'),
+    ('Accept-Language', 'en-US,en;q=0.5'),
+    ('Accept-Encoding', 'gzip, deflate, br'),
+    ('Connection', 'keep-alive'),
+    ('Cookie', 'session=0123456789abcdef; theme=dark'),
+    ('Upgrade-Insecure-Requests', '1'),
+    ('Cache-Control', 'max-age=0'),
+]
+
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'Hello World!']
+
+
+class Driver(Actor):
+    """
+    Keeps CONCURRENCY requests waiting on the WSGI actor at a time,
+    until NUM_REQUESTS have been answered.
+    """
+    def __init__(self, hive, id, wsgi, num_requests, concurrency, done):
+        super(Driver, self).__init__(hive, id)
+        self.message_routing.update({
+            'start': self.start,
+            'respond': self.respond})
+        self.wsgi = wsgi
+        self.to_send = num_requests
+        self.concurrency = concurrency
+        self.done = done
+        self.outstanding = 0
+
+        # (The WSGI actor doesn't touch these, so every request can
+        # share them)
+        self.headers = HTTPHeaders()
+        for name, value in HEADERS:
+            self.headers.add(name, value)
+
+    def start(self, message):
+        for i in range(self.concurrency):
+            self._send_next()
+
+    def respond(self, message):
+        self.outstanding -= 1
+        self._send_next()
+        if not self.outstanding:
+            self.done.append(time.time())
+            self.hive.send_shutdown()
+
+    def _send_next(self):
+        if not self.to_send:
+            return
+        self.to_send -= 1
+        self.outstanding += 1
+
+        self.send_message(
+            to=self.wsgi, directive='handle_request',
+            body={
+                'body': b'',
+                'options': {
+                    'method': 'GET',
+                    'uri': '/some/path/here?page=2&sort=name',
+                    'version': 'HTTP/1.1',
+                    'headers': self.headers,
+                    'remote_ip': '127.0.0.1',
+                    'content_length': None,
+                    'server_name': '127.0.0.1',
+                    'port': 8000},
+                'arguments': {},
+                'files': {},
+                'streaming': False},
+            wants_reply=True)
+
+
+def run_benchmark(num_requests=100000, concurrency=100):
+    """
+    Returns seconds taken for the WSGI actor to answer NUM_REQUESTS
+    requests.
+    """
+    hive = Hive(loop=asyncio.new_event_loop())
+    wsgi = hive.create_actor(WSGI, app=app)
+    done = []
+    driver = hive.create_actor(
+        Driver, wsgi=wsgi, num_requests=num_requests,
+        concurrency=concurrency, done=done)
+
+    hive.send_message(to=driver, directive='start')
+    start = time.time()
+    hive.run()
+    hive.loop.close()
+    return done[0] - start
+
+
+def main(num_requests=100000):
+    elapsed = run_benchmark(num_requests)
+    print("%d requests in %.3fs: %.0f requests/sec" % (
+        num_requests, elapsed, num_requests / elapsed))
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="WSGI actor benchmark")
+    parser.add_argument(
+        "-n", "--requests",
+        help="Number of requests to send through the WSGI actor",
+        default=100000, type=int)
+
+    args = parser.parse_args()
+    main(args.requests)
+
+
+if __name__ == "__main__":
+    cli()
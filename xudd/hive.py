@@ -1,18 +1,28 @@
 from __future__ import print_function
 
 import asyncio
+import heapq
 import logging
+from collections import deque
 from itertools import count
 import signal
 
 from xudd.message import Message
 from xudd.tools import (
-    base64_uuid4, is_qualified_id, join_id, split_id,
-    import_component)
+    base64_uuid4, is_qualified_id, join_id, split_id, actor_ref,
+    parse_actor_ref, release_actor_ref, import_component, ActorRef)
 from xudd.actor import Actor
 
 _log = logging.getLogger(__name__)
 
+# How many messages the hive will process in one go before giving the
+# event loop a chance to run other callbacks (socket I/O and friends)
+DEFAULT_BATCH_SIZE = 500
+
+# How many messages an actor gets to handle per turn before the next
+# runnable actor gets a go
+DEFAULT_MAX_MESSAGES = 5
+
 
 class Hive(Actor):
     """
@@ -26,25 +36,54 @@ class Hive(Actor):
 
     TODO: This docstring sucks ;)
     """
-    def __init__(self, hive_id=None, loop=None):
+    def __init__(self, hive_id=None, loop=None,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 max_messages=DEFAULT_MAX_MESSAGES,
+                 reply_fast_path=True,
+                 wait_timeout=None):
         # id of the hive
         self.hive_id = hive_id or self.gen_actor_id()
 
         hive_proxy = self.gen_proxy()
         super(Hive, self).__init__(
-            id=join_id("hive", self.hive_id),
+            id=actor_ref(join_id("hive", self.hive_id)),
             hive=hive_proxy)
         hive_proxy.associate_with_actor(self)
 
-        # Which actors this hive is managing
+        # Which actors this hive is managing (by local id), and their
+        # mailboxes (by fully qualified id)
         self._actor_registry = {}
+        self._mailboxes = {}
 
         # Note: can we just trust the user to set the right policy?
         self.loop = loop or asyncio.get_event_loop()
 
-        # Objects related to generating unique ids for messages
+        # Mailboxes of actors with messages waiting to be processed,
+        # and whether or not we've already asked the loop to drain them
+        self._run_queue = deque()
+        self._drain_scheduled = False
+        self.batch_size = batch_size
+        self.max_messages = max_messages
+
+        # Whether replies to coroutines waiting on this hive can skip
+        # straight to the coroutine (see _drain_run_queue)
+        self.reply_fast_path = reply_fast_path
+
+        # Deadlines for coroutines waiting on replies.  All of them
+        # share a single heap and a single loop timer, set for
+        # whichever deadline is soonest.
+        self.wait_timeout = wait_timeout
+        self._wait_deadlines = []
+        self._wait_deadline_counter = count()
+        self._cancelled_wait_deadlines = 0
+        self._wait_deadline_timer = None
+        self._wait_deadline_timer_when = None
+
+        # Objects related to generating unique ids for messages.
+        # (Counting from 1 so that no message id is ever falsy.)
         self.message_uuid = base64_uuid4()
-        self.message_counter = count()
+        self.message_counter = count(1)
+        self._message_id_prefix = u"%s:" % self.message_uuid
 
         # Ambassador registry (for inter-hive-communication)
         self._ambassadors = {}
@@ -53,7 +92,9 @@ class Hive(Actor):
         self.message_routing.update(
             {"register_ambassador": self.register_ambassador,
              "unregister_ambassador": self.unregister_ambassador,
-             "create_actor": self.create_actor_handler})
+             "create_actor": self.create_actor_handler,
+             "get_queue_depths": self.get_queue_depths,
+             "get_pending_waits": self.get_pending_waits})
 
         # Register ourselves on... ourselves ;)
         self.register_actor(self)
@@ -71,14 +112,42 @@ class Hive(Actor):
 
         self._actor_registry[actor.local_id] = actor
 
+        mailbox = ActorMailbox(actor)
+        # Only actors using the standard handle_message() get their
+        # replies handed straight to their waiting coroutines; anyone
+        # else might be doing something special with them.
+        mailbox.fast_replies = self.reply_fast_path and (
+            type(actor).handle_message is Actor.handle_message)
+        self._mailboxes[actor.id] = mailbox
+
     def remove_actor(self, actor_id):
         """
         Remove an actor from the hive
         """
-        if is_qualified_id(actor_id):
-            actor_id = split_id(actor_id)[0]
+        actor_id = self._qualify_local_id(actor_id)
+
+        self._actor_registry.pop(actor_id.local_id)
+        mailbox = self._mailboxes.pop(actor_id)
+        release_actor_ref(actor_id)
+
+        # Anything still waiting on this actor isn't going to get
+        # handled now, so let the senders know.
+        undelivered = list(mailbox.messages)
+        mailbox.messages.clear()
+        for message in undelivered:
+            self.return_to_sender(message)
+
+    def _qualify_local_id(self, actor_id):
+        """
+        Get the ActorRef for an actor that should be on this hive.
+        """
+        if not is_qualified_id(actor_id):
+            actor_id = join_id(actor_id, self.hive_id)
+        actor_id = parse_actor_ref(actor_id)
 
-        self._actor_registry.pop(actor_id)
+        # Make sure this actor is from our hive
+        assert actor_id.hive_id == self.hive_id
+        return actor_id
 
     def send_message(self, to, directive,
                      from_id=None,
@@ -89,7 +158,7 @@ class Hive(Actor):
 
         This also constructs a proper Message object.
         """
-        message_id = id or self.gen_message_id()
+        message_id = id if id is not None else self.gen_message_id()
         message = Message(
             to=to,
             from_id=from_id,
@@ -98,53 +167,311 @@ class Hive(Actor):
 
         _log.debug("send_message: %s", message)
 
-        self.loop.call_soon(self._process_message, message)
+        self._queue_message(message)
         return message_id
 
-    def run(self):
+    def send_after(self, delay, to, directive, **kwargs):
         """
-        Run the hive's main loop.
+        Send a message DELAY seconds from now.
+
+        Takes the same arguments as send_message(), and returns a
+        ScheduledMessage which can be used to cancel() it.
         """
-        self.loop.add_signal_handler(signal.SIGINT, self.send_shutdown)
-        self.loop.add_signal_handler(signal.SIGTERM, self.send_shutdown)
-        self.loop.run_forever()
+        scheduled = ScheduledMessage(
+            self, dict(kwargs, to=to, directive=directive))
+        scheduled._schedule(self.loop.time() + delay)
+        return scheduled
+
+    def send_every(self, interval, to, directive, **kwargs):
+        """
+        Send a message every INTERVAL seconds, starting INTERVAL
+        seconds from now, until cancelled.
+
+        Takes the same arguments as send_message() (though each
+        message gets its own id), and returns a ScheduledMessage which
+        can be used to cancel() it.
+        """
+        scheduled = ScheduledMessage(
+            self, dict(kwargs, to=to, directive=directive), interval)
+        scheduled._schedule(self.loop.time() + interval)
+        return scheduled
+
+    def send_when_readable(self, fileobj, to, directive, **kwargs):
+        """
+        Send a message as soon as FILEOBJ (a socket, or anything else
+        with a fileno()) has something to read.
+
+        This is a one-shot: the hive stops watching FILEOBJ once the
+        message is sent, so ask again after you've done your reading.
+        Takes the same arguments as send_message(), and returns the
+        message id.
+        """
+        return self._send_when_ready(
+            self.loop.add_reader, self.loop.remove_reader,
+            fileobj, to, directive, kwargs)
+
+    def send_when_writable(self, fileobj, to, directive, **kwargs):
+        """
+        Like send_when_readable(), but for when FILEOBJ can be written
+        to without blocking.
+        """
+        return self._send_when_ready(
+            self.loop.add_writer, self.loop.remove_writer,
+            fileobj, to, directive, kwargs)
+
+    def _send_when_ready(self, add, remove, fileobj, to, directive, kwargs):
+        message_id = kwargs.pop("id", None)
+        if message_id is None:
+            message_id = self.gen_message_id()
+
+        def ready():
+            remove(fileobj)
+            self.send_message(to, directive, id=message_id, **kwargs)
+
+        add(fileobj, ready)
+        return message_id
 
+    def stop_watching(self, fileobj):
+        """
+        Forget about any send_when_readable() or send_when_writable()
+        waiting on FILEOBJ, eg because it's about to be closed.
+        """
+        self.loop.remove_reader(fileobj)
+        self.loop.remove_writer(fileobj)
 
-    def _process_message(self, message):
-        # Route appropriately here
-        actor_id, hive_id = split_id(message.to)
+    def _route_message(self, message):
+        """
+        Figure out which mailbox a message should go to.
 
+        Returns a tuple of (mailbox, message), since messages to remote
+        actors get repackaged for their hive's ambassador.  If there's
+        nowhere to deliver the message to, mailbox will be None.
+        """
         ## Is the actor local?  Send it!
-        if hive_id == self.hive_id:
-            try:
-                actor = self._actor_registry[actor_id]
-            except IndexError:
+        # (Mailboxes are keyed by the full actor id, so this is a
+        # single lookup whether message.to is a plain string or an
+        # ActorRef)
+        mailbox = self._mailboxes.get(message.to)
+
+        if mailbox is None:
+            # (Not actor_ref(), which would hold onto every remote or
+            # made-up recipient id we ever saw)
+            to = message.to
+            if isinstance(to, ActorRef):
+                hive_id = to.hive_id
+            else:
+                hive_id = split_id(to)[1]
+
+            if hive_id == self.hive_id or hive_id is None:
                 # For some reason this actor wasn't found, so we may need to
                 # inform the original sender
                 _log.warning('recipient not found for message: {0}'.format(
                     message))
 
                 self.return_to_sender(message)
+                return None, None
 
-            # Maybe not the most opportune place to attach this
-            message.hive_proxy = actor.hive
-
-            # TODO: More error handling here! ;)
-            actor.handle_message(message)
-
-        ## Looks like the actor must be remote, forward it!
-        else:
+            ## Looks like the actor must be remote, forward it!
             # Get the associated ambassador
             ## TODO: error handling if hive doesn't exist ;)
             ambassador_id = self._ambassadors[hive_id]
-            ambassador = self._actor_registry[ambassador_id]
+            mailbox = self._mailboxes[ambassador_id]
 
             # repackage the message for sending
-            repackaged_message = self._repackage_message_for_forwarding(
-                message, ambassador)
+            message = self._repackage_message_for_forwarding(
+                message, mailbox.actor)
+
+        # Maybe not the most opportune place to attach this
+        message.hive_proxy = mailbox.actor.hive
+
+        return mailbox, message
+
+    def _queue_message(self, message):
+        """
+        Put a message in its recipient's mailbox, scheduling the
+        recipient to run if it isn't already.
+        """
+        mailbox, message = self._route_message(message)
+        if mailbox is None:
+            return
+
+        mailbox.messages.append(message)
+
+        if not mailbox.scheduled:
+            mailbox.scheduled = True
+            self._run_queue.append(mailbox)
+
+            if not self._drain_scheduled:
+                self._drain_scheduled = True
+                self.loop.call_soon(self._drain_run_queue)
+
+    def _drain_run_queue(self):
+        """
+        Give runnable actors their turns, round-robin style.
+
+        Each actor handles at most max_messages before going to the
+        back of the line, so one chatty actor can't starve the rest.
+        After batch_size messages in total we reschedule ourselves
+        rather than keep going, so that the event loop gets a chance
+        to do other work (like socket I/O) between batches.
+        """
+        run_queue = self._run_queue
+        max_messages = self.max_messages
+        processed = 0
+
+        try:
+            while run_queue and processed < self.batch_size:
+                mailbox = run_queue.popleft()
+                messages = mailbox.messages
+                actor = mailbox.actor
+                handle_message = actor.handle_message
+                fast_replies = mailbox.fast_replies
+                turn = 0
+
+                try:
+                    while messages and turn < max_messages:
+                        turn += 1
+                        message = messages.popleft()
+
+                        # Fast path: a reply to a coroutine that's
+                        # waiting on it goes straight to that coroutine,
+                        # skipping handle_message() and the autoreply
+                        # machinery.  It still waited its turn in the
+                        # mailbox, so ordering is preserved and we never
+                        # resume a coroutine from inside whoever sent
+                        # the reply.
+                        if fast_replies and message.in_reply_to is not None \
+                           and not message.wants_reply:
+                            coroutine = actor._waiting_coroutines.pop(
+                                message.in_reply_to, None)
+                            if coroutine is not None:
+                                if actor._wait_deadlines:
+                                    actor._forget_wait_deadline(
+                                        message.in_reply_to)
+                                actor._resume_coroutine(coroutine, message)
+                                continue
+
+                        handle_message(message)
+                finally:
+                    processed += turn
+                    if messages:
+                        run_queue.append(mailbox)
+                    else:
+                        mailbox.scheduled = False
+        finally:
+            # Even if a message handler blew up, don't leave the
+            # remaining actors stranded
+            if run_queue:
+                self.loop.call_soon(self._drain_run_queue)
+            else:
+                self._drain_scheduled = False
+
+    def queue_depths(self):
+        """
+        Return a dictionary of actor id -> number of messages waiting
+        in that actor's mailbox.
+        """
+        return dict(
+            (mailbox.actor.id, len(mailbox.messages))
+            for mailbox in self._mailboxes.values())
+
+    def pending_waits(self):
+        """
+        Return a dictionary of actor id -> number of coroutines that
+        actor has waiting on replies.
+        """
+        return dict(
+            (mailbox.actor.id, len(mailbox.actor._waiting_coroutines))
+            for mailbox in self._mailboxes.values())
+
+    def add_wait_deadline(self, actor, message_id, timeout=None):
+        """
+        Give up on ACTOR's wait for a reply to MESSAGE_ID if it takes
+        longer than TIMEOUT seconds (or our wait_timeout, if TIMEOUT
+        is None).  If neither is set, wait forever.
+
+        Returns the deadline entry (or None), which may be passed to
+        cancel_wait_deadline().
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+            if timeout is None:
+                return None
+
+        deadline = [
+            self.loop.time() + timeout, next(self._wait_deadline_counter),
+            actor, message_id, timeout]
+        heapq.heappush(self._wait_deadlines, deadline)
+        actor._wait_deadlines[message_id] = deadline
+
+        if self._wait_deadline_timer is None \
+           or deadline[0] < self._wait_deadline_timer_when:
+            self._set_wait_deadline_timer()
+
+        return deadline
+
+    def cancel_wait_deadline(self, deadline):
+        """
+        Cancel a deadline set up by add_wait_deadline().
+
+        Cancelled deadlines are just marked as such and skipped over
+        when they come up, unless enough of them pile up that it's
+        worth rebuilding the heap without them.
+        """
+        if deadline[2] is None:
+            return
+
+        deadline[2] = None
+        self._cancelled_wait_deadlines += 1
+
+        if self._cancelled_wait_deadlines > 64 \
+           and self._cancelled_wait_deadlines > len(self._wait_deadlines) // 2:
+            self._wait_deadlines = [
+                deadline for deadline in self._wait_deadlines
+                if deadline[2] is not None]
+            heapq.heapify(self._wait_deadlines)
+            self._cancelled_wait_deadlines = 0
+
+    def _set_wait_deadline_timer(self):
+        """
+        (Re)set the loop timer for whichever deadline is soonest.
+        """
+        if self._wait_deadline_timer is not None:
+            self._wait_deadline_timer.cancel()
+            self._wait_deadline_timer = None
 
-            # send it off!
-            ambassador.handle_message(repackaged_message)
+        if self._wait_deadlines:
+            self._wait_deadline_timer_when = self._wait_deadlines[0][0]
+            self._wait_deadline_timer = self.loop.call_at(
+                self._wait_deadline_timer_when, self._expire_wait_deadlines)
+
+    def _expire_wait_deadlines(self):
+        """
+        Time out every wait whose deadline has passed.
+        """
+        self._wait_deadline_timer = None
+        deadlines = self._wait_deadlines
+        now = self.loop.time()
+
+        try:
+            while deadlines and deadlines[0][0] <= now:
+                deadline = heapq.heappop(deadlines)
+                when, counter, actor, message_id, timeout = deadline
+                if actor is None:
+                    self._cancelled_wait_deadlines -= 1
+                    continue
+
+                actor._expire_wait(message_id, timeout)
+        finally:
+            self._set_wait_deadline_timer()
+
+    def run(self):
+        """
+        Run the hive's main loop.
+        """
+        self.loop.add_signal_handler(signal.SIGINT, self.send_shutdown)
+        self.loop.add_signal_handler(signal.SIGTERM, self.send_shutdown)
+        self.loop.run_forever()
 
 
     def _repackage_message_for_forwarding(self, message, ambassador):
@@ -163,9 +490,9 @@ class Hive(Actor):
                 "to": message.to,
                 "directive": message.directive,
                 "from_id": message.from_id,
-                "id": message.id,
+                "id": self.qualify_message_id(message.id),
                 "body": message.body,
-                "in_reply_to": message.in_reply_to,
+                "in_reply_to": self.qualify_message_id(message.in_reply_to),
                 "wants_reply": message.wants_reply})
 
     def return_to_sender(self, message, directive="error.no_such_actor"):
@@ -195,20 +522,48 @@ class Hive(Actor):
 
     def gen_message_id(self):
         """
-        Generate a unique message id.
+        Generate a message id that's unique within this hive.
 
         Since uuid4s take a bit of time to compose, instead we keep a
-        local counter combined with our hive's counter-uuid.
+        local counter.  These are only unique to this hive, so they get
+        combined with our hive's counter-uuid by qualify_message_id()
+        before they're allowed to leave it.
         """
         # This method should be thread safe, I think, without need for a lock:
         #   http://29a.ch/2009/2/20/atomic-get-and-increment-in-python
-        return u"%s:%s" % (self.message_uuid, self.message_counter.__next__())
+        return next(self.message_counter)
+
+    def qualify_message_id(self, message_id):
+        """
+        Make a message id globally unique, for sending to other hives.
+
+        Our own (integer) message ids become "<message_uuid>:<counter>";
+        anything else is already qualified and is returned as-is.
+        """
+        if isinstance(message_id, int):
+            return self._message_id_prefix + str(message_id)
+
+        return message_id
+
+    def localize_message_id(self, message_id):
+        """
+        The reverse of qualify_message_id(), for messages coming in from
+        other hives.
+
+        If this is one of our own message ids coming back to us, turn it
+        back into the integer id we know it by; otherwise return it as-is.
+        """
+        if isinstance(message_id, str) \
+           and message_id.startswith(self._message_id_prefix):
+            return int(message_id[len(self._message_id_prefix):])
+
+        return message_id
 
     def create_actor(self, actor_class, *args, **kwargs):
         hive_proxy = self.gen_proxy()
-        actor_id = join_id(
+        actor_id = actor_ref(join_id(
             kwargs.pop("id", None) or self.gen_actor_id(),
-            self.hive_id)
+            self.hive_id))
 
         actor = actor_class(
             hive_proxy, actor_id, *args, **kwargs)
@@ -229,21 +584,18 @@ class Hive(Actor):
         """
         Register this actor as being the ambassador for some specific hive id
         """
-        from_actor_id, from_hive_id = split_id(message.from_id)
-        # Make sure this actor is from our hive
-        assert from_hive_id == self.hive_id or from_hive_id is None
-        self._ambassadors[message.body["hive_id"]] = from_actor_id
+        from_id = self._qualify_local_id(message.from_id)
+        self._ambassadors[message.body["hive_id"]] = from_id
 
     def unregister_ambassador(self, message):
         """
         Unregister this actor as being the ambassador for some specific hive id
         """
-        from_actor_id, from_hive_id = split_id(message.from_id)
-        assert from_hive_id == self.hive_id or from_hive_id is None
+        from_id = self._qualify_local_id(message.from_id)
         old_ambassador_id = self._ambassadors.pop(message.body["hive_id"])
         # Make sure this actor is really the one it said it was
         # (though this only possibly could help find bugs)
-        assert old_ambassador_id == from_actor_id
+        assert old_ambassador_id == from_id
 
     # NOTE: If we eventually get to the point where we don't
     # necessarily trust outside hives, THIS MUST BE MOVED TO A MIXIN.
@@ -261,6 +613,75 @@ class Hive(Actor):
         actor_id = self.create_actor(actor_class, *actor_args, **actor_kwargs)
         message.reply({'actor_id': actor_id})
 
+    def get_pending_waits(self, message):
+        """
+        Reply with how many coroutines each actor has waiting on replies.
+        """
+        message.reply({'pending_waits': self.pending_waits()})
+
+    def get_queue_depths(self, message):
+        """
+        Reply with how many messages are waiting on each actor.
+
+        Handy for figuring out who's hogging the hive.
+        """
+        message.reply({'queue_depths': self.queue_depths()})
+
+
+class ActorMailbox(object):
+    """
+    Messages waiting to be handled by a particular actor.
+
+    Also keeps track of whether or not the actor is currently sitting
+    in the hive's run queue.
+    """
+    __slots__ = ("actor", "messages", "scheduled", "fast_replies")
+
+    def __init__(self, actor):
+        self.actor = actor
+        self.messages = deque()
+        self.scheduled = False
+        self.fast_replies = False
+
+
+class ScheduledMessage(object):
+    """
+    A message waiting to be sent later (or repeatedly), as set up by
+    Hive.send_after() or Hive.send_every().
+    """
+    def __init__(self, hive, message_kwargs, interval=None):
+        self.hive = hive
+        self.message_kwargs = message_kwargs
+        self.interval = interval
+
+        # Id of the most recent message we sent
+        self.message_id = None
+        self.cancelled = False
+        self._timer = None
+        self._when = None
+
+    def _schedule(self, when):
+        self._when = when
+        self._timer = self.hive.loop.call_at(when, self._send)
+
+    def _send(self):
+        self._timer = None
+        self.message_id = self.hive.send_message(**self.message_kwargs)
+
+        if self.interval is not None and not self.cancelled:
+            # Schedule off of when we were *meant* to go off, so we
+            # don't drift
+            self._schedule(self._when + self.interval)
+
+    def cancel(self):
+        """
+        Don't send anything else.
+        """
+        self.cancelled = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
 
 class HiveProxy(object):
     """
@@ -289,6 +710,25 @@ class HiveProxy(object):
             in_reply_to=in_reply_to, id=id,
             wants_reply=wants_reply)
 
+    def send_after(self, delay, to, directive, **kwargs):
+        kwargs.setdefault("from_id", self._actor.id)
+        return self._hive.send_after(delay, to, directive, **kwargs)
+
+    def send_every(self, interval, to, directive, **kwargs):
+        kwargs.setdefault("from_id", self._actor.id)
+        return self._hive.send_every(interval, to, directive, **kwargs)
+
+    def send_when_readable(self, fileobj, to, directive, **kwargs):
+        kwargs.setdefault("from_id", self._actor.id)
+        return self._hive.send_when_readable(fileobj, to, directive, **kwargs)
+
+    def send_when_writable(self, fileobj, to, directive, **kwargs):
+        kwargs.setdefault("from_id", self._actor.id)
+        return self._hive.send_when_writable(fileobj, to, directive, **kwargs)
+
+    def stop_watching(self, fileobj):
+        return self._hive.stop_watching(fileobj)
+
     def remove_actor(self, *args, **kwargs):
         return self._hive.remove_actor(*args, **kwargs)
 
@@ -301,7 +741,23 @@ class HiveProxy(object):
     def gen_message_id(self, *args, **kwargs):
         return self._hive.gen_message_id(*args, **kwargs)
 
+    def qualify_message_id(self, *args, **kwargs):
+        return self._hive.qualify_message_id(*args, **kwargs)
+
+    def add_wait_deadline(self, message_id, timeout=None):
+        return self._hive.add_wait_deadline(self._actor, message_id, timeout)
+
+    def cancel_wait_deadline(self, deadline):
+        return self._hive.cancel_wait_deadline(deadline)
+
+    def localize_message_id(self, *args, **kwargs):
+        return self._hive.localize_message_id(*args, **kwargs)
+
     @property
     def hive_id(self):
         return self._hive.hive_id
 
+    @property
+    def loop(self):
+        return self._hive.loop
+
@@ -0,0 +1,536 @@
+"""
+An in-memory cache for HTTP responses.
+
+Put a ResponseCache between the HTTP actor and whatever handles its
+requests (a WSGI actor, say):
+
+    wsgi = hive.create_actor(WSGI, app=application)
+    cache = hive.create_actor(ResponseCache, backend=wsgi)
+    http = hive.create_actor(HTTP, request_handler=cache)
+
+GET and HEAD responses that say they can be cached (with
+Cache-Control: max-age, or Expires) are kept, keyed on the method,
+URI and whatever request headers the response Varies on, and served
+straight from memory until they go stale.  Conditional requests
+(If-None-Match, If-Modified-Since) get a 304 when they can.
+"""
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+from xudd.actor import Actor
+
+_log = logging.getLogger(__name__)
+
+
+# Statuses it's fine to cache (RFC 7231, section 6.1)
+CACHEABLE_STATUSES = ('200', '203', '300', '301', '404', '410')
+
+# Methods whose responses we cache, and those that invalidate what
+# we've cached for the URI
+CACHEABLE_METHODS = ('GET', 'HEAD')
+UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# Headers a 304 carries over from the full response
+NOT_MODIFIED_HEADERS = (
+    'cache-control', 'content-location', 'date', 'etag', 'expires', 'vary')
+
+# Rough per-entry bookkeeping cost, on top of its headers and body
+ENTRY_OVERHEAD = 256
+
+
+def _parse_date(value):
+    """
+    Parse an HTTP date into a timestamp, or None if we can't.
+    """
+    try:
+        parsed = parsedate_tz(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def _header(headers, name):
+    """
+    Get a header's value out of a response's list of (name, value).
+    """
+    name = name.lower()
+    for header, value in headers:
+        if header.lower() == name:
+            return value
+    return None
+
+
+def _cache_control(value):
+    """
+    Parse a Cache-Control header into a dict of directive -> value
+    (None for directives without one).
+    """
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') or None
+    return directives
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+class CacheEntry(object):
+    """
+    A cached response.
+    """
+    __slots__ = ("key", "status", "headers", "body", "etag",
+                 "last_modified", "stored", "expires", "size")
+
+    def __init__(self, key, status, headers, body, etag, last_modified,
+                 stored, expires):
+        self.key = key
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = stored
+        self.expires = expires
+        self.size = ENTRY_OVERHEAD + len(body) + sum(
+            len(name) + len(value) for name, value in headers)
+
+
+class Variants(object):
+    """
+    The cached responses for one method and URI: which request
+    headers they Vary on, and the entry for each set of values of
+    those headers.
+    """
+    __slots__ = ("vary", "entries")
+
+    def __init__(self, vary):
+        self.vary = vary
+        self.entries = {}
+
+
+class Fetch(object):
+    """
+    A request the backend's working on for us, and the requests
+    waiting on its response.
+    """
+    __slots__ = ("key", "vary_values", "waiters")
+
+    def __init__(self, key, vary_values, waiters):
+        # (method, uri), or None for a fetch nobody else can join
+        self.key = key
+        self.vary_values = vary_values
+        self.waiters = waiters
+
+
+class ResponseCache(Actor):
+    '''
+    Caches the responses BACKEND gives to the 'handle_request'
+    messages an HTTP actor sends us, up to MAX_BYTES of them, throwing
+    out the least recently used entries to make room.
+
+    Responses are only cached if they say for how long (unless
+    DEFAULT_MAX_AGE is set, in which case ones that don't say are
+    kept that many seconds), aren't private, no-store or no-cache,
+    aren't streamed, and are no bigger than MAX_ENTRY_BYTES.  Cached
+    responses get an ETag if they don't have one (unless ADD_ETAGS is
+    off), so clients can revalidate them.
+
+    If a request comes in for something the backend's already working
+    on, it waits on that response rather than asking for it again.
+    POSTs and the like (which are passed straight on, as are streamed
+    uploads) throw out whatever's cached for their URI.
+
+    Send us 'get_cache_stats' to see how we're doing.
+    '''
+    def __init__(self, hive, id, backend, max_bytes=64 * 1024 * 1024,
+                 max_entry_bytes=1024 * 1024, default_max_age=None,
+                 add_etags=True):
+        super(ResponseCache, self).__init__(hive, id)
+        self.message_routing.update({
+            'handle_request': self.handle_request,
+            'handle_request_chunk': self.handle_request_chunk,
+            'respond': self.respond,
+            'respond_chunk': self.respond_chunk,
+            'get_cache_stats': self.get_cache_stats,
+            # What we get if the backend didn't respond to a request
+            # (or its handler failed)
+            'reply': self.handle_reply,
+            'error.handler_failed': self.handle_reply,
+        })
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.default_max_age = default_max_age
+        self.add_etags = add_etags
+
+        # (method, uri, vary values) -> CacheEntry, least recently
+        # used first
+        self.entries = OrderedDict()
+        # (method, uri) -> Variants
+        self.variants = {}
+        self.size = 0
+
+        # (method, uri) -> the Fetch that others can join
+        self.fetching = {}
+        # Backend request id -> Fetch
+        self.fetches = {}
+        # Backend request id -> request whose response is streaming
+        # through us
+        self.streams = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.not_modified = 0
+
+    ##################
+    # Request handling
+    ##################
+
+    def handle_request(self, message):
+        options = message.body['options']
+        method = options['method']
+        headers = options['headers']
+
+        if method not in CACHEABLE_METHODS or message.body.get('streaming') \
+           or 'Authorization' in headers:
+            if method in UNSAFE_METHODS:
+                self._invalidate(options['uri'])
+            self._forward(message)
+            return
+
+        key = (method, options['uri'])
+        variants = self.variants.get(key)
+        vary_values = self._vary_values(variants, headers)
+
+        if not self._no_cache(headers):
+            entry = self._lookup(key, vary_values)
+            if entry is not None:
+                self.hits += 1
+                message.reply(
+                    directive='respond',
+                    body=self._response_for(entry, method, headers))
+                return
+
+        self.misses += 1
+        message.defer_reply()
+
+        fetch = self.fetching.get(key)
+        if fetch is not None and fetch.vary_values == vary_values:
+            self.collapsed += 1
+            fetch.waiters.append(message)
+            return
+
+        fetch = Fetch(key, vary_values, [message])
+        if key not in self.fetching:
+            self.fetching[key] = fetch
+
+        # We'll check the validators ourselves, so make sure we get the
+        # whole response to cache
+        headers = headers.copy()
+        headers.pop('If-None-Match', None)
+        headers.pop('If-Modified-Since', None)
+        backend_id = self.send_message(
+            to=self.backend,
+            directive='handle_request',
+            body=dict(message.body, options=dict(options, headers=headers)),
+            wants_reply=True)
+        self.fetches[backend_id] = fetch
+
+    def handle_request_chunk(self, message):
+        # Only streamed uploads have these, and we pass those through
+        self._forward(message)
+
+    def _forward(self, message):
+        # Pass it on as though we weren't here, so the reply goes
+        # straight back to whoever sent it
+        message.defer_reply()
+        self.hive.send_message(
+            to=self.backend,
+            directive=message.directive,
+            from_id=message.from_id,
+            id=message.id,
+            body=message.body,
+            wants_reply=message.wants_reply)
+
+    def _vary_values(self, variants, headers):
+        if variants is None or not variants.vary:
+            return ()
+        return tuple(headers.get(name) for name in variants.vary)
+
+    def _no_cache(self, headers):
+        return 'no-cache' in _cache_control(headers.get('Cache-Control')) \
+            or headers.get('Pragma', '').lower() == 'no-cache'
+
+    def _lookup(self, key, vary_values):
+        entry = self.entries.get(key + (vary_values,))
+        if entry is None:
+            return None
+
+        if entry.expires <= self.hive.loop.time():
+            self._remove(entry)
+            return None
+
+        self.entries.move_to_end(entry.key)
+        return entry
+
+    def _response_for(self, entry, method, request_headers):
+        age = int(self.hive.loop.time() - entry.stored)
+
+        if self._is_not_modified(entry, request_headers):
+            self.not_modified += 1
+            headers = [(name, value) for name, value in entry.headers
+                       if name.lower() in NOT_MODIFIED_HEADERS]
+            # What the length would have been, so the HTTP actor
+            # doesn't tell the client it's 0
+            headers.append(('Content-Length', str(len(entry.body))))
+            headers.append(('Age', str(age)))
+            return {'status': '304 Not Modified', 'headers': headers,
+                    'body': b''}
+
+        headers = entry.headers + [('Age', str(age))]
+        if method == 'HEAD':
+            # Just the headers, but with the length the body would have
+            if _header(headers, 'Content-Length') is None:
+                headers.append(('Content-Length', str(len(entry.body))))
+            return {'status': entry.status, 'headers': headers, 'body': b''}
+
+        return {'status': entry.status, 'headers': headers,
+                'body': entry.body}
+
+    def _is_not_modified(self, entry, headers):
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match is not None:
+            if entry.etag is None:
+                return False
+            etag = _strip_weak(entry.etag)
+            return any(
+                tag == '*' or _strip_weak(tag) == etag
+                for tag in (t.strip() for t in if_none_match.split(',')))
+
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since is not None and entry.last_modified is not None:
+            since = _parse_date(if_modified_since)
+            return since is not None and entry.last_modified <= since
+
+        return False
+
+    ###################
+    # Backend responses
+    ###################
+
+    def respond(self, message):
+        fetch = self.fetches.pop(message.in_reply_to, None)
+        if fetch is None:
+            return
+        if self.fetching.get(fetch.key) is fetch:
+            del self.fetching[fetch.key]
+
+        leader, others = fetch.waiters[0], fetch.waiters[1:]
+        body = message.body
+        entry = self._store(fetch, body)
+
+        if entry is None:
+            # Not something we can share, so only the first request
+            # gets this response, and the rest ask for their own
+            if body.get('more'):
+                self.streams[message.in_reply_to] = leader
+            leader.reply(directive='respond', body=body)
+            for waiter in others:
+                self._forward(waiter)
+            return
+
+        for waiter in fetch.waiters:
+            headers = waiter.body['options']['headers']
+            if self._vary_values(self.variants.get(fetch.key), headers) \
+               != entry.key[2]:
+                # This one wants a different variant after all
+                self.misses -= 1
+                self.handle_request(waiter)
+                continue
+            waiter.reply(
+                directive='respond',
+                body=self._response_for(
+                    entry, waiter.body['options']['method'], headers))
+
+    def handle_reply(self, message):
+        # Must be a request the backend didn't respond to; let
+        # everyone waiting on it know, rather than leaving them (and
+        # anyone else who asks for the same thing) waiting forever
+        fetch = self.fetches.pop(message.in_reply_to, None)
+        if fetch is None:
+            return
+        if self.fetching.get(fetch.key) is fetch:
+            del self.fetching[fetch.key]
+
+        for waiter in fetch.waiters:
+            waiter.reply(directive='respond', body={
+                'status': '500 Internal Server Error', 'headers': [],
+                'body': b''})
+
+    def respond_chunk(self, message):
+        request_id = message.body['request']
+        leader = self.streams.get(request_id)
+        if leader is None:
+            if message.wants_reply:
+                message.reply({'closed': True})
+            return
+
+        if message.body.get('abort') or not message.body.get('more'):
+            del self.streams[request_id]
+
+        # Pass it on to the HTTP actor as though it came from the
+        # backend, so the HTTP actor's reply (once the chunk's been
+        # sent) goes straight back to it
+        message.defer_reply()
+        self.hive.send_message(
+            to=leader.from_id,
+            directive='respond_chunk',
+            from_id=message.from_id,
+            id=message.id,
+            body=dict(message.body, request=leader.id),
+            wants_reply=message.wants_reply)
+
+    def _store(self, fetch, response):
+        """
+        Cache RESPONSE if we can; returns the CacheEntry, or None.
+        """
+        if 'status' not in response or response.get('more') \
+           or response.get('file') is not None:
+            return None
+
+        status = response['status']
+        if status.split(' ', 1)[0] not in CACHEABLE_STATUSES:
+            return None
+
+        headers = list(response.get('headers', ()))
+        body = response.get('body', b'')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        vary = _header(headers, 'Vary')
+        vary = tuple(
+            name.strip() for name in (vary or '').split(',') if name.strip())
+        if '*' in vary:
+            return None
+
+        max_age = self._max_age(headers)
+        if max_age is None or max_age <= 0:
+            return None
+
+        etag = _header(headers, 'ETag')
+        if etag is None and self.add_etags:
+            etag = '"{0}"'.format(hashlib.sha1(body).hexdigest()[:20])
+            headers.append(('ETag', etag))
+        last_modified = _header(headers, 'Last-Modified')
+        if last_modified is not None:
+            last_modified = _parse_date(last_modified)
+
+        method, uri = fetch.key
+        variants = self.variants.get(fetch.key)
+        if variants is not None and variants.vary != vary:
+            # The response has changed what it Varies on, so whatever
+            # we had is no use
+            self._invalidate_variants(fetch.key)
+            variants = None
+        if variants is None:
+            variants = self.variants[fetch.key] = Variants(vary)
+
+        leader_headers = fetch.waiters[0].body['options']['headers']
+        vary_values = self._vary_values(variants, leader_headers)
+
+        now = self.hive.loop.time()
+        entry = CacheEntry(
+            (method, uri, vary_values), status, headers, body, etag,
+            last_modified, now, now + max_age)
+        if entry.size > self.max_entry_bytes or entry.size > self.max_bytes:
+            if not variants.entries:
+                del self.variants[fetch.key]
+            return None
+
+        old = self.entries.get(entry.key)
+        if old is not None:
+            self._remove(old)
+            variants = self.variants.setdefault(fetch.key, variants)
+
+        self.entries[entry.key] = entry
+        variants.entries[vary_values] = entry
+        self.size += entry.size
+
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries.values())))
+
+        return entry
+
+    def _max_age(self, headers):
+        cache_control = _cache_control(_header(headers, 'Cache-Control'))
+        if 'no-store' in cache_control or 'no-cache' in cache_control \
+           or 'private' in cache_control:
+            return None
+
+        for directive in ('s-maxage', 'max-age'):
+            if cache_control.get(directive) is not None:
+                try:
+                    return int(cache_control[directive])
+                except ValueError:
+                    return None
+
+        expires = _header(headers, 'Expires')
+        if expires is not None:
+            expires = _parse_date(expires)
+            # An Expires we can't make sense of means already expired
+            return None if expires is None else expires - time.time()
+
+        return self.default_max_age
+
+    ##########
+    # Eviction
+    ##########
+
+    def _remove(self, entry):
+        del self.entries[entry.key]
+        self.size -= entry.size
+
+        method, uri, vary_values = entry.key
+        variants = self.variants.get((method, uri))
+        if variants is not None:
+            variants.entries.pop(vary_values, None)
+            if not variants.entries:
+                del self.variants[(method, uri)]
+
+    def _invalidate_variants(self, key):
+        variants = self.variants.get(key)
+        if variants is not None:
+            for entry in list(variants.entries.values()):
+                self._remove(entry)
+            self.variants.pop(key, None)
+
+    def _invalidate(self, uri):
+        for method in CACHEABLE_METHODS:
+            self._invalidate_variants((method, uri))
+
+    def cache_stats(self):
+        """
+        How many requests we've answered from the cache (`hits`, and of
+        those, `not_modified`) or had to pass on (`misses`, and of
+        those, `collapsed` into a request already in progress), and
+        how many `entries` we're holding in how many `bytes`.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'collapsed': self.collapsed,
+            'not_modified': self.not_modified,
+            'entries': len(self.entries),
+            'bytes': self.size}
+
+    def get_cache_stats(self, message):
+        message.reply(self.cache_stats())
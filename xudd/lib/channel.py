@@ -0,0 +1,226 @@
+"""
+A framed byte channel between two hives, over a socket.
+
+Each end wraps one end of a connected socket (usually half of a
+socketpair(), shared with a child process).  Frames are sent with a
+4-byte length prefix, and the receiving end is woken up by its event
+loop's add_reader() only when there's actually something to read,
+rather than anyone having to poll for it.
+"""
+import errno
+import logging
+import socket
+import struct
+
+_log = logging.getLogger(__name__)
+
+# Frames are prefixed with their length, as a big-endian unsigned int
+FRAME_HEADER = struct.Struct("!I")
+
+# How much to try to read from the socket at a time
+READ_SIZE = 256 * 1024
+
+
+def channel_pair():
+    """
+    Make a connected pair of sockets for the two ends of a channel.
+    """
+    return socket.socketpair()
+
+
+class Channel(object):
+    """
+    One end of a channel.
+
+    ON_FRAME gets called with the bytes of each frame as it comes in,
+    and ON_CLOSE (if given) once the other end has gone away.  Call
+    start() to start listening for them on LOOP.
+
+    send() never blocks: whatever the socket won't take right away is
+    buffered, and written out as the socket becomes writable.
+    """
+    def __init__(self, sock, loop, on_frame, on_close=None):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.loop = loop
+        self.on_frame = on_frame
+        self.on_close = on_close
+
+        self._read_buffer = bytearray()
+        self._write_buffer = bytearray()
+        self._writing = False
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def start(self):
+        """
+        Start handing frames to ON_FRAME as they come in.
+        """
+        self.loop.add_reader(self.sock.fileno(), self._read_ready)
+
+    def send(self, data):
+        """
+        Send DATA (bytes) as a single frame.
+        """
+        if self.closed:
+            return
+
+        frame = FRAME_HEADER.pack(len(data)) + data
+        if self._write_buffer:
+            # Still waiting on the socket; get in line
+            self._write_buffer += frame
+            return
+
+        try:
+            sent = self.sock.send(frame)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as exc:
+            self._connection_lost(exc)
+            return
+
+        if sent < len(frame):
+            self._write_buffer += frame[sent:]
+            self._start_writing()
+
+    def _start_writing(self):
+        if not self._writing:
+            self._writing = True
+            self.loop.add_writer(self.sock.fileno(), self._write_ready)
+
+    def _write_ready(self):
+        try:
+            sent = self.sock.send(self._write_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._connection_lost(exc)
+            return
+
+        del self._write_buffer[:sent]
+        if not self._write_buffer:
+            self._writing = False
+            self.loop.remove_writer(self.sock.fileno())
+
+    def _read_ready(self):
+        try:
+            data = self.sock.recv(READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            self._connection_lost(exc)
+            return
+
+        if not data:
+            self._connection_lost(None)
+            return
+
+        buffer = self._read_buffer
+        buffer += data
+
+        # Hand over every complete frame we've got
+        header_size = FRAME_HEADER.size
+        offset = 0
+        while len(buffer) - offset >= header_size:
+            length, = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + header_size + length
+            if len(buffer) < end:
+                break
+            frame = bytes(buffer[offset + header_size:end])
+            offset = end
+            self.on_frame(frame)
+            if self.closed:
+                return
+        del buffer[:offset]
+
+    def _connection_lost(self, exc):
+        if exc is not None and exc.errno not in (
+                errno.EPIPE, errno.ECONNRESET):
+            _log.warning('Channel failed: {0!r}'.format(exc))
+        self.close()
+        if self.on_close is not None:
+            self.on_close()
+
+    def close(self, flush=False):
+        """
+        Close our end of the channel.  If FLUSH is set, first block
+        until anything still buffered has been written out (eg because
+        the loop's about to stop, and can't do it for us).
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        if self._writing:
+            self.loop.remove_writer(self.sock.fileno())
+            self._writing = False
+
+        if flush and self._write_buffer:
+            try:
+                self.sock.setblocking(True)
+                self.sock.sendall(self._write_buffer)
+            except OSError:
+                pass
+            del self._write_buffer[:]
+
+        self.sock.close()
+
+
+class Batcher(object):
+    """
+    Collects items to go down a Channel, and sends them as a batch in
+    a single frame, rather than paying for a frame (and a send()) per
+    item.
+
+    A batch goes out once it has MAX_ITEMS items in it, or MAX_DELAY
+    seconds after its first item was added, whichever's sooner.  With
+    MAX_DELAY of 0 (the default) that's at the end of the current
+    turn of the event loop, so everything sent in one go gets
+    batched up without anything being held back for long; a small
+    positive MAX_DELAY holds on a little longer for bigger batches,
+    at the cost of latency, much like Nagle's algorithm.
+
+    ENCODE turns a list of items into the bytes of a frame.
+    """
+    def __init__(self, channel, encode, max_items=1000, max_delay=0):
+        self.channel = channel
+        self.encode = encode
+        self.max_items = max_items
+        self.max_delay = max_delay
+
+        self._items = []
+        self._flush_handle = None
+
+        # How many batches and items we've sent
+        self.batches_sent = 0
+        self.items_sent = 0
+
+    def add(self, item):
+        self._items.append(item)
+
+        if len(self._items) >= self.max_items:
+            self.flush()
+        elif self._flush_handle is None:
+            if self.max_delay:
+                self._flush_handle = self.channel.loop.call_later(
+                    self.max_delay, self.flush)
+            else:
+                self._flush_handle = self.channel.loop.call_soon(self.flush)
+
+    def flush(self):
+        """
+        Send whatever we've got right now.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._items:
+            return
+
+        items, self._items = self._items, []
+        self.batches_sent += 1
+        self.items_sent += len(items)
+        self.channel.send(self.encode(items))
@@ -1,150 +1,789 @@
 import logging
-import select
-import traceback
+import os
+from collections import deque
 
-from tornado import httputil, httpserver, escape
+from tornado import httputil
 
-from xudd.actor import Actor, super_init
+from xudd.actor import Actor
 
 _log = logging.getLogger(__name__)
 
+MAX_REQUEST_SIZE = 10 * 1024 * 1024  # 10M
+MAX_HEADER_SIZE = 64 * 1024
+
+CRLF = b'\r\n'
+HEADER_END = b'\r\n\r\n'
+CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+INTERNAL_SERVER_ERROR = (
+    b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n')
+
+
+class HTTPParseError(Exception):
+    """
+    The client sent us something we can't make sense of.  STATUS is
+    what we should tell it about that.
+    """
+    def __init__(self, message, status='400 Bad Request'):
+        super(HTTPParseError, self).__init__(message)
+        self.status = status
+
+
+class BodyChunk(object):
+    """
+    A piece of a streamed request's body, as handed back by
+    HTTPRequestParser.feed().  FINAL is set on the last one.
+    """
+    __slots__ = ('data', 'final')
+
+    def __init__(self, data, final):
+        self.data = data
+        self.final = final
+
+
+class HTTPRequestParser(object):
+    """
+    Resumable HTTP/1.x request parser.
+
+    Feed it data as it comes off the connection, in whatever sized
+    bits it comes in, and it'll hand back every request that's been
+    completed so far:
+
+        parser = HTTPRequestParser()
+        for request in parser.feed(data):
+            ...
+
+    Requests are dicts with `method`, `uri`, `version`, `headers` (a
+    tornado HTTPHeaders), `body` (bytes) and `keep_alive`.  Anything
+    after the last complete request is kept for the next feed(), so
+    pipelined requests and requests split across reads both just work.
+
+    If STREAM_BODIES_OVER is set, requests with a bigger body than that
+    are handed back as soon as their headers are in, with `streaming`
+    set and `body` None, followed by BodyChunks of the body as it
+    arrives (which aren't held to MAX_BODY_SIZE).
+    """
+    def __init__(self, max_body_size=MAX_REQUEST_SIZE,
+                 max_header_size=MAX_HEADER_SIZE,
+                 stream_bodies_over=None):
+        self.max_body_size = max_body_size
+        self.max_header_size = max_header_size
+        self.stream_bodies_over = stream_bodies_over
+
+        self.buffer = bytearray()
+        # The request whose headers we've parsed but whose body
+        # hasn't all arrived yet
+        self.request = None
+        # How much of its body we're still waiting on
+        self.content_length = 0
+        # Whether that body's being streamed rather than buffered
+        self.streaming = False
+        # Set when a request wants a "100 Continue" before it sends its
+        # body (and is HTTP/1.1, since HTTP/1.0 clients don't know what
+        # one is); whoever sends that should clear it
+        self.needs_continue = False
+        # Where to pick up looking for the end of the headers, so
+        # dribbled-in headers don't get rescanned from the top
+        self._scan_from = 0
+
+    def feed(self, data):
+        """
+        Add DATA to what we've got, and return a list of any requests
+        (and BodyChunks) that are now complete.
+
+        Raises HTTPParseError if the client's sending nonsense, after
+        which this parser shouldn't be used any more.
+        """
+        requests = []
+
+        if self.streaming and data and not self.buffer:
+            # Pass body data straight through rather than copying it
+            # into our buffer and back out again
+            size = min(len(data), self.content_length)
+            if size == len(data):
+                self._add_body_chunk(requests, data)
+                return requests
+            data = memoryview(data)
+            self._add_body_chunk(requests, bytes(data[:size]))
+            data = data[size:]
+
+        self.buffer += data
+
+        while True:
+            if self.request is None:
+                if not self._parse_headers():
+                    break
+                if self.streaming:
+                    requests.append(self.request)
+
+            if self.streaming:
+                if not self.buffer:
+                    break
+                size = min(len(self.buffer), self.content_length)
+                chunk = bytes(self.buffer[:size])
+                del self.buffer[:size]
+                self._add_body_chunk(requests, chunk)
+                continue
+
+            if len(self.buffer) < self.content_length:
+                break
+
+            request = self.request
+            request['body'] = bytes(self.buffer[:self.content_length])
+            del self.buffer[:self.content_length]
+            self.request = None
+            self.content_length = 0
+            self.needs_continue = False
+            requests.append(request)
+
+        return requests
+
+    def _add_body_chunk(self, requests, chunk):
+        self.content_length -= len(chunk)
+        final = self.content_length == 0
+        requests.append(BodyChunk(chunk, final))
+        self.needs_continue = False
+        if final:
+            self.request = None
+            self.streaming = False
+
+    def _parse_headers(self):
+        if self.buffer[:2] == CRLF:
+            # Be forgiving of blank lines between pipelined requests
+            self.buffer = self.buffer.lstrip(CRLF)
+            self._scan_from = 0
+
+        end = self.buffer.find(HEADER_END, self._scan_from)
+        if end == -1:
+            if len(self.buffer) > self.max_header_size:
+                raise HTTPParseError(
+                    'Request headers too long',
+                    '431 Request Header Fields Too Large')
+            # The end marker might be split across feeds
+            self._scan_from = max(0, len(self.buffer) - 3)
+            return False
+
+        head = self.buffer[:end].decode('latin-1')
+        del self.buffer[:end + len(HEADER_END)]
+        self._scan_from = 0
+
+        request_line, _, header_lines = head.partition('\r\n')
+        try:
+            method, uri, version = request_line.split(' ')
+        except ValueError:
+            raise HTTPParseError(
+                'Malformed request line: {0!r}'.format(request_line))
+
+        if not version.startswith('HTTP/1.'):
+            raise HTTPParseError(
+                'Unsupported HTTP version: {0!r}'.format(version),
+                '505 HTTP Version Not Supported')
+
+        headers = httputil.HTTPHeaders.parse(header_lines)
+
+        if 'Transfer-Encoding' in headers:
+            raise HTTPParseError(
+                'Transfer-Encoding {0!r} not supported'.format(
+                    headers['Transfer-Encoding']),
+                '501 Not Implemented')
+
+        content_length = headers.get('Content-Length')
+        if content_length:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                raise HTTPParseError(
+                    'Bad Content-Length: {0!r}'.format(content_length))
+            if content_length < 0:
+                raise HTTPParseError(
+                    'Bad Content-Length: {0!r}'.format(content_length))
+            streaming = self.stream_bodies_over is not None \
+                and content_length > self.stream_bodies_over
+            if content_length > self.max_body_size and not streaming:
+                raise HTTPParseError(
+                    'Content-Length too long',
+                    '413 Request Entity Too Large')
+        else:
+            content_length = 0
+            streaming = False
+
+        connection = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+
+        self.request = dict(
+            method=method,
+            uri=uri,
+            version=version,
+            headers=headers,
+            keep_alive=keep_alive,
+            content_length=content_length or None,
+            streaming=streaming,
+            body=None)
+        self.content_length = content_length
+        self.streaming = streaming
+        self.needs_continue = content_length > 0 \
+            and version != 'HTTP/1.0' \
+            and headers.get('Expect', '').lower() == '100-continue'
+        return True
+
+
+class HTTPConnection(object):
+    """
+    What the HTTP actor knows about one client connection.
+    """
+    __slots__ = ('id', 'server', 'parser', 'peername', 'sockname',
+                 'responses', 'closing', 'streaming_request',
+                 'chunks_in_flight', 'reading_paused')
+
+    def __init__(self, id, server, peername, sockname, parser):
+        self.id = id
+        self.server = server
+        self.peername = peername
+        self.sockname = sockname
+        self.parser = parser
+        # PendingResponses for every request in flight, in the order
+        # they came in, since that's the order they have to go out in
+        self.responses = deque()
+        # Set once we've decided this connection isn't getting any more
+        # requests out of us
+        self.closing = False
+
+        # Message id of the request whose body we're streaming, and how
+        # many of its chunks the request handler has yet to get through
+        self.streaming_request = None
+        self.chunks_in_flight = 0
+        self.reading_paused = False
+
+
+class PendingResponse(object):
+    """
+    A response to a request on an HTTPConnection, or as much of it as
+    we've been given so far.
+    """
+    __slots__ = ('request_id', 'version', 'keep_alive', 'method', 'chunked',
+                 'bodiless', 'parts', 'done', 'sending_file')
+
+    def __init__(self, request_id, version, keep_alive, method=None):
+        self.request_id = request_id
+        self.version = version
+        self.keep_alive = keep_alive
+        self.method = method
+        # Whether the body's going out with Transfer-Encoding: chunked
+        self.chunked = False
+        # Set if this response mustn't have a body at all (for HEAD
+        # requests, and 1xx, 204 and 304 responses), whatever the
+        # request handler gives us
+        self.bodiless = False
+        # (bytes or file wrapper, message to reply to once it's
+        # written) for everything that's ready to go out
+        self.parts = deque()
+        # Whether we've got the whole response
+        self.done = False
+        # Set while the server's busy sending a file for us
+        self.sending_file = False
+
 
 class HTTP(Actor):
     '''
-    Parses HTTP from socket data
+    Speaks HTTP/1.1 to the connections of a tcp.ConnectionServer.
+
+    Set this up as the ConnectionServer's handler.  Every request that
+    comes in is sent on to REQUEST_HANDLER as a 'handle_request'
+    message with `body`, `options`, `arguments` and `files`, and it
+    should reply with a 'respond' directive, whose body has either
+
+    - `status` (eg '200 OK'), `headers` (a list of (name, value)) and
+      `body` (bytes), and `more` if the rest of the body is still to
+      come in 'respond_chunk' messages.  It can also have a `file`
+      (with a fileno(), and optionally `offset` and `count`) to be
+      sent after `body` with sendfile() and then close()d, or
+    - the raw `response`, headers and all.
+
+    'respond_chunk' messages go to us, with `request` (the id of the
+    'handle_request' message), `body` and `more` (unset on the last
+    one), or `abort` if the response can't be finished after all.
+    Ask for a reply to a chunk to wait until it's been sent and the
+    connection isn't backed up, so as not to get ahead of the client.
+    A streamed response without a Content-Length is sent with
+    Transfer-Encoding: chunked (or for HTTP/1.0 clients, by closing
+    the connection when it's done).
+
+    Connections are kept alive between requests unless the client (or
+    the response) says otherwise, and pipelined requests are handed to
+    the request handler as soon as they arrive, with their responses
+    sent back in order.  Responses to HEAD requests, and 1xx, 204 and
+    304 responses, are sent without a body, whatever the request
+    handler gives us.
+
+    Request bodies bigger than STREAM_BODIES_OVER (if set) aren't
+    buffered up.  Instead the 'handle_request' message arrives as soon
+    as the headers do, with `streaming` set and `body` None, and is
+    followed by 'handle_request_chunk' messages with `request` (the id
+    of the 'handle_request' message), `chunk` and `final`; the request
+    handler should defer_reply() to the 'handle_request' message until
+    it's ready to respond (or be an "async def" handler).  We stop
+    reading from the client while MAX_CHUNKS_IN_FLIGHT of those are
+    waiting on the request handler, so a slow handler means a slow
+    upload rather than a pile of chunks in memory.
     '''
-    def __init__(self, hive, id, request_handler):
+    def __init__(self, hive, id, request_handler,
+                 max_body_size=MAX_REQUEST_SIZE,
+                 stream_bodies_over=None,
+                 max_chunks_in_flight=4):
         super(HTTP, self).__init__(hive, id)
         self.message_routing.update({
-            'handle_request': self.handle_request,
-            'handle_request_body': self.handle_request_body
+            'connection_made': self.connection_made,
+            'data_received': self.data_received,
+            'connection_lost': self.connection_lost,
+            'respond': self.respond,
+            'respond_chunk': self.respond_chunk,
+            'get_stats': self.get_stats,
+            # What we get if the request handler didn't reply itself,
+            # or has finished with a body chunk, or the server's done
+            # with something we asked of it
+            'reply': self.handle_reply,
+            # ... or if its "async def" handler failed
+            'error.handler_failed': self.handle_reply,
         })
 
         self.request_handler = request_handler
-
-    def handle_request(self, message):
-        '''
-        Handles a socket request
-
-        Expects:
-            body: {
-                'request': <the return value of socket.accept()>
-            }
-
-        Much of the code for parsing HTTP is inspired by the tornado framweork
-        <http://tornadoweb.org>.
-        '''
-        sock, bind = message.body['request']
-
-        while True:
-            r, w, e = select.select([sock], [], [], .0001)
-
-            if not r:
-                yield self.wait_on_self()
-            else:
-                first_data = sock.recv(8192)
-
-                _log.debug('first_data: {0}'.format(first_data))
-
-                # XXX: Sometimes first_data is zero-length when running
-                # `ab -n 10000 -c 500 URI` against the server, this block
-                # catches those cases, but I'm still not sure why they occur.
-                try:
-                    request_line, rest = first_data.split('\r\n', 1)
-
-                    method, uri, version = request_line.split(' ')
-
-                    http_headers, rest = rest.split('\r\n\r\n', 1)
-
-                    headers = httputil.HTTPHeaders.parse(http_headers)
-
-                    _log.info('headers: {0}'.format(headers))
-
-                    remote_ip = sock.getpeername()[0]
-
-                    content_length = headers.get('Content-Length')
-
-                    if content_length:
-                        content_length = int(content_length)
-
-                        if content_length > MAX_REQUEST_SIZE:
-                            raise Exception('Content-Length too long')
-
-                        if headers.get('Expect') == '100-continue':
-                            sock.sendall('HTTP/1.1 100 (Continue)\r\n\r\n')
-
-                            additional_data = b''
-
-                            while True:
-                                r, w, e = select.select([sock], [], [], .0001)
-
-                                if not r:
-                                    yield self.wait_on_self()
-
-                                additional_data += sock.recv(content_length)
-
-                                if len(additional_data) == content_length:
-                                    break
-
-                            _log.debug('additional_data: {0}'.format(
-                                additional_data))
-
-                            rest += additional_data
-
-                    body = rest
-                    _log.debug('body: {0}'.format(body))
-
-                    option_names = ('method', 'uri', 'version', 'headers',
-                                    'remote_ip', 'content_length')
-                    options = dict(
-                        method=method,
-                        uri=uri,
-                        version=version,
-                        headers=headers,
-                        remote_ip=remote_ip,
-                        content_length=content_length,
-                        server_name=bind[0],
-                        port=bind[1])
-
-                    _log.debug('options: {0}'.format(options))
-
-                    _log.info('{method} {uri} ({content_length})'.format(
-                        **options))
-                except Exception as exc:
-                    _log.error('Failed to parse request: {0}\n---\n{0}'.format(
-                        traceback.format_exc(),
-                        first_data
-                    ))
-
-                    message.reply(
-                        directive='respond',
-                        body={
-                            'response': 'HTTP/1.1 400 Invalid Request\r\n'
-                                'Connection: close'
-                        })
-                    break  # Don't try to parse the request any further as
-                           # we've already replied with a 400
-
-                arguments, files = self.handle_request_body(method, headers, body)
-
-                response = yield self.wait_on_message(
-                    to=self.request_handler,
-                    directive='handle_request',
-                    body={
-                        'body': body,
-                        'options': options,
-                        'arguments': arguments,
-                        'files': files
-                    })
-
-                message.reply(
-                    directive='respond',
-                    body={
-                        'response': response.body.get('response')
-                    })
-
+        self.max_body_size = max_body_size
+        self.stream_bodies_over = stream_bodies_over
+        self.max_chunks_in_flight = max_chunks_in_flight
+
+        self.connections = {}
+        # Request message id -> connection it came in on
+        self.requests = {}
+        # Body chunk message id -> connection it came in on
+        self.chunks = {}
+        # Request message id -> (connection, PendingResponse) for
+        # responses that are still streaming in
+        self.streams = {}
+        # Write message id -> respond_chunk message waiting on it
+        self.writes = {}
+        # Sendfile message id -> (connection, PendingResponse, file)
+        self.sendfiles = {}
+
+        # How many requests we've passed on to the request handler
+        self.requests_handled = 0
+
+    def connection_made(self, message):
+        connection_id = message.body['connection']
+        self.connections[connection_id] = HTTPConnection(
+            connection_id, message.from_id,
+            message.body.get('peername'), message.body.get('sockname'),
+            HTTPRequestParser(
+                max_body_size=self.max_body_size,
+                stream_bodies_over=self.stream_bodies_over))
+
+    def connection_lost(self, message):
+        connection = self.connections.pop(message.body['connection'], None)
+        if connection is None:
+            return
+
+        # Nobody to send these to any more
+        for pending in connection.responses:
+            self.requests.pop(pending.request_id, None)
+            self.streams.pop(pending.request_id, None)
+            for part, waiting in pending.parts:
+                if waiting is not None:
+                    waiting.reply({'closed': True})
+                elif not isinstance(part, bytes):
+                    part[0].close()
+
+    def data_received(self, message):
+        connection = self.connections.get(message.body['connection'])
+        if connection is None or \
+           (connection.closing and not connection.parser.streaming):
+            return
+
+        parser = connection.parser
+        try:
+            requests = parser.feed(message.body['data'])
+        except HTTPParseError as exc:
+            _log.info('Failed to parse request: {0}'.format(exc))
+            self._reject(connection, exc.status)
+            return
+
+        for request in requests:
+            if isinstance(request, BodyChunk):
+                self._handle_body_chunk(connection, request)
+            elif not connection.closing:
+                # (Anything after a "Connection: close" is ignored)
+                self._handle_request(connection, request)
+
+        if parser.needs_continue:
+            parser.needs_continue = False
+            self._send_continue(connection)
+
+    def _send_continue(self, connection):
+        # This has to wait its turn behind the responses to any earlier
+        # requests, just like a real response
+        interim = PendingResponse(None, 'HTTP/1.1', True)
+        interim.parts.append((CONTINUE, None))
+        interim.done = True
+        if connection.parser.streaming:
+            # The request's already been handed on, and its response
+            # has to come after this one
+            connection.responses.insert(
+                len(connection.responses) - 1, interim)
+        else:
+            connection.responses.append(interim)
+        self._flush_responses(connection)
+
+    def _handle_request(self, connection, request):
+        method = request['method']
+        headers = request['headers']
+        body = request['body']
+
+        options = dict(
+            method=method,
+            uri=request['uri'],
+            version=request['version'],
+            headers=headers,
+            remote_ip=connection.peername and connection.peername[0],
+            content_length=request['content_length'],
+            server_name=connection.sockname and connection.sockname[0],
+            port=connection.sockname and connection.sockname[1])
+
+        _log.info('{method} {uri} ({content_length})'.format(**options))
+        self.requests_handled += 1
+
+        if request['streaming']:
+            # Nothing to parse yet
+            arguments, files = {}, {}
+        else:
+            arguments, files = self.handle_request_body(
+                method, headers, body)
+
+        request_id = self.send_message(
+            to=self.request_handler,
+            directive='handle_request',
+            body={
+                'body': body,
+                'options': options,
+                'arguments': arguments,
+                'files': files,
+                'streaming': request['streaming']
+            },
+            wants_reply=True)
+
+        if request['streaming']:
+            connection.streaming_request = request_id
+
+        self.requests[request_id] = connection
+        connection.responses.append(PendingResponse(
+            request_id, request['version'], request['keep_alive'],
+            method))
+        if not request['keep_alive']:
+            connection.closing = True
+
+    def _handle_body_chunk(self, connection, chunk):
+        chunk_id = self.send_message(
+            to=self.request_handler,
+            directive='handle_request_chunk',
+            body={
+                'request': connection.streaming_request,
+                'chunk': chunk.data,
+                'final': chunk.final
+            },
+            wants_reply=True)
+
+        self.chunks[chunk_id] = connection
+        connection.chunks_in_flight += 1
+        if chunk.final:
+            connection.streaming_request = None
+
+        if connection.chunks_in_flight >= self.max_chunks_in_flight \
+           and not connection.reading_paused:
+            connection.reading_paused = True
+            self._set_reading(connection, 'pause_reading')
+
+    def stats(self):
+        """
+        How many `connections` are open, how many `requests` we've
+        handled, and how many of them are `in_flight`.
+        """
+        return {
+            'connections': len(self.connections),
+            'requests': self.requests_handled,
+            'in_flight': len(self.requests) + len(self.streams)}
+
+    def get_stats(self, message):
+        message.reply(self.stats())
+
+    def handle_reply(self, message):
+        in_reply_to = message.in_reply_to
+
+        if in_reply_to in self.writes:
+            # A chunk of a response is on its way
+            self.writes.pop(in_reply_to).reply(message.body)
+
+        elif in_reply_to in self.sendfiles:
+            connection, pending, fileobj = self.sendfiles.pop(in_reply_to)
+            fileobj.close()
+            pending.sending_file = False
+            if connection.id in self.connections:
+                self._flush_responses(connection)
+
+        elif in_reply_to in self.chunks:
+            connection = self.chunks.pop(in_reply_to)
+            connection.chunks_in_flight -= 1
+            if connection.reading_paused \
+               and connection.chunks_in_flight < self.max_chunks_in_flight:
+                connection.reading_paused = False
+                self._set_reading(connection, 'resume_reading')
+
+        else:
+            # Must be a request the request handler didn't respond to
+            self.respond(message)
+
+    def respond(self, message):
+        connection = self.requests.pop(message.in_reply_to, None)
+        if connection is None:
+            # Connection's gone away in the meantime
+            return
+
+        for pending in connection.responses:
+            if pending.request_id == message.in_reply_to:
                 break
 
+        # (Bare autoreplies have no body at all)
+        body = message.body or {}
+        if 'status' in body:
+            self._start_response(connection, pending, body)
+        else:
+            response, pending.keep_alive = self._prepare_response(
+                body.get('response', INTERNAL_SERVER_ERROR),
+                pending.keep_alive, pending.method == 'HEAD')
+            pending.parts.append((response, None))
+            pending.done = True
+
+        self._flush_responses(connection)
+
+    def _start_response(self, connection, pending, body):
+        headers = list(body.get('headers', ()))
+        names = set(name.lower() for name, value in headers)
+        data = body.get('body', b'')
+        fileobj = body.get('file')
+        more = body.get('more', False)
+
+        if fileobj is not None:
+            offset = body.get('offset', 0)
+            count = body.get('count')
+            if count is None:
+                count = os.fstat(fileobj.fileno()).st_size - offset
+
+        code = int(body['status'].split(None, 1)[0])
+        if pending.method == 'HEAD' or code < 200 or code in (204, 304):
+            pending.bodiless = True
+
+        if pending.bodiless and (pending.method != 'HEAD'
+                                 or 'content-length' in names or more):
+            # (A HEAD response can still say how long the GET one
+            # would be, if we know)
+            pass
+        elif 'content-length' in names:
+            pass
+        elif fileobj is not None:
+            headers.append(('Content-Length', str(len(data) + count)))
+        elif not more:
+            headers.append(('Content-Length', str(len(data))))
+        elif pending.version == 'HTTP/1.1':
+            headers.append(('Transfer-Encoding', 'chunked'))
+            pending.chunked = True
+        else:
+            # Nothing else for it but to hang up when we're done
+            pending.keep_alive = False
+
+        if 'connection' in names:
+            for name, value in headers:
+                if name.lower() == 'connection' and value.lower() == 'close':
+                    pending.keep_alive = False
+        else:
+            headers.append((
+                'Connection',
+                'keep-alive' if pending.keep_alive else 'close'))
+
+        head = 'HTTP/1.1 {0}\r\n{1}\r\n\r\n'.format(
+            body['status'],
+            '\r\n'.join('{0}: {1}'.format(name, value)
+                         for name, value in headers)).encode('latin-1')
+        if pending.bodiless:
+            pending.parts.append((head, None))
+            if fileobj is not None:
+                fileobj.close()
+        else:
+            pending.parts.append((head + self._frame(pending, data), None))
+            if fileobj is not None:
+                pending.parts.append(((fileobj, offset, count), None))
+
+        if more:
+            self.streams[pending.request_id] = (connection, pending)
+        else:
+            pending.done = True
+
+    def respond_chunk(self, message):
+        stream = self.streams.get(message.body['request'])
+        if stream is None:
+            # Connection's gone away in the meantime
+            if message.wants_reply:
+                message.reply({'closed': True})
+            return
+
+        connection, pending = stream
+        if message.body.get('abort'):
+            # The response can't be finished, so the client mustn't
+            # think it has been
+            del self.streams[pending.request_id]
+            connection.closing = True
+            self.send_message(
+                to=connection.server,
+                directive='close',
+                body={'connection': connection.id, 'abort': True})
+            return
+
+        if pending.bodiless:
+            data = b''
+        else:
+            data = self._frame(pending, message.body.get('body', b''))
+        more = message.body.get('more', False)
+        if not more:
+            if pending.chunked:
+                data += b'0\r\n\r\n'
+            del self.streams[pending.request_id]
+            pending.done = True
+
+        if message.wants_reply:
+            message.defer_reply()
+            pending.parts.append((data, message))
+        else:
+            pending.parts.append((data, None))
+
+        self._flush_responses(connection)
+
+    def _frame(self, pending, data):
+        if pending.chunked and data:
+            return b'%x\r\n%s\r\n' % (len(data), data)
+        return data
+
+    def _flush_responses(self, connection):
+        """
+        Send off every bit of response that's ready and isn't stuck
+        behind one that isn't.
+        """
+        responses = connection.responses
+        while responses:
+            pending = responses[0]
+            parts = pending.parts
+
+            while parts and not pending.sending_file:
+                part, waiting = parts.popleft()
+                if isinstance(part, bytes):
+                    self._write(connection, part, waiting)
+                else:
+                    self._sendfile(connection, pending, part)
+
+            if not pending.done or parts or pending.sending_file:
+                return
+
+            responses.popleft()
+            if not pending.keep_alive:
+                self._close(connection)
+                return
+
+    def _prepare_response(self, response, keep_alive, bodiless=False):
+        """
+        Make sure the client knows whether we're keeping the connection
+        open, and that we only do so if the response has a length for
+        the client to go by.  If BODILESS is set (for HEAD requests),
+        anything after the headers is dropped.
+        """
+        if not isinstance(response, bytes):
+            response = response.encode('latin-1')
+
+        head_end = response.find(HEADER_END)
+        head = response[:head_end].lower() if head_end != -1 else b''
+        if bodiless and head_end != -1:
+            response = response[:head_end + len(HEADER_END)]
+
+        if keep_alive and b'\r\ncontent-length:' not in head \
+           and b'\r\ntransfer-encoding:' not in head:
+            # No way for the client to tell where this response ends
+            # other than us hanging up
+            keep_alive = False
+
+        if b'\r\nconnection:' not in head:
+            status_end = response.find(CRLF)
+            response = b''.join([
+                response[:status_end],
+                b'\r\nConnection: keep-alive' if keep_alive
+                else b'\r\nConnection: close',
+                response[status_end:]])
+        elif b'\r\nconnection: close' in head:
+            keep_alive = False
+
+        return response, keep_alive
+
+    def _reject(self, connection, status):
+        # Requests already in flight still get their responses, but
+        # nothing else does
+        connection.closing = True
+        pending = PendingResponse(None, 'HTTP/1.1', False)
+        pending.parts.append((
+            'HTTP/1.1 {0}\r\nContent-Length: 0\r\nConnection: close'
+            '\r\n\r\n'.format(status).encode('latin-1'), None))
+        pending.done = True
+        connection.responses.append(pending)
+        self._flush_responses(connection)
+
+    def _sendfile(self, connection, pending, part):
+        fileobj, offset, count = part
+        pending.sending_file = True
+        sendfile_id = self.send_message(
+            to=connection.server,
+            directive='sendfile',
+            body={
+                'connection': connection.id,
+                'file': fileobj,
+                'offset': offset,
+                'count': count},
+            wants_reply=True)
+        self.sendfiles[sendfile_id] = (connection, pending, fileobj)
+
+    def _write(self, connection, data, waiting=None):
+        if waiting is None:
+            self.send_message(
+                to=connection.server,
+                directive='write',
+                body={'connection': connection.id, 'data': data})
+        else:
+            # Let whoever's waiting know once the server's happy with
+            # how much it's got buffered
+            write_id = self.send_message(
+                to=connection.server,
+                directive='write',
+                body={'connection': connection.id, 'data': data},
+                wants_reply=True)
+            self.writes[write_id] = waiting
+
+    def _set_reading(self, connection, directive):
+        if connection.id in self.connections:
+            self.send_message(
+                to=connection.server,
+                directive=directive,
+                body={'connection': connection.id})
+
+    def _close(self, connection):
+        connection.closing = True
+        self.send_message(
+            to=connection.server,
+            directive='close',
+            body={'connection': connection.id})
+
     def handle_request_body(self, method, headers, body):
 
         files = {}
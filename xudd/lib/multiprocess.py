@@ -1,105 +1,193 @@
-from multiprocessing import Process, Queue
+import asyncio
+from multiprocessing import Process
 
 from xudd.hive import Hive
 from xudd.actor import Actor
 from xudd.tools import base64_uuid4, join_id
+from xudd.lib.channel import Channel, Batcher, channel_pair
+from xudd.lib.shm import (
+    RingBuffer, SharedMemoryChannel, shared_memory_channel_pair)
 
 import json
+import logging
+import socket
 
+_log = logging.getLogger(__name__)
 
-def spawn_multiprocess_hive(hive_id, to_hive_queue, from_hive_queue):
-    hive = MultiProcessHive(hive_id, to_hive_queue, from_hive_queue)
-    hive.run()
+# Forwarded messages go out in batches of up to this many, or as soon
+# as this many seconds have passed since the first of them (see
+# xudd.lib.channel.Batcher)
+MAX_BATCH_SIZE = 1000
+MAX_BATCH_DELAY = 0
+
+# How often to check whether a child hive that's gone away has exited
+REAP_INTERVAL = .05
+
+
+def spawn_multiprocess_hive(hive_id, endpoint):
+    # We may well have been forked from a running hive, whose event
+    # loop (and its epoll fd) is no use to us
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    hive = MultiProcessHive(hive_id, endpoint, loop=loop)
+    try:
+        hive.run()
+    finally:
+        loop.close()
 
 
 ## We should be doing these via multiple inheritance, but in the meanwhile...
 # class ForwarderActor(Actor):
     
 
+def _encode_batch(message_dicts):
+    try:
+        return json.dumps(message_dicts).encode("utf-8")
+    except (TypeError, ValueError):
+        pass
+
+    # Something in there can't be sent; encode them one at a time to
+    # find out which, so that the rest can still go
+    encoded = []
+    for message_dict in message_dicts:
+        try:
+            encoded.append(json.dumps(message_dict))
+        except (TypeError, ValueError) as exc:
+            _log.error(
+                "Can't send {0!r} directive to {1} ({2})".format(
+                    message_dict["directive"], message_dict["to"], exc))
+    return ("[" + ", ".join(encoded) + "]").encode("utf-8")
+
+
+def _make_channel(self, endpoint, loop, on_close=None):
+    """
+    Set up our channel to the other hive, and batching for it.
+
+    ENDPOINT is either a socket, or what one end of a
+    shared_memory_channel_pair() gave us.
+    """
+    if isinstance(endpoint, socket.socket):
+        self.channel = Channel(endpoint, loop, self._receive_frame, on_close)
+    elif isinstance(endpoint[1], RingBuffer):
+        self.channel = SharedMemoryChannel.create(
+            endpoint, loop, self._receive_frame, on_close)
+    else:
+        self.channel = SharedMemoryChannel.attach(
+            endpoint, loop, self._receive_frame, on_close)
+    self.batcher = Batcher(
+        self.channel, _encode_batch,
+        max_items=MAX_BATCH_SIZE, max_delay=MAX_BATCH_DELAY)
+
+
 def forward_message_method(self, message):
     """
     Forward message to the subprocess
     """
-    self.send_queue.put(json.dumps(message.body))
+    self.batcher.add(message.body)
+
 
+def _receive_frame(self, frame):
+    """
+    Deliver a batch of messages that's come in over the channel.
 
-def _flush_receive_queue(self):
-    queue_len = self.receive_queue.qsize()
-    for i in range(queue_len):
-        # do we need exception handling here?
-        encoded_message = self.receive_queue.get()
-        message_dict = json.loads(encoded_message)
+    The channel calls this straight from the event loop, as soon as
+    there's something to read; nobody has to keep checking for it.
+    """
+    localize_message_id = self.hive.localize_message_id
+    send_message = self.send_message
+    # (Over shared memory, FRAME is a memoryview onto the ring, which
+    # json can't take directly)
+    for message_dict in json.loads(bytes(frame)):
+        # Replies to our own messages need to find their way back to
+        # the (local, integer) message ids they're replying to
+        message_dict["id"] = localize_message_id(message_dict["id"])
+        message_dict["in_reply_to"] = localize_message_id(
+            message_dict["in_reply_to"])
         # TODO: less hokey version of this sending a message stuff
-        self.send_message(**message_dict)
+        send_message(**message_dict)
 
 
 class MultiProcessAmbassador(Actor):
     forward_message = forward_message_method
-    _flush_receive_queue = _flush_receive_queue
+    _receive_frame = _receive_frame
+    _make_channel = _make_channel
 
-    def __init__(self, hive, id):
+    def __init__(self, hive, id, shared_memory=False):
         super(MultiProcessAmbassador, self).__init__(hive, id)
+        # Whether to talk to the child through rings in shared memory,
+        # rather than over a socket
+        self.shared_memory = shared_memory
         self.message_routing.update(
             {"get_remote_hive_id": self.get_remote_hive_id,
              "setup": self.setup,
-             "forward_message": self.forward_message,
-             "check_message_loop": self.check_message_loop})
+             "forward_message": self.forward_message})
 
     def setup(self, message):
-        # Spawn the remote hive
+        # Spawn the remote hive, with the other end of our channel
         self.remote_hive_id = base64_uuid4()
-        self.send_queue = Queue()
-        self.receive_queue = Queue()
+        if self.shared_memory:
+            ours, theirs = shared_memory_channel_pair()
+            their_sock = theirs[0]
+        else:
+            ours, theirs = channel_pair()
+            their_sock = theirs
         self.multiproces_hive_proc = Process(
             target=spawn_multiprocess_hive,
-            args=(
-                self.remote_hive_id,
-                # The opposite of our send and receive queue!
-                self.send_queue,
-                self.receive_queue))
+            args=(self.remote_hive_id, theirs))
         self.multiproces_hive_proc.start()
+        their_sock.close()
 
-        # Declare ourselves the ambassador for this hive
-        self.send_message(
+        # Have the loop wake us up whenever the child has something
+        # for us
+        self._make_channel(
+            ours, self.hive.loop, on_close=self._channel_closed)
+        self.channel.start()
+
+        # Declare ourselves the ambassador for this hive (and make sure
+        # that's sunk in before sending anything its way)
+        yield self.wait_on_message(
             to=join_id("hive", self.hive.hive_id),
             directive="register_ambassador",
             body={
                 "hive_id": self.remote_hive_id})
 
-        # Set up the message-checking loop
-        self.send_message(
-            to=self.id,
-            directive="check_message_loop")
-
         # Tell the child hive to connect back to us
         yield self.wait_on_message(
             to=join_id("hive", self.remote_hive_id),
             directive="connect_back",
             body={"parent_hive_id": self.hive.hive_id})
 
+        if self.shared_memory:
+            # The child's attached to the rings by now, so nobody else
+            # needs to find them by name
+            self.channel.unlink()
+
     def get_remote_hive_id(self, message):
         message.reply({"hive_id": self.remote_hive_id})
 
-    def check_message_loop(self, message):
-        """
-        Begin looping to check to see if there are messages to send
-        back
-        """
-        self._flush_receive_queue()
-        self.send_message(
-            to=self.id,
-            directive="check_message_loop")
+    def _channel_closed(self):
+        _log.info("Child hive {0} has gone away".format(self.remote_hive_id))
+        # Don't leave it lying around as a zombie (but don't hold up
+        # the loop waiting for it to finish exiting, either)
+        self._reap_child()
+
+    def _reap_child(self):
+        # is_alive() reaps the child once it has exited
+        if self.multiproces_hive_proc.is_alive():
+            self.hive.loop.call_later(REAP_INTERVAL, self._reap_child)
 
 
 class MultiProcessHive(Hive):
     forward_message = forward_message_method
-    _flush_receive_queue = _flush_receive_queue
+    _receive_frame = _receive_frame
+    _make_channel = _make_channel
 
-    def __init__(self, hive_id, receive_queue, send_queue):
+    def __init__(self, hive_id, endpoint, loop=None):
         super(MultiProcessHive, self).__init__(
-            hive_id=hive_id)
-        self.receive_queue = receive_queue
-        self.send_queue = send_queue
+            hive_id=hive_id, loop=loop)
+        # If the parent goes away, there's nobody left to work for
+        self._make_channel(endpoint, self.loop, on_close=self.send_shutdown)
 
         self.message_routing.update(
             {"connect_back": self.connect_back,
@@ -108,19 +196,23 @@ class MultiProcessHive(Hive):
              "remote_shutdown_step2": self.remote_shutdown_step2})
 
     def run(self):
-        while not self.should_stop:
-            self._flush_receive_queue()
-            self._process_messages()
+        # Messages from the parent wake our loop up just like any other
+        # socket would
+        self.channel.start()
+        try:
+            super(MultiProcessHive, self).run()
+        finally:
+            # Make sure the last of our replies gets out
+            self.batcher.flush()
+            self.channel.close(flush=True)
 
     def connect_back(self, message):
         """
         Set up our ambassadorial connection to the parent process
         """
-        self.hive.send_message(
-            to=self.id,
-            directive="register_ambassador",
-            body={
-                "hive_id": message.body["parent_hive_id"]})
+        # (Straight away, rather than by messaging ourselves, since
+        # our reply to this has to find its way back through it)
+        self._ambassadors[message.body["parent_hive_id"]] = self.id
 
     ### Waiiiit, why have a 2-step shutdown process?
     # The reason is that the parent process needs to receive the
@@ -137,4 +229,4 @@ class MultiProcessHive(Hive):
             directive="remote_shutdown_step2")
 
     def remote_shutdown_step2(self, message):
-        self.should_stop = True
+        self.send_shutdown()
@@ -0,0 +1,378 @@
+"""
+Serve a WSGI app from several worker processes, each with its own hive.
+
+Every worker runs the usual ConnectionServer -> HTTP -> WSGI chain on
+the same port, so the kernel spreads connections across them and
+throughput can scale with the number of cores.  Either the workers
+all bind the port themselves with SO_REUSEPORT, or (the default) the
+parent binds it once and the workers inherit the listening socket.
+
+The parent runs a Supervisor actor in a hive of its own, which starts
+the workers, restarts any that die, and collects the stats they send
+back:
+
+    python -m xudd.lib.prefork mypackage.wsgi:application -w 4
+
+or from Python:
+
+    from xudd.lib.prefork import serve
+    serve(application, workers=4, port=8000)
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import time
+
+try:
+    from queue import Empty  # python 3
+except ImportError:
+    from Queue import Empty  # python 2
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.tools import import_component
+from xudd.lib.tcp import ConnectionServer
+from xudd.lib.http import HTTP
+from xudd.lib.wsgi import WSGI
+
+_log = logging.getLogger(__name__)
+
+# How often workers report their stats, and how often the supervisor
+# checks on the workers
+STATS_INTERVAL = 1.0
+CHECK_INTERVAL = .5
+
+# How long workers get to finish up once they've been told to stop
+# (before they're killed), and how often we check whether they have
+STOP_TIMEOUT = 5.0
+REAP_INTERVAL = .05
+
+
+def _get_context():
+    # Inheriting the listening socket relies on fork()
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return multiprocessing.get_context()
+
+
+def bind_socket(host, port, backlog=1024, reuse_port=False):
+    """
+    Make a listening socket for HOST and PORT.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class Worker(Actor):
+    """
+    Sets up the ConnectionServer -> HTTP -> WSGI chain in a worker
+    process, and reports back to the supervisor every so often.
+    """
+    def __init__(self, hive, id, number, app, stats_queue,
+                 threads=None, stats_interval=STATS_INTERVAL):
+        super(Worker, self).__init__(hive, id)
+        self.message_routing.update({
+            'start': self.start,
+            'report': self.report,
+        })
+        self.number = number
+        self.app = app
+        self.stats_queue = stats_queue
+        self.threads = threads
+        self.stats_interval = stats_interval
+
+        self.wsgi = None
+        self.http = None
+
+    async def start(self, message):
+        """
+        Start serving.  The body is passed on to ConnectionServer's
+        'listen'.
+        """
+        self.wsgi = self.hive.create_actor(
+            WSGI, app=self.app, threads=self.threads)
+        self.http = self.hive.create_actor(HTTP, request_handler=self.wsgi)
+        server = self.hive.create_actor(ConnectionServer, handler=self.http)
+
+        listening = await self.ask(server, 'listen', dict(message.body))
+        _log.info('Worker {0} (pid {1}) listening on port {2}'.format(
+            self.number, os.getpid(), listening.body['port']))
+
+        self.hive.send_every(
+            self.stats_interval, to=self.id, directive='report')
+
+    async def report(self, message):
+        http_stats, pool_stats = await self.ask_all([
+            dict(to=self.http, directive='get_stats'),
+            dict(to=self.wsgi, directive='get_pool_stats')])
+
+        stats = dict(http_stats.body)
+        stats['pool'] = dict(pool_stats.body)
+        self.stats_queue.put((self.number, os.getpid(), stats))
+
+
+def run_worker(number, app, listen_body, stats_queue, threads=None,
+               stats_interval=STATS_INTERVAL):
+    """
+    Body of a worker process.
+    """
+    if isinstance(app, str):
+        app = import_component(app)
+
+    # Don't go sharing the parent's event loop (and its epoll fd)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    hive = Hive(loop=loop)
+    worker = hive.create_actor(
+        Worker, number=number, app=app, stats_queue=stats_queue,
+        threads=threads, stats_interval=stats_interval)
+    hive.send_message(to=worker, directive='start', body=listen_body)
+    hive.run()
+
+
+class Supervisor(Actor):
+    """
+    Starts and looks after the worker processes.
+
+    Send it 'start' to get going, and 'get_stats' to find out how the
+    workers are doing: it replies with the totals across all of them,
+    plus each worker's own most recent report under `per_worker`.
+    """
+    def __init__(self, hive, id, app, workers=None, host='127.0.0.1',
+                 port=8000, reuse_port=False, threads=None, backlog=1024,
+                 stats_interval=STATS_INTERVAL,
+                 check_interval=CHECK_INTERVAL):
+        super(Supervisor, self).__init__(hive, id)
+        self.message_routing.update({
+            'start': self.start,
+            'check_workers': self.check_workers,
+            'get_stats': self.get_stats,
+            'stop': self.stop,
+        })
+        self.app = app
+        self.num_workers = workers or multiprocessing.cpu_count()
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.threads = threads
+        self.backlog = backlog
+        self.stats_interval = stats_interval
+        self.check_interval = check_interval
+
+        self.context = _get_context()
+        self.stats_queue = self.context.Queue()
+        self.sock = None
+        self.checker = None
+        self.stopping = False
+
+        # Worker number -> Process, and the last stats it sent us
+        self.workers = {}
+        self.worker_stats = {}
+        # How many times we've had to replace a worker
+        self.restarts = 0
+
+    def start(self, message):
+        if self.reuse_port:
+            listen_body = {
+                'host': self.host, 'port': self.port,
+                'backlog': self.backlog, 'reuse_port': True}
+        else:
+            self.sock = bind_socket(self.host, self.port, self.backlog)
+            # In case we were asked for any free port
+            self.port = self.sock.getsockname()[1]
+            listen_body = {'sock': self.sock, 'backlog': self.backlog}
+        self.listen_body = listen_body
+
+        for number in range(self.num_workers):
+            self._start_worker(number)
+
+        self.checker = self.hive.send_every(
+            self.check_interval, to=self.id, directive='check_workers')
+
+        if message.wants_reply:
+            message.reply({'port': self.port, 'workers': self.num_workers})
+
+    def _start_worker(self, number):
+        process = self.context.Process(
+            target=run_worker,
+            args=(number, self.app, self.listen_body, self.stats_queue),
+            kwargs={'threads': self.threads,
+                    'stats_interval': self.stats_interval},
+            name='xudd-worker-{0}'.format(number))
+        process.daemon = True
+        process.start()
+        self.workers[number] = process
+        _log.info('Started worker {0} (pid {1})'.format(number, process.pid))
+
+    def check_workers(self, message):
+        self._collect_stats()
+
+        if self.stopping:
+            return
+
+        for number, process in list(self.workers.items()):
+            if not process.is_alive():
+                _log.warning('Worker {0} (pid {1}) exited with {2}; '
+                             'restarting it'.format(
+                                 number, process.pid, process.exitcode))
+                self.worker_stats.pop(number, None)
+                self.restarts += 1
+                self._start_worker(number)
+
+    def _collect_stats(self):
+        while True:
+            try:
+                number, pid, stats = self.stats_queue.get_nowait()
+            except Empty:
+                break
+            stats['pid'] = pid
+            self.worker_stats[number] = stats
+
+    def stats(self):
+        """
+        Totals across all the workers' latest reports.
+        """
+        self._collect_stats()
+        totals = {
+            'workers': sum(1 for process in self.workers.values()
+                           if process.is_alive()),
+            'restarts': self.restarts,
+            'connections': 0,
+            'requests': 0,
+            'in_flight': 0,
+            'per_worker': dict(self.worker_stats)}
+
+        for stats in self.worker_stats.values():
+            for key in ('connections', 'requests', 'in_flight'):
+                totals[key] += stats[key]
+
+        return totals
+
+    def get_stats(self, message):
+        message.reply(self.stats())
+
+    async def stop(self, message):
+        self.stop_workers()
+        await self.reap_workers()
+        self.hive.send_shutdown()
+
+    def stop_workers(self):
+        """
+        Tell the workers to shut down (they'll each finish up when their
+        hive gets SIGTERM) and stop listening.  Doesn't wait for them;
+        see reap_workers() and join_workers() for that.
+        """
+        self.stopping = True
+        if self.checker is not None:
+            self.checker.cancel()
+
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    async def reap_workers(self, timeout=STOP_TIMEOUT):
+        """
+        Wait (without holding up the loop) for the workers to exit,
+        killing any still around after TIMEOUT seconds.
+        """
+        deadline = self.hive.loop.time() + timeout
+        # (is_alive() reaps them as they go)
+        while any(process.is_alive() for process in self.workers.values()):
+            if self.hive.loop.time() >= deadline:
+                self._kill_stragglers()
+                break
+            await asyncio.sleep(REAP_INTERVAL)
+
+    def join_workers(self, timeout=STOP_TIMEOUT):
+        """
+        Like reap_workers(), but blocks; for when the loop's not
+        running any more anyway.
+        """
+        deadline = time.monotonic() + timeout
+        for process in self.workers.values():
+            process.join(max(0, deadline - time.monotonic()))
+        self._kill_stragglers()
+
+    def _kill_stragglers(self):
+        for number, process in self.workers.items():
+            if process.is_alive():
+                _log.warning('Worker {0} (pid {1}) did not stop; '
+                             'killing it'.format(number, process.pid))
+                process.kill()
+                process.join(1)
+
+
+def serve(app, workers=None, host='127.0.0.1', port=8000,
+          reuse_port=False, threads=None):
+    """
+    Serve APP (a WSGI app, or a "module:component" string naming one)
+    from WORKERS processes (by default, one per core) until we get
+    SIGINT or SIGTERM.
+    """
+    hive = Hive()
+    supervisor_id = hive.create_actor(
+        Supervisor, app=app, workers=workers, host=host, port=port,
+        reuse_port=reuse_port, threads=threads)
+    hive.send_message(to=supervisor_id, directive='start')
+
+    try:
+        hive.run()
+    finally:
+        supervisor = hive._actor_registry[supervisor_id.local_id]
+        supervisor.stop_workers()
+        supervisor.join_workers()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a WSGI app from several worker hives")
+    parser.add_argument(
+        "app",
+        help="The WSGI app, as module:component")
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of worker processes (default: one per core)",
+        default=None, type=int)
+    parser.add_argument(
+        "--host",
+        help="Host to listen on",
+        default="127.0.0.1")
+    parser.add_argument(
+        "-p", "--port",
+        help="Port to listen on",
+        default=8000, type=int)
+    parser.add_argument(
+        "--reuse-port",
+        help="Have each worker bind the port with SO_REUSEPORT, rather "
+             "than sharing one listening socket",
+        action="store_true")
+    parser.add_argument(
+        "-t", "--threads",
+        help="Run the app in a pool of this many threads in each worker",
+        default=None, type=int)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(args.app, args.workers, args.host, args.port,
+          args.reuse_port, args.threads)
+
+
+if __name__ == "__main__":
+    main()
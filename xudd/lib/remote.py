@@ -0,0 +1,522 @@
+"""
+Ambassadors for hives that were started independently of each other,
+talking over TCP or a Unix domain socket (eg one hive per container).
+
+Unlike MultiProcessAmbassador, nobody spawns anybody here: one hive
+runs a RemoteHiveListener, and the other creates a RemoteAmbassador
+with its address and tells it to connect.  Once the two hives have
+told each other their hive ids, each side has a RemoteAmbassador
+registered (with register_ambassador) for the other, and messages to
+actors in the other hive get forwarded to it like any others.
+
+Frames on the wire are a 4-byte length prefix followed by msgpack:
+first a {"hive_id": ...} hello from each side, then batches (lists) of
+forwarded messages.  Message bodies have to be msgpack-able, then.
+
+If the connection goes down, the ambassador that dialed out keeps
+trying to reconnect (backing off as it goes), and both ambassadors
+hold onto whatever's sent in the meanwhile until it's back.  Anything
+that was already on its way when the connection went down may be
+lost, though; delivery is at most once.
+
+Remote hives can send any directive to any actor here, unless told
+otherwise; that includes asking the hive itself to create_actor() any
+class it can import.  So only let hives you trust connect (the
+listener binds to 127.0.0.1 unless told otherwise), or give the
+ambassadors ALLOWED_DIRECTIVES to limit what can come in.
+"""
+import asyncio
+import logging
+from collections import deque
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from xudd.actor import Actor
+from xudd.tools import join_id
+from xudd.lib.channel import FRAME_HEADER, Batcher
+
+_log = logging.getLogger(__name__)
+
+# Forwarded messages go out in batches of up to this many (see
+# xudd.lib.channel.Batcher)
+MAX_BATCH_SIZE = 1000
+MAX_BATCH_DELAY = 0
+
+# How much an ambassador will hold onto while it's disconnected, in
+# bytes of encoded batches
+DEFAULT_MAX_BUFFER = 16 * 1024 * 1024
+
+
+def _check_msgpack():
+    if msgpack is None:
+        raise ImportError(
+            "msgpack is needed to talk to remote hives, "
+            "but doesn't seem to be installed")
+
+
+def _pack(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _unpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+def _encode_batch(message_dicts):
+    try:
+        return _pack(message_dicts)
+    except (TypeError, ValueError):
+        pass
+
+    # Something in there can't be sent; pack them one at a time to
+    # find out which, so that the rest can still go
+    packer = msgpack.Packer(use_bin_type=True)
+    packed = []
+    for message_dict in message_dicts:
+        try:
+            packed.append(packer.pack(message_dict))
+        except (TypeError, ValueError) as exc:
+            _log.error(
+                "Can't send {0!r} directive to {1} ({2})".format(
+                    message_dict["directive"], message_dict["to"], exc))
+    return packer.pack_array_header(len(packed)) + b"".join(packed)
+
+
+class RemoteConnection(asyncio.Protocol):
+    """
+    One connection between two hives.
+
+    Says hello as soon as it's connected, then hands each frame that
+    comes in to its OWNER.  The first frame from the other side should
+    be its hello, which goes to owner._hello_received(); anything
+    after that is held until set_ready() (ie until the owner has got
+    everything set up to deliver it), then goes to
+    owner._frame_received().
+    """
+    def __init__(self, owner, hive_id):
+        self.owner = owner
+        self.hive_id = hive_id
+        self.transport = None
+        self.remote_hive_id = None
+        self.ready = False
+        self.closed = False
+
+        self._read_buffer = bytearray()
+        # Frames that came in before we were ready for them
+        self._backlog = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send(_pack({"hive_id": self.hive_id}))
+
+    def send(self, data):
+        self.transport.write(FRAME_HEADER.pack(len(data)) + data)
+
+    def data_received(self, data):
+        buffer = self._read_buffer
+        buffer += data
+
+        header_size = FRAME_HEADER.size
+        offset = 0
+        while len(buffer) - offset >= header_size:
+            length, = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + header_size + length
+            if len(buffer) < end:
+                break
+            frame = _unpack(buffer[offset + header_size:end])
+            offset = end
+            self._frame_received(frame)
+            if self.closed:
+                return
+        del buffer[:offset]
+
+    def _frame_received(self, frame):
+        if self.remote_hive_id is None:
+            try:
+                self.remote_hive_id = frame["hive_id"]
+            except (TypeError, KeyError):
+                _log.warning("Bad hello from {0}: {1!r}".format(
+                    self.transport.get_extra_info("peername"), frame))
+                self.close()
+                return
+            self.owner._hello_received(self)
+        elif self.ready:
+            self.owner._frame_received(self, frame)
+        else:
+            self._backlog.append(frame)
+
+    def set_ready(self):
+        self.ready = True
+        backlog, self._backlog = self._backlog, []
+        for frame in backlog:
+            self.owner._frame_received(self, frame)
+            if self.closed:
+                return
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.owner is not None:
+            self.owner._connection_lost(self, exc)
+
+
+class RemoteAmbassador(Actor):
+    """
+    The ambassador for a hive at the other end of a RemoteConnection.
+
+    Give it an ADDRESS to dial out to, either a (host, port) tuple for
+    TCP or a path for a Unix socket, and send it *connect*.  Those a
+    RemoteHiveListener creates for incoming connections don't have an
+    address; they wait for the other side to dial back in instead.
+
+    If REMOTE_HIVE_ID is known up front, we register for it straight
+    away on connect, so that messages can be sent its way (and be held
+    onto) before the connection's even up.
+
+    If ALLOWED_DIRECTIVES is given, messages from the other hive with
+    any other directive are dropped.  (Include "reply" if actors here
+    will be waiting on replies from over there.)
+
+    Directives:
+
+    - *connect*: connect to ADDRESS, replying (once the two hives have
+      said hello) with the `hive_id` of the hive there.
+    - *get_remote_hive_id*: replies with `hive_id`.
+    - *close*: hang up, for good, and unregister.
+    """
+    def __init__(self, hive, id, address=None, remote_hive_id=None,
+                 reconnect_delay=.1, max_reconnect_delay=5,
+                 connect_timeout=5, max_buffer=DEFAULT_MAX_BUFFER,
+                 allowed_directives=None):
+        _check_msgpack()
+        super(RemoteAmbassador, self).__init__(hive, id)
+        self.message_routing.update(
+            {"connect": self.connect,
+             "reconnect": self.reconnect,
+             "attach_connection": self.attach_connection,
+             "get_remote_hive_id": self.get_remote_hive_id,
+             "forward_message": self.forward_message,
+             "close": self.close})
+
+        self.address = address
+        self.remote_hive_id = remote_hive_id
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.connect_timeout = connect_timeout
+        if allowed_directives is not None:
+            allowed_directives = frozenset(allowed_directives)
+        self.allowed_directives = allowed_directives
+
+        self.connection = None
+        self.outbox = Outbox(self.hive.loop, max_buffer)
+        self.batcher = Batcher(
+            self.outbox, _encode_batch,
+            max_items=MAX_BATCH_SIZE, max_delay=MAX_BATCH_DELAY)
+
+        self.registered = False
+        self.closed = False
+        # How long until we try reconnecting next, if it comes to that
+        self._retry_delay = reconnect_delay
+        # Futures waiting on us to be connected
+        self._connect_waiters = []
+
+    async def connect(self, message):
+        if self.remote_hive_id is not None:
+            await self._register()
+
+        waiter = self.hive.loop.create_future()
+        self._connect_waiters.append(waiter)
+        if self.connection is None:
+            await self.reconnect(message)
+        if self.outbox.connection is not None and not waiter.done():
+            # Already were
+            waiter.set_result(self.remote_hive_id)
+
+        hive_id = await waiter
+        message.reply({"hive_id": hive_id})
+
+    async def reconnect(self, message):
+        """
+        Try to connect to ADDRESS, and if that doesn't work, try again
+        in a little while.
+        """
+        if self.closed or self.connection is not None:
+            return
+
+        loop = self.hive.loop
+
+        def make_connection():
+            return RemoteConnection(self, self.hive.hive_id)
+
+        try:
+            if isinstance(self.address, str):
+                opening = loop.create_unix_connection(
+                    make_connection, self.address)
+            else:
+                host, port = self.address
+                opening = loop.create_connection(make_connection, host, port)
+            transport, self.connection = await asyncio.wait_for(
+                opening, self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            _log.info("Couldn't connect to {0!r} ({1}); trying again in "
+                      "{2}s".format(self.address, exc, self._retry_delay))
+            self._reconnect_later()
+
+    def _reconnect_later(self):
+        self.hive.send_after(self._retry_delay, self.id, "reconnect")
+        self._retry_delay = min(
+            self._retry_delay * 2, self.max_reconnect_delay)
+
+    def _hello_received(self, connection):
+        self.send_message(
+            to=self.id, directive="attach_connection",
+            body={"connection": connection})
+
+    async def attach_connection(self, message):
+        """
+        Start sending (and delivering) messages over a connection
+        that's said hello, either our own or one that came in through
+        a RemoteHiveListener.
+        """
+        connection = message.body["connection"]
+        connection.owner = self
+
+        if self.remote_hive_id is None:
+            self.remote_hive_id = connection.remote_hive_id
+        elif connection.remote_hive_id != self.remote_hive_id:
+            _log.warning(
+                "Expected to be connected to hive {0}, not {1}".format(
+                    self.remote_hive_id, connection.remote_hive_id))
+            connection.owner = None
+            connection.close()
+            return
+
+        if self.closed:
+            connection.close()
+            return
+
+        if self.connection is not None and self.connection is not connection:
+            # The other side's dialed back in before we noticed the old
+            # connection had gone
+            old_connection, self.connection = self.connection, None
+            self.outbox.detach()
+            old_connection.owner = None
+            old_connection.close()
+        self.connection = connection
+
+        if not self.registered:
+            await self._register()
+
+        if connection.closed:
+            # Lost it while we were registering
+            self._connection_lost(connection, None)
+            return
+
+        _log.info("Connected to hive {0}".format(self.remote_hive_id))
+        self._retry_delay = self.reconnect_delay
+        self.outbox.attach(connection)
+        connection.set_ready()
+
+        waiters, self._connect_waiters = self._connect_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(self.remote_hive_id)
+
+    async def _register(self):
+        await self.ask(
+            join_id("hive", self.hive.hive_id), "register_ambassador",
+            {"hive_id": self.remote_hive_id})
+        self.registered = True
+
+    def _connection_lost(self, connection, exc):
+        if connection is not self.connection:
+            return
+
+        self.connection = None
+        self.outbox.detach()
+        if self.closed:
+            return
+
+        _log.info("Lost connection to hive {0} ({1})".format(
+            self.remote_hive_id, exc))
+        if self.address is not None:
+            self._reconnect_later()
+
+    def _frame_received(self, connection, message_dicts):
+        localize_message_id = self.hive.localize_message_id
+        send_message = self.send_message
+        allowed_directives = self.allowed_directives
+        for message_dict in message_dicts:
+            if allowed_directives is not None \
+               and message_dict["directive"] not in allowed_directives:
+                _log.warning(
+                    "Dropping {0!r} directive to {1} from hive {2}".format(
+                        message_dict["directive"], message_dict["to"],
+                        self.remote_hive_id))
+                continue
+            # Replies to our own messages need to find their way back
+            # to the (local, integer) message ids they're replying to
+            message_dict["id"] = localize_message_id(message_dict["id"])
+            message_dict["in_reply_to"] = localize_message_id(
+                message_dict["in_reply_to"])
+            send_message(**message_dict)
+
+    def get_remote_hive_id(self, message):
+        message.reply({"hive_id": self.remote_hive_id})
+
+    def forward_message(self, message):
+        self.batcher.add(message.body)
+
+    def close(self, message):
+        if self.closed:
+            return
+        self.closed = True
+
+        self.batcher.flush()
+        if self.connection is not None:
+            self.connection.close()
+        if self.registered:
+            self.registered = False
+            self.send_message(
+                to=join_id("hive", self.hive.hive_id),
+                directive="unregister_ambassador",
+                body={"hive_id": self.remote_hive_id})
+
+
+class Outbox(object):
+    """
+    Where a RemoteAmbassador's batches go: straight down the
+    connection, if there is one, or otherwise held onto (up to
+    MAX_BUFFER bytes of them) until there is.
+    """
+    def __init__(self, loop, max_buffer=DEFAULT_MAX_BUFFER):
+        self.loop = loop
+        self.max_buffer = max_buffer
+        self.connection = None
+
+        self.buffer = deque()
+        self.buffered_bytes = 0
+        # How many batches we've had to throw away for want of room
+        self.dropped = 0
+
+    def send(self, data):
+        if self.connection is not None:
+            self.connection.send(data)
+            return
+
+        if self.buffered_bytes + len(data) > self.max_buffer:
+            self.dropped += 1
+            _log.warning(
+                "Outbox full; dropping a batch of {0} bytes".format(
+                    len(data)))
+            return
+
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+
+    def attach(self, connection):
+        while self.buffer:
+            connection.send(self.buffer.popleft())
+        self.buffered_bytes = 0
+        self.connection = connection
+
+    def detach(self):
+        self.connection = None
+
+
+class RemoteHiveListener(Actor):
+    """
+    Listens for other hives connecting to us, and sets up a
+    RemoteAmbassador for each of them.
+
+    The same ambassador gets used again when a hive reconnects, so
+    anything it's been holding onto in the meanwhile gets through.
+    Extra keyword arguments (such as `allowed_directives`) are passed
+    on to the ambassadors.
+
+    Any hive that can connect can send messages to actors here, so
+    this should only be reachable by hives you trust; see the module
+    docstring.
+
+    Directives:
+
+    - *listen*: body has either `path` for a Unix socket, or `host`
+      (default 127.0.0.1) and `port` (default 8000; 0 picks a free
+      one).  Replies with the `address` we're listening on.
+    - *get_ambassadors*: replies with `ambassadors`, a dict of the
+      ambassador for each hive id that's connected to us.
+    - *stop_listening*: stop taking new connections.
+    """
+    def __init__(self, hive, id, **ambassador_kwargs):
+        _check_msgpack()
+        super(RemoteHiveListener, self).__init__(hive, id)
+        self.message_routing.update(
+            {"listen": self.listen,
+             "get_ambassadors": self.get_ambassadors,
+             "stop_listening": self.stop_listening})
+        self.ambassador_kwargs = ambassador_kwargs
+
+        self.server = None
+        self.ambassadors = {}
+
+    async def listen(self, message):
+        loop = self.hive.loop
+        body = message.body
+
+        if body.get("path") is not None:
+            self.server = await loop.create_unix_server(
+                self._make_connection, body["path"])
+            address = body["path"]
+        else:
+            self.server = await loop.create_server(
+                self._make_connection,
+                host=body.get("host", "127.0.0.1"),
+                port=body.get("port", 8000),
+                reuse_address=True)
+            address = self.server.sockets[0].getsockname()[:2]
+            if address[0] not in ("127.0.0.1", "::1") \
+               and self.ambassador_kwargs.get("allowed_directives") is None:
+                _log.warning(
+                    "Letting hives on {0} send us anything at all; make "
+                    "sure only trusted ones can connect".format(address[0]))
+
+        _log.info("Listening for hives on {0!r}".format(address))
+        if message.wants_reply:
+            message.reply({"address": address})
+
+    def _make_connection(self):
+        return RemoteConnection(self, self.hive.hive_id)
+
+    def _hello_received(self, connection):
+        # It's the ambassador's from here on
+        connection.owner = None
+
+        hive_id = connection.remote_hive_id
+        ambassador = self.ambassadors.get(hive_id)
+        if ambassador is None:
+            ambassador = self.ambassadors[hive_id] = self.hive.create_actor(
+                RemoteAmbassador, remote_hive_id=hive_id,
+                **self.ambassador_kwargs)
+
+        self.send_message(
+            to=ambassador, directive="attach_connection",
+            body={"connection": connection})
+
+    def _connection_lost(self, connection, exc):
+        # Went away before saying hello; nothing to clean up
+        pass
+
+    def get_ambassadors(self, message):
+        message.reply({"ambassadors": dict(self.ambassadors)})
+
+    def stop_listening(self, message):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
@@ -0,0 +1,352 @@
+"""
+Send HTTP requests to different actors depending on their path.
+
+Put a Router between the HTTP actor and whatever handles requests:
+
+    router = hive.create_actor(Router, routes=[
+        ('/', index),
+        ('/users/{user_id}', [user_worker_1, user_worker_2]),
+        ('/users/{user_id}/posts/{post_id}', posts, ['GET']),
+        ('/static/{path:path}', files),
+    ])
+    http = hive.create_actor(HTTP, request_handler=router)
+
+Routes are compiled into a trie keyed on path segments, so finding
+the route for a request costs one dict lookup per segment, however
+many routes there are, rather than trying a regex per route.
+"""
+import logging
+from itertools import cycle
+
+try:
+    from urllib.parse import unquote  # python 3
+except ImportError:
+    from urllib import unquote  # python 2
+
+from xudd.actor import Actor
+
+_log = logging.getLogger(__name__)
+
+
+NOT_FOUND = {
+    'status': '404 Not Found',
+    'headers': [('Content-Type', 'text/plain')],
+    'body': b'Not Found'}
+
+METHOD_NOT_ALLOWED = {
+    'status': '405 Method Not Allowed',
+    'headers': [('Content-Type', 'text/plain')],
+    'body': b'Method Not Allowed'}
+
+
+class RouteError(ValueError):
+    """
+    Raised for a route pattern we can't make sense of, or one that
+    clashes with a route we've already got.
+    """
+    pass
+
+
+class RouteNode(object):
+    """
+    One path segment's worth of the trie.
+    """
+    __slots__ = ("static", "param", "param_node", "rest", "rest_routes",
+                 "routes")
+
+    def __init__(self):
+        # Segment -> RouteNode for plain segments
+        self.static = {}
+        # Name and node for a {param} segment, if any route has one here
+        self.param = None
+        self.param_node = None
+        # Name and method -> Route for a trailing {name:path}, which
+        # soaks up everything that's left
+        self.rest = None
+        self.rest_routes = None
+        # Method (or None for any) -> Route, for routes ending here
+        self.routes = None
+
+
+class Route(object):
+    """
+    Where requests for a route go: TARGETS is one actor, or a list of
+    them to take turns.
+    """
+    __slots__ = ("pattern", "targets", "_next_target")
+
+    def __init__(self, pattern, targets):
+        self.pattern = pattern
+        if isinstance(targets, (list, tuple)):
+            self.targets = list(targets)
+        else:
+            self.targets = [targets]
+
+        if len(self.targets) == 1:
+            target = self.targets[0]
+            self._next_target = lambda: target
+        else:
+            self._next_target = cycle(self.targets).__next__
+
+    def next_target(self):
+        return self._next_target()
+
+
+def _parse_segment(segment):
+    """
+    Returns (kind, name) for a pattern segment, where kind is
+    'static', 'param' or 'rest'.
+    """
+    if not (segment.startswith('{') and segment.endswith('}')):
+        if '{' in segment or '}' in segment:
+            raise RouteError(
+                'Parameters must be a whole path segment: {0}'.format(
+                    segment))
+        return 'static', segment
+
+    name, _, kind = segment[1:-1].partition(':')
+    if not name:
+        raise RouteError('Parameter needs a name: {0}'.format(segment))
+    if kind == 'path':
+        return 'rest', name
+    elif kind:
+        raise RouteError('Unknown parameter type: {0}'.format(segment))
+    return 'param', name
+
+
+def _split_path(path):
+    return path.strip('/').split('/') if path.strip('/') else []
+
+
+def _route_for(routes, method):
+    route = routes.get(method) or routes.get(None)
+    if route is None and method == 'HEAD':
+        # Whatever handles GET can handle HEAD too
+        route = routes.get('GET')
+    return route
+
+
+def _add_routes(routes, pattern, targets, methods):
+    route = Route(pattern, targets)
+    for method in methods or [None]:
+        if method in routes:
+            raise RouteError('{0} is routed twice for {1}'.format(
+                pattern, method or 'all methods'))
+        routes[method] = route
+
+
+class RouteTrie(object):
+    """
+    Routes compiled into a trie of path segments.
+
+    Patterns are paths whose segments are either plain text, `{name}`
+    (matching any one segment) or, as the last segment only,
+    `{name:path}` (matching all the rest of the path).  A plain
+    segment wins over a parameter at the same spot, which in turn wins
+    over a `{name:path}`, so '/users/me' can be routed somewhere other
+    than '/users/{user_id}'.  If the best match isn't routed for the
+    request's method, the next best one that is gets it instead.
+    HEAD requests go to GET routes unless they have their own.
+    """
+    def __init__(self):
+        self.root = RouteNode()
+
+    def add(self, pattern, targets, methods=None):
+        node = self.root
+        segments = _split_path(pattern)
+
+        for i, segment in enumerate(segments):
+            kind, name = _parse_segment(segment)
+
+            if kind == 'static':
+                node = node.static.setdefault(segment, RouteNode())
+
+            elif kind == 'param':
+                if node.param is None:
+                    node.param = name
+                    node.param_node = RouteNode()
+                elif node.param != name:
+                    raise RouteError(
+                        '{0} clashes with an earlier route using '
+                        '{{{1}}} here'.format(pattern, node.param))
+                node = node.param_node
+
+            else:
+                if i != len(segments) - 1:
+                    raise RouteError(
+                        '{{{0}:path}} has to be at the end: {1}'.format(
+                            name, pattern))
+                if node.rest is None:
+                    node.rest = name
+                    node.rest_routes = {}
+                elif node.rest != name:
+                    raise RouteError(
+                        '{0} clashes with an earlier route using '
+                        '{{{1}:path}} here'.format(pattern, node.rest))
+                _add_routes(node.rest_routes, pattern, targets, methods)
+                return
+
+        if node.routes is None:
+            node.routes = {}
+        _add_routes(node.routes, pattern, targets, methods)
+
+    def match(self, method, path):
+        """
+        Find the route for METHOD and PATH.
+
+        Returns (route, params), where route is None if nothing
+        matches at all, or METHOD_NOT_ALLOWED if the path matches but
+        not for this method.
+        """
+        path_matched = False
+        for routes, params in self._match(
+                self.root, _split_path(path), 0, {}):
+            route = _route_for(routes, method)
+            if route is not None:
+                return route, params
+            path_matched = True
+
+        if path_matched:
+            return METHOD_NOT_ALLOWED, {}
+        return None, {}
+
+    def allowed_methods(self, path):
+        """
+        The methods PATH is routed for, for a 405's Allow header.
+        (None among them means any method at all.)
+        """
+        methods = set()
+        for routes, params in self._match(
+                self.root, _split_path(path), 0, {}):
+            methods.update(routes)
+        if 'GET' in methods:
+            methods.add('HEAD')
+        return methods
+
+    def _match(self, node, segments, i, params):
+        # Yields (method -> Route dict, params) for each route that
+        # matches the path, best match first
+        if i == len(segments):
+            if node.routes is not None:
+                yield node.routes, params
+            return
+
+        segment = segments[i]
+
+        child = node.static.get(segment)
+        if child is not None:
+            yield from self._match(child, segments, i + 1, params)
+
+        if node.param_node is not None:
+            param_params = dict(params)
+            param_params[node.param] = segment
+            yield from self._match(
+                node.param_node, segments, i + 1, param_params)
+
+        if node.rest_routes is not None:
+            rest_params = dict(params)
+            rest_params[node.rest] = '/'.join(segments[i:])
+            yield node.rest_routes, rest_params
+
+
+class Router(Actor):
+    '''
+    Dispatches the 'handle_request' messages an HTTP actor sends us to
+    the actor (or one of a pool of actors, in turn) set up for their
+    path.
+
+    ROUTES is a list of (pattern, target) or (pattern, target,
+    methods), where target is an actor id or a list of them, and
+    methods a list of the methods the route is for (by default, all
+    of them).  Patterns are as described in RouteTrie.  More routes
+    can be added with 'add_route' messages with `pattern`, `target`
+    and optionally `methods`.
+
+    The request is passed on as though the HTTP actor had sent it to
+    the target itself (same message id, same sender), so the target
+    replies straight to the HTTP actor, and never knows we were here
+    except that the body has `route` (the pattern that matched) and
+    `route_params` (a dict of the path's parameters).  Chunks of
+    streamed request bodies follow their request to the same target.
+
+    Requests no route matches go to NOT_FOUND_HANDLER if there is one,
+    or get a 404 (or a 405 with an Allow header, if the path's routed
+    but not for that method).
+    '''
+    def __init__(self, hive, id, routes=(), not_found_handler=None):
+        super(Router, self).__init__(hive, id)
+        self.message_routing.update({
+            'handle_request': self.handle_request,
+            'handle_request_chunk': self.handle_request_chunk,
+            'add_route': self.add_route,
+        })
+
+        self.trie = RouteTrie()
+        for route in routes:
+            self.trie.add(*route)
+
+        self.not_found_handler = not_found_handler
+        # Request message id -> where its body chunks are going
+        self.streaming = {}
+
+    def add_route(self, message):
+        self.trie.add(
+            message.body['pattern'], message.body['target'],
+            message.body.get('methods'))
+
+    def handle_request(self, message):
+        options = message.body['options']
+        path = options['uri'].partition('?')[0]
+
+        route, params = self.trie.match(options['method'], path)
+
+        if route is None or route is METHOD_NOT_ALLOWED:
+            if self.not_found_handler is None:
+                _log.info('No route for {0} {1}'.format(
+                    options['method'], path))
+                if route is None:
+                    response = NOT_FOUND
+                else:
+                    allowed = self.trie.allowed_methods(path)
+                    allowed.discard(None)
+                    response = dict(
+                        METHOD_NOT_ALLOWED,
+                        headers=METHOD_NOT_ALLOWED['headers'] + [
+                            ('Allow', ', '.join(sorted(allowed)))])
+                message.reply(directive='respond', body=response)
+                return
+            target, pattern = self.not_found_handler, None
+        else:
+            target, pattern = route.next_target(), route.pattern
+            params = dict(
+                (name, unquote(value)) for name, value in params.items())
+
+        body = dict(message.body, route=pattern, route_params=params)
+        if body.get('streaming'):
+            self.streaming[message.id] = target
+        self._forward(message, target, body)
+
+    def handle_request_chunk(self, message):
+        request_id = message.body['request']
+        if message.body.get('final'):
+            target = self.streaming.pop(request_id, None)
+        else:
+            target = self.streaming.get(request_id)
+
+        if target is None:
+            # We must have turned the request away
+            message.reply()
+            return
+
+        self._forward(message, target, message.body)
+
+    def _forward(self, message, target, body):
+        # Replies go straight back to whoever sent it to us
+        message.defer_reply()
+        self.hive.send_message(
+            to=target,
+            directive=message.directive,
+            from_id=message.from_id,
+            id=message.id,
+            body=body,
+            wants_reply=message.wants_reply)
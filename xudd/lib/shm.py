@@ -0,0 +1,452 @@
+"""
+A channel between two hives on the same machine, over shared memory.
+
+Each direction is a single-producer/single-consumer ring buffer in a
+multiprocessing.shared_memory segment, so frames are copied straight
+into memory the other process can see rather than through the kernel.
+A socketpair is still used, but only as a doorbell: a byte is written
+to it to wake the other side's event loop up (through add_reader(),
+as for a plain Channel) when there's something in the ring for it,
+or when it's waiting on room in a ring that's been full.
+
+SharedMemoryChannel has the same interface as xudd.lib.channel.Channel,
+so a Batcher can sit on top of it just the same.
+"""
+import logging
+import socket
+import struct
+from collections import deque
+
+from multiprocessing import shared_memory
+
+_log = logging.getLogger(__name__)
+
+# Layout of a ring's segment.  The producer's and consumer's positions
+# are on cache lines of their own, so they don't fight over them.
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+CAPACITY_OFFSET = 128
+WAITING_OFFSET = 136
+DATA_OFFSET = 192
+
+POSITION = struct.Struct("=Q")
+WAITING = struct.Struct("=B")
+RECORD_HEADER = struct.Struct("=I")
+
+# Set in a record's length if the rest of its frame is in the records
+# after it
+MORE = 0x80000000
+# A record that just says "skip to the start of the ring"
+PADDING = 0x7FFFFFFF
+
+# Doorbells: "there's something for you", and "there's room now"
+DATA_READY = b"d"
+SPACE_READY = b"s"
+
+DEFAULT_CAPACITY = 4 * 1024 * 1024
+
+# If the other side never rings back after we found the ring full
+# (eg because the ring filled up just as it was emptied), try again
+# after this many seconds anyway
+FULL_RETRY_DELAY = .01
+
+
+def _attach(name):
+    """
+    Attach to an existing segment, without the resource tracker
+    unlinking it out from under its owner when we exit.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13, attaching always registers with the
+        # resource tracker.  (Unregistering afterwards won't do, since
+        # a forked child shares its parent's tracker, and would take
+        # the parent's registration with it.)
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class RingBuffer(object):
+    """
+    A single-producer/single-consumer ring buffer of records, in a
+    shared memory segment.
+
+    Records are a 4-byte length followed by their data, padded out to
+    a multiple of 4 bytes.  A record never wraps around the end of the
+    ring; if there isn't room for it before the end, a PADDING record
+    takes up the rest and it goes at the start.  Positions only ever
+    go up (the offset in the ring being the position modulo its
+    capacity, which is a power of 2), so the ring is empty when the
+    consumer's position has caught up with the producer's.
+    """
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.buf = shm.buf
+        self.owner = owner
+        self.capacity, = POSITION.unpack_from(self.buf, CAPACITY_OFFSET)
+        self.mask = self.capacity - 1
+        # The biggest record we'll write, so that one will always fit
+        # in an empty ring wherever it's up to
+        self.max_record = self.capacity // 4
+
+        # Our own copies of the positions: whichever's ours to move,
+        # and however far we last saw the other one had got
+        self.head, = POSITION.unpack_from(self.buf, HEAD_OFFSET)
+        self.tail, = POSITION.unpack_from(self.buf, TAIL_OFFSET)
+
+    @classmethod
+    def create(cls, capacity=DEFAULT_CAPACITY):
+        if capacity & (capacity - 1):
+            raise ValueError("Ring capacity must be a power of 2")
+        shm = shared_memory.SharedMemory(
+            create=True, size=DATA_OFFSET + capacity)
+        shm.buf[:DATA_OFFSET] = bytes(DATA_OFFSET)
+        POSITION.pack_into(shm.buf, CAPACITY_OFFSET, capacity)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(_attach(name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    ##########
+    # Producer
+    ##########
+
+    def write(self, data, more=False):
+        """
+        Write DATA (no more than max_record bytes) as a record.
+
+        Returns False, having written nothing, if there isn't room.
+        """
+        length = len(data)
+        record_size = RECORD_HEADER.size + ((length + 3) & ~3)
+
+        head = self.head
+        offset = head & self.mask
+        room_before_end = self.capacity - offset
+        padding = room_before_end if room_before_end < record_size else 0
+
+        if padding + record_size > self.capacity - (head - self.tail):
+            # Not as far as we last knew; see how far the consumer's
+            # got since
+            self.tail, = POSITION.unpack_from(self.buf, TAIL_OFFSET)
+            if padding + record_size > self.capacity - (head - self.tail):
+                return False
+
+        buf = self.buf
+        if padding:
+            RECORD_HEADER.pack_into(buf, DATA_OFFSET + offset, PADDING)
+            head += padding
+            offset = 0
+
+        start = DATA_OFFSET + offset
+        RECORD_HEADER.pack_into(buf, start, length | MORE if more else length)
+        start += RECORD_HEADER.size
+        buf[start:start + length] = data
+
+        # Only now that it's all there does the consumer get to see it
+        self.head = head + record_size
+        POSITION.pack_into(buf, HEAD_OFFSET, self.head)
+        return True
+
+    def set_waiting(self, waiting):
+        """
+        Flag (or unflag) that the producer's waiting on room.
+        """
+        WAITING.pack_into(self.buf, WAITING_OFFSET, int(waiting))
+
+    ##########
+    # Consumer
+    ##########
+
+    def read(self):
+        """
+        Yield (data, more) for each record in the ring, where data is
+        a memoryview of the record in place.  The records aren't
+        given back to the producer until we're done, so the views are
+        good until the end of the loop over them (and no longer!).
+        """
+        buf = self.buf
+        tail = self.tail
+        try:
+            while True:
+                head, = POSITION.unpack_from(buf, HEAD_OFFSET)
+                if tail == head:
+                    return
+
+                while tail != head:
+                    offset = tail & self.mask
+                    length, = RECORD_HEADER.unpack_from(
+                        buf, DATA_OFFSET + offset)
+
+                    if length == PADDING:
+                        tail += self.capacity - offset
+                        continue
+
+                    more = bool(length & MORE)
+                    length &= ~MORE
+                    start = DATA_OFFSET + offset + RECORD_HEADER.size
+                    yield buf[start:start + length], more
+                    tail += RECORD_HEADER.size + ((length + 3) & ~3)
+        finally:
+            self.tail = tail
+            # (Unless we've been closed in the meantime)
+            if self.buf is not None:
+                POSITION.pack_into(self.buf, TAIL_OFFSET, tail)
+
+    def producer_waiting(self):
+        """
+        Whether the producer's flagged that it's waiting on room (and
+        if so, unflag it).
+        """
+        waiting, = WAITING.unpack_from(self.buf, WAITING_OFFSET)
+        if waiting:
+            self.set_waiting(False)
+        return bool(waiting)
+
+    def unlink(self):
+        """
+        Remove the segment's name, if it's ours to remove.  Anyone
+        who's already attached to it keeps it for as long as they like.
+        """
+        if self.owner:
+            self.owner = False
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Someone's still holding onto a view of a record; the
+            # mapping goes when they let go of it
+            pass
+        self.unlink()
+
+
+def shared_memory_channel_pair(capacity=DEFAULT_CAPACITY):
+    """
+    Set up the rings and doorbell for a SharedMemoryChannel.
+
+    Returns (ours, theirs): keep OURS for SharedMemoryChannel.create(),
+    and hand THEIRS (which is picklable) to the other process for
+    SharedMemoryChannel.attach().
+    """
+    our_sock, their_sock = socket.socketpair()
+    outbound = RingBuffer.create(capacity)
+    inbound = RingBuffer.create(capacity)
+    return ((our_sock, outbound, inbound),
+            (their_sock, inbound.name, outbound.name))
+
+
+class SharedMemoryChannel(object):
+    """
+    One end of a channel whose frames go through a pair of shared
+    memory rings, with a socket for a doorbell.
+
+    ON_FRAME gets called with each frame as it comes in.  Frames that
+    fit in a single record are handed over as a memoryview straight
+    onto the ring, which is only good for the duration of the call:
+    copy it (eg with bytes()) to keep it.  Bigger frames are split
+    across records going in, and put back together coming out.
+
+    Like Channel, send() never blocks; if the ring is full, frames
+    wait their turn until the other side makes room.
+    """
+    def __init__(self, sock, outbound, inbound, loop, on_frame,
+                 on_close=None):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.outbound = outbound
+        self.inbound = inbound
+        self.loop = loop
+        self.on_frame = on_frame
+        self.on_close = on_close
+
+        # Frames (or what's left of them) waiting on room in the ring
+        self._pending = deque()
+        self._retry_handle = None
+        self._bell_handle = None
+        # Pieces of a frame split across records
+        self._parts = []
+        self.closed = False
+
+    @classmethod
+    def create(cls, ours, loop, on_frame, on_close=None):
+        sock, outbound, inbound = ours
+        return cls(sock, outbound, inbound, loop, on_frame, on_close)
+
+    @classmethod
+    def attach(cls, theirs, loop, on_frame, on_close=None):
+        sock, outbound_name, inbound_name = theirs
+        return cls(
+            sock, RingBuffer.attach(outbound_name),
+            RingBuffer.attach(inbound_name), loop, on_frame, on_close)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def start(self):
+        self.loop.add_reader(self.sock.fileno(), self._doorbell)
+        # Anything that went in before we were listening
+        self._read_frames()
+
+    def send(self, data):
+        if self.closed:
+            return
+
+        self._pending.append(data)
+        if len(self._pending) == 1:
+            self._write_pending()
+
+    def _write_pending(self):
+        outbound = self.outbound
+        max_record = outbound.max_record
+        wrote = False
+
+        while self._pending:
+            data = self._pending[0]
+            more = len(data) > max_record
+            if more:
+                data = memoryview(data)
+            if not outbound.write(data[:max_record] if more else data, more):
+                # Full up; ask the other side to let us know when
+                # there's room
+                outbound.set_waiting(True)
+                if self._retry_handle is None:
+                    self._retry_handle = self.loop.call_later(
+                        FULL_RETRY_DELAY, self._retry)
+                break
+
+            wrote = True
+            if more:
+                self._pending[0] = data[max_record:]
+            else:
+                self._pending.popleft()
+
+        if wrote and self._bell_handle is None:
+            # One doorbell does for everything written this turn of
+            # the loop
+            self._bell_handle = self.loop.call_soon(self._ring_data_ready)
+
+    def _ring_data_ready(self):
+        self._bell_handle = None
+        if not self.closed:
+            self._ring(DATA_READY)
+
+    def _retry(self):
+        self._retry_handle = None
+        if not self.closed:
+            self._write_pending()
+
+    def _ring(self, bell):
+        try:
+            self.sock.send(bell)
+        except (BlockingIOError, InterruptedError):
+            # There are plenty of doorbells waiting to be answered
+            # already
+            pass
+        except OSError:
+            self._connection_lost()
+
+    def _doorbell(self):
+        try:
+            bells = self.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._connection_lost()
+            return
+
+        if not bells:
+            self._connection_lost()
+            return
+
+        if DATA_READY in bells:
+            self._read_frames()
+        if SPACE_READY in bells and self._pending and not self.closed:
+            self._write_pending()
+
+    def _read_frames(self):
+        on_frame = self.on_frame
+        parts = self._parts
+
+        for data, more in self.inbound.read():
+            if more or parts:
+                parts.append(bytes(data))
+                if more:
+                    continue
+                data = b"".join(parts)
+                del parts[:]
+            on_frame(data)
+            if self.closed:
+                return
+
+        if self.inbound.producer_waiting():
+            self._ring(SPACE_READY)
+
+    def unlink(self):
+        """
+        Remove the names of the rings we created, once the other side
+        has attached to them, so that they can't be left behind
+        however either of us goes away.
+        """
+        self.outbound.unlink()
+        self.inbound.unlink()
+
+    def _connection_lost(self):
+        if self.closed:
+            # Already dealt with
+            return
+        self.close()
+        if self.on_close is not None:
+            self.on_close()
+
+    def close(self, flush=False):
+        """
+        Close our end of the channel.  If FLUSH is set, first hang on
+        (for a little while) for anything still waiting on room in the
+        ring to make it in.
+        """
+        if self.closed:
+            return
+
+        if flush:
+            self.sock.settimeout(1)
+            while self._pending and not self.closed:
+                self._write_pending()
+                self._ring(DATA_READY)
+                if self.closed or not self._pending:
+                    break
+                try:
+                    if not self.sock.recv(4096):
+                        break
+                except OSError:
+                    break
+            if self._bell_handle is not None and not self.closed:
+                self._ring(DATA_READY)
+            if self.closed:
+                # The other side went away while we were at it
+                return
+
+        self.closed = True
+        for handle in (self._retry_handle, self._bell_handle):
+            if handle is not None:
+                handle.cancel()
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.outbound.close()
+        self.inbound.close()
@@ -1,13 +1,24 @@
 import socket
-import select
+import asyncio
 import logging
+import warnings
+from itertools import count
 
 from xudd.actor import Actor
 
 _log = logging.getLogger(__name__)
 
+
 class Server(Actor):
+    """
+    Deprecated: hands the request handler raw (socket, address) pairs
+    and writes to them with blocking sendall()s.  Use ConnectionServer
+    instead; this is going away in the next release.
+    """
     def __init__(self, hive, id, request_handler=None):
+        warnings.warn(
+            "xudd.lib.tcp.Server is deprecated; use ConnectionServer",
+            DeprecationWarning, stacklevel=2)
         super(Server, self).__init__(hive, id)
         self.message_routing.update({
             'respond': self.respond,
@@ -16,7 +27,6 @@ class Server(Actor):
         self.requests = {}
         self.request_handler = request_handler
 
-
     def listen(self, message):
         body = message.body
 
@@ -25,20 +35,23 @@ class Server(Actor):
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.setblocking(0)  # XXX: Don't know if this helps much
+        self.socket.setblocking(0)
         self.socket.bind((host, port))
-        self.socket.listen(5)  # Max 5 connections in queue
+        self.socket.listen(body.get('backlog', 128))
 
         while True:
-            readable, writable, errored = select.select(
-                [self.socket],
-                [],
-                [],
-                .0000001)  # XXX: This will surely make it fast! (?)
+            # The hive will let us know when there's someone knocking
+            yield self.wait_on_readable(self.socket)
 
-            if readable:
-                _log.info('Got new request ({0} in local index)'.format(len(self.requests)))
-                req = self.socket.accept()
+            # ... and there may well be more than one of them by now
+            while True:
+                try:
+                    req = self.socket.accept()
+                except (BlockingIOError, InterruptedError):
+                    break
+
+                _log.info('Got new request ({0} in local index)'.format(
+                    len(self.requests)))
 
                 # Use the message id as the internal id for the request
                 message_id = self.send_message(
@@ -55,8 +68,6 @@ class Server(Actor):
                     message_id: req
                 })
 
-            yield self.wait_on_self()
-
     def send(self, message):
         sock, bind = self.requests.get(message.in_reply_to)
         sock.sendall(message.body['response'])
@@ -75,6 +86,246 @@ class Server(Actor):
         _log.info('Responded')
 
 
+class ServerConnection(asyncio.Protocol):
+    """
+    One connection to a ConnectionServer.
+
+    This is both the asyncio protocol for the connection and its entry
+    in the server's connection table; handlers only ever see its id.
+    """
+    __slots__ = ("server", "id", "transport", "paused", "reading_paused",
+                 "drain_waiters")
+
+    def __init__(self, server, id):
+        self.server = server
+        self.id = id
+        self.transport = None
+        self.paused = False
+        # Whether the handler's asked us to stop reading for a bit
+        self.reading_paused = False
+        # Write messages waiting to be told the buffer's drained
+        self.drain_waiters = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server._connection_made(self)
+
+    def data_received(self, data):
+        self.server._notify(
+            "data_received", {"connection": self.id, "data": data})
+
+    def eof_received(self):
+        # Let the transport close itself once our writes are flushed
+        return False
+
+    def pause_writing(self):
+        # The client isn't keeping up with what we're writing, so stop
+        # reading more requests from it until it does
+        self.paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        self._update_reading()
+        self._release_drain_waiters()
+
+    def _update_reading(self):
+        if self.transport.is_closing():
+            return
+        elif self.paused or self.reading_paused:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.paused = False
+        self._release_drain_waiters(closed=True)
+        self.server._connection_lost(self, exc)
+
+    def _release_drain_waiters(self, closed=False):
+        waiters, self.drain_waiters = self.drain_waiters, []
+        for message in waiters:
+            message.reply({"closed": closed})
+
+
+class ConnectionServer(Actor):
+    """TCP server built on loop.create_server()
+
+    Every connection gets an integer id, and the HANDLER actor is sent
+    messages about it:
+
+    - *connection_made*: body has `connection` (the id), `peername`
+      and `sockname`
+    - *data_received*: body has `connection` and `data` (bytes)
+    - *connection_lost*: body has `connection` and `error` (None for a
+      clean close)
+
+    The handler talks back with:
+
+    - *write*: body has `connection` and `data`.  Never blocks; the
+      data is buffered by the connection.  If the message wants a
+      reply, the reply is held until the connection's write buffer has
+      drained below its low water mark, so a handler producing lots of
+      output can wait_on_message() to keep from outrunning the client.
+    - *close*: body has `connection`, and optionally `abort` to drop
+      the connection without flushing what's buffered.
+    - *sendfile*: body has `connection`, `file` (opened in binary
+      mode) and optionally `offset` and `count`.  Sends (that much of)
+      the file after anything already written, using os.sendfile()
+      where it can, and replies once it's done.  Don't write anything
+      else to the connection until then.
+    - *pause_reading* / *resume_reading*: body has `connection`.  Stop
+      (or start again) sending data_received for it, eg because the
+      handler's got a backlog.
+
+    Replies to write/close have `closed` set if the connection is gone.
+    """
+    def __init__(self, hive, id, handler=None,
+                 write_high_water=64 * 1024, write_low_water=16 * 1024):
+        super(ConnectionServer, self).__init__(hive, id)
+        self.message_routing.update({
+            'listen': self.listen,
+            'stop_listening': self.stop_listening,
+            'write': self.write,
+            'close': self.close,
+            'sendfile': self.sendfile,
+            'pause_reading': self.pause_reading,
+            'resume_reading': self.resume_reading,
+        })
+        self.handler = handler
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+
+        self.server = None
+        self.connections = {}
+        self._connection_ids = count(1)
+
+    async def listen(self, message):
+        """
+        Start listening.  Body may have `host` (default 127.0.0.1),
+        `port` (default 8000; 0 picks a free one), `backlog` and
+        `reuse_port`, or instead a `sock` that's already bound and
+        listening (eg one inherited from a parent process).
+
+        Replies with the `host` and `port` we ended up listening on.
+        """
+        body = message.body
+        if body.get('sock') is not None:
+            self.server = await self.hive.loop.create_server(
+                self._make_connection,
+                sock=body['sock'],
+                backlog=body.get('backlog', 128))
+        else:
+            self.server = await self.hive.loop.create_server(
+                self._make_connection,
+                host=body.get('host', '127.0.0.1'),
+                port=body.get('port', 8000),
+                backlog=body.get('backlog', 128),
+                reuse_address=True,
+                reuse_port=body.get('reuse_port'))
+
+        host, port = self.server.sockets[0].getsockname()[:2]
+        _log.info('Listening on {0}:{1}'.format(host, port))
+        if message.wants_reply:
+            message.reply({'host': host, 'port': port})
+
+    def stop_listening(self, message):
+        """
+        Stop accepting new connections (existing ones carry on).
+        """
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    def _make_connection(self):
+        return ServerConnection(self, next(self._connection_ids))
+
+    def _connection_made(self, connection):
+        transport = connection.transport
+        transport.set_write_buffer_limits(
+            self.write_high_water, self.write_low_water)
+        self.connections[connection.id] = connection
+        self._notify(
+            'connection_made',
+            {'connection': connection.id,
+             'peername': transport.get_extra_info('peername'),
+             'sockname': transport.get_extra_info('sockname')})
+
+    def _connection_lost(self, connection, exc):
+        self.connections.pop(connection.id, None)
+        self._notify(
+            'connection_lost', {'connection': connection.id, 'error': exc})
+
+    def _notify(self, directive, body):
+        self.send_message(to=self.handler, directive=directive, body=body)
+
+    def write(self, message):
+        connection = self.connections.get(message.body['connection'])
+        if connection is None or connection.transport.is_closing():
+            if message.wants_reply:
+                message.reply({'closed': True})
+            return
+
+        connection.transport.write(message.body['data'])
+
+        if connection.paused and message.wants_reply:
+            message.defer_reply()
+            connection.drain_waiters.append(message)
+
+    def close(self, message):
+        connection = self.connections.get(message.body['connection'])
+        if connection is None:
+            if message.wants_reply:
+                message.reply({'closed': True})
+            return
+
+        if message.body.get('abort'):
+            connection.transport.abort()
+        else:
+            connection.transport.close()
+
+    async def sendfile(self, message):
+        connection = self.connections.get(message.body['connection'])
+        if connection is None or connection.transport.is_closing():
+            if message.wants_reply:
+                message.reply({'closed': True})
+            return
+
+        try:
+            await self.hive.loop.sendfile(
+                connection.transport, message.body['file'],
+                message.body.get('offset', 0), message.body.get('count'))
+        except (ConnectionError, RuntimeError) as exc:
+            # The connection went away (or was closed) from under us
+            _log.debug('sendfile failed: {0!r}'.format(exc))
+            if message.wants_reply:
+                message.reply({'closed': True})
+            return
+        except Exception:
+            # Most likely the file couldn't be read; whatever's been
+            # sent of it already, the client's not getting the rest
+            _log.exception('sendfile failed')
+            connection.transport.abort()
+            if message.wants_reply:
+                message.reply({'closed': True})
+            return
+
+        # sendfile() fiddles with reading while it works
+        connection._update_reading()
+
+    def pause_reading(self, message):
+        self._set_reading_paused(message.body['connection'], True)
+
+    def resume_reading(self, message):
+        self._set_reading_paused(message.body['connection'], False)
+
+    def _set_reading_paused(self, connection_id, paused):
+        connection = self.connections.get(connection_id)
+        if connection is not None:
+            connection.reading_paused = paused
+            connection._update_reading()
+
+
 class Client(Actor):
     """TCP client
 
@@ -90,14 +341,12 @@ class Client(Actor):
             body={'chunk': b'some bytes'})
 
     """
-    def __init__(self, hive, id, chunk_handler=None, poll_timeout=10):
+    def __init__(self, hive, id, chunk_handler=None):
         """Initialize the client
 
         - *chunk_handler*: ID of the actor that will be given data as we
         receive it through the socket. *Must* have a directive called
         'handle_chunk'
-        - *poll_timeout*: number of milliseconds to wait for data before
-        returning collected (if any) data
         """
         super(Client, self).__init__(hive, id)
 
@@ -106,7 +355,6 @@ class Client(Actor):
             'send': self.send,
         })
 
-        self.poll_timout = poll_timeout
         self.chunk_handler = chunk_handler
 
     def connect(self, message):
@@ -136,40 +384,25 @@ class Client(Actor):
         chunk_size = message.body.get('chunk_size', 1024)
 
         self.socket = socket.create_connection((host, port), timeout)
-        self.socket.setblocking(0)  # XXX: Don't know if this helps much
-        # M says: docs aren't clear on a non-zero timeout + the above
-
-        READ_ONLY = select.POLLIN | select.POLLPRI | select.POLLHUP \
-            | select.POLLERR
-
-        poller = select.poll()
-        poller.register(self.socket, READ_ONLY)
-
-        socket_from_fd = {
-            self.socket.fileno(): self.socket
-        }
+        self.socket.setblocking(0)
 
         _log.info('Connected to {host}:{port}'.format(host=host, port=port))
 
         while True:
-            events = poller.poll(self.poll_timout)
-
-            for fd, flag in events:
-                sock = socket_from_fd[fd]
+            yield self.wait_on_readable(self.socket)
 
-                if flag & (select.POLLIN | select.POLLPRI):
-                    if sock is self.socket:
-                        chunk = self.socket.recv(chunk_size)
+            try:
+                chunk = self.socket.recv(chunk_size)
+            except (BlockingIOError, InterruptedError):
+                continue
 
-                        if chunk in ['', b'']:
-                            raise RuntimeError('socket connection broken')
-
-                        self.send_message(
-                            to=self.chunk_handler,
-                            directive='handle_chunk',
-                            body={'chunk': chunk})
+            if not chunk:
+                raise RuntimeError('socket connection broken')
 
-            yield self.wait_on_self()
+            self.send_message(
+                to=self.chunk_handler,
+                directive='handle_chunk',
+                body={'chunk': chunk})
 
     def send(self, message):
         """Send
@@ -180,7 +413,12 @@ class Client(Actor):
         length = len(out)
         total_sent = 0
         while total_sent < length:
-            sent = self.socket.send(out[total_sent:])
+            try:
+                sent = self.socket.send(out[total_sent:])
+            except (BlockingIOError, InterruptedError):
+                # Socket buffer's full; wait for it to drain
+                yield self.wait_on_writable(self.socket)
+                continue
 
             if sent == 0:
                 raise RuntimeError('socket connection broken')
@@ -1,30 +1,135 @@
 import logging
-import urlparse
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
 
 try:
     from io import BytesIO # python 3
+    from urllib.parse import unquote
 except ImportError:
     from cStringIO import StringIO as BytesIO # python 2
+    from urllib import unquote
 
 from tornado import escape
 
 
-from xudd.actor import Actor, super_init
+from xudd.actor import Actor
 
 _log = logging.getLogger(__name__)
 
 
+SERVICE_UNAVAILABLE = {
+    'status': '503 Service Unavailable',
+    'headers': [('Retry-After', '1')],
+    'body': b''}
+
+INTERNAL_SERVER_ERROR = {
+    'status': '500 Internal Server Error',
+    'headers': [],
+    'body': b''}
+
+# The two headers that don't get an HTTP_ prefix in the environ
+CGI_KEYS = {
+    'Content-Type': 'CONTENT_TYPE',
+    'Content-Length': 'CONTENT_LENGTH',
+}
+# Don't let a client sending us made-up headers grow the cache
+# without limit
+MAX_CGI_KEYS = 1000
+
+# Streamed request bodies bigger than this are put together on disk
+# rather than in memory
+SPOOL_BODIES_OVER = 1024 * 1024
+
+
+def cgi_key(header_name):
+    """
+    The environ key for a request header, eg 'HTTP_USER_AGENT' for
+    'User-Agent'.
+    """
+    key = CGI_KEYS.get(header_name)
+    if key is None:
+        key = 'HTTP_' + header_name.replace('-', '_').upper()
+        if len(CGI_KEYS) < MAX_CGI_KEYS:
+            CGI_KEYS[header_name] = key
+    return key
+
+
+def split_uri(uri):
+    """
+    Split a request URI into its (still quoted) path and query string.
+    """
+    path, _, query = uri.partition('?')
+    if not path.startswith('/') and '://' in path:
+        # An absolute URI, as sent to proxies
+        path = '/' + path.split('://', 1)[1].partition('/')[2]
+    return path, query
+
+
 class WSGI(Actor):
-    def __init__(self, hive, id, app=None):
+    '''
+    Runs a WSGI app for the requests the HTTP actor sends us.
+
+    By default the app runs right here in the hive, which is fine for
+    apps that never block.  For ones that do (talking to a database,
+    say), give THREADS and the app is run (and its response iterated
+    over) in a pool of that many threads instead, so a slow request
+    only ties up its own thread.  If MAX_QUEUED is set too, requests
+    that would leave more than that many jobs waiting on a thread get
+    a 503 straight away instead.
+
+    Request bodies the HTTP actor streams to us (see its
+    STREAM_BODIES_OVER) are put back together before the app is
+    called, since WSGI apps expect all of wsgi.input to be there to
+    read.  Any over SPOOL_BODIES_OVER go in a temporary file rather
+    than in memory.
+
+    Send us 'get_pool_stats' to find out how busy the pool is.
+    '''
+    def __init__(self, hive, id, app=None, threads=None, max_queued=None):
         super(WSGI, self).__init__(hive, id)
         self.message_routing.update({
             'handle_request': self.handle_request,
-            'set_app': self.set_app
+            'handle_request_chunk': self.handle_request_chunk,
+            'set_app': self.set_app,
+            'get_pool_stats': self.get_pool_stats,
         })
 
         self.wsgi_app = app
 
+        self.threads = threads
+        self.max_queued = max_queued
+        if threads:
+            self.executor = ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix='xudd-wsgi')
+        else:
+            self.executor = None
+
+        # Everything in the environ that's the same for every request
+        self.environ_template = {
+            'SCRIPT_NAME': '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': self.executor is not None,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+
+        # Requests being handled in the pool, jobs waiting on a thread,
+        # and jobs running in one.  (The last two are also touched from
+        # the pool's threads, hence the lock.)
+        self.requests_in_flight = 0
+        self.jobs_queued = 0
+        self.jobs_running = 0
+        self._jobs_lock = threading.Lock()
+
+        # Request message id -> (message, body so far) for requests
+        # whose bodies are still streaming in
+        self.uploads = {}
+
     def set_app(self, message):
         '''
         Set the WSGI backend app.
@@ -37,75 +142,305 @@ class WSGI(Actor):
         self.wsgi_app = message.body['app']
 
     def handle_request(self, message):
-        _log.info('Got request')
+        _log.debug('Got request: %s', message.body)
 
-        _log.debug('message body: {0}'.format(message.body))
+        if message.body.get('streaming'):
+            # Wait for the rest of the body
+            message.defer_reply()
+            self.uploads[message.id] = (
+                message, SpooledTemporaryFile(max_size=SPOOL_BODIES_OVER))
+            return
 
-        options = message.body.get('options')
+        return self._start_request(message)
 
-        uri_parts = urlparse.urlparse(''.join([
-            'http://fake.example',
-            options.get('uri')
-        ]))
+    def handle_request_chunk(self, message):
+        request_id = message.body['request']
+        message.reply()
+        if request_id not in self.uploads:
+            return
 
-        environ = {
-            'REQUEST_METHOD': options.get('method'),
-            'SCRIPT_NAME': '',
-            'PATH_INFO': escape.url_unescape(uri_parts.path),
-            'QUERY_STRING': uri_parts.query,
-            "REMOTE_ADDR": options.get('remote_ip'),
-            "SERVER_NAME": options.get('server_name'),
-            "SERVER_PORT": str(options.get('port')),
-            "SERVER_PROTOCOL": options.get('version'),
-            "wsgi.version": (1, 0),
-            "wsgi.url_scheme": 'http',
-            "wsgi.input": BytesIO(escape.utf8(message.body.get('body'))),
-            "wsgi.errors": sys.stderr,
-            "wsgi.multithread": False,
-            "wsgi.multiprocess": False,
-            "wsgi.run_once": False,
-        }
+        request, body = self.uploads[request_id]
+        body.write(message.body['chunk'])
+        if message.body['final']:
+            del self.uploads[request_id]
+            body.seek(0)
+            return self._start_request(request, body)
+
+    def _start_request(self, message, wsgi_input=None):
+        environ = self.make_environ(message.body, wsgi_input)
+        response = AppResponse(self.wsgi_app, environ)
+
+        if self.executor is None:
+            return self._handle_request(message, response)
+
+        if self.max_queued is not None and self.jobs_queued >= self.max_queued:
+            _log.warning('WSGI thread pool backed up; turning request away')
+            message.reply(directive='respond', body=SERVICE_UNAVAILABLE)
+            return
+
+        return self._handle_request_in_pool(message, response)
+
+    def make_environ(self, request, wsgi_input=None):
+        """
+        Build the environ for a 'handle_request' message's body (and
+        WSGI_INPUT, if the request body isn't in there).
+        """
+        options = request['options']
+        path, query = split_uri(options['uri'])
+
+        environ = self.environ_template.copy()
+        environ['REQUEST_METHOD'] = options['method']
+        # PEP 3333 wants the unquoted path's bytes as latin-1
+        environ['PATH_INFO'] = unquote(path, 'latin-1')
+        environ['QUERY_STRING'] = query
+        environ['REMOTE_ADDR'] = options.get('remote_ip')
+        environ['SERVER_NAME'] = options.get('server_name')
+        environ['SERVER_PORT'] = str(options.get('port'))
+        environ['SERVER_PROTOCOL'] = options.get('version')
+        if wsgi_input is None:
+            wsgi_input = BytesIO(escape.utf8(request.get('body') or b''))
+        environ['wsgi.input'] = wsgi_input
+
+        for name, value in options['headers'].items():
+            environ[cgi_key(name)] = value
+
+        return environ
+
+    def _handle_request(self, message, response):
+        try:
+            message.reply(directive='respond', body=response.start())
+
+            while True:
+                try:
+                    chunk = response.next_chunk()
+                except Exception:
+                    self._abort_response(message)
+                    break
+
+                if chunk is None:
+                    break
+
+                chunk['request'] = message.id
+                reply = yield self.wait_on_message(
+                    to=message.from_id,
+                    directive='respond_chunk',
+                    body=chunk)
 
-        if "Content-Type" in options.get('headers'):
-            environ["CONTENT_TYPE"] = options.get('headers').pop("Content-Type")
-        if "Content-Length" in options.get('headers'):
-            environ["CONTENT_LENGTH"] = options.get('headers').pop("Content-Length")
-        for key, value in options.get('headers').items():
-            environ["HTTP_" + key.replace("-", "_").upper()] = value
+                if reply.body.get('closed'):
+                    _log.info('Client went away mid-response')
+                    break
+        finally:
+            response.close()
 
-        response = []
-        data = {
-            'status': 200,
-            'headers': {}}
+    async def _handle_request_in_pool(self, message, response):
+        self.requests_in_flight += 1
+        try:
+            message.reply(
+                directive='respond',
+                body=await self._run_in_pool(response.start))
 
-        def start_response(status, response_headers, exc_info=None):
-            data['status'] = status
-            data['headers'] = response_headers
+            while True:
+                try:
+                    chunk = await self._run_in_pool(response.next_chunk)
+                except Exception:
+                    self._abort_response(message)
+                    break
 
-            return response.append
+                if chunk is None:
+                    break
 
-        app_return_value = self.wsgi_app(environ, start_response)
+                chunk['request'] = message.id
+                reply = await self.ask(
+                    message.from_id, 'respond_chunk', chunk)
 
-        if app_return_value is not None:
+                if reply.body.get('closed'):
+                    _log.info('Client went away mid-response')
+                    break
+        finally:
+            self.requests_in_flight -= 1
+            # Closing can block too
+            self._run_in_pool(response.close)
+
+    def _run_in_pool(self, func):
+        with self._jobs_lock:
+            self.jobs_queued += 1
+
+        def job():
+            with self._jobs_lock:
+                self.jobs_queued -= 1
+                self.jobs_running += 1
+            try:
+                return func()
+            finally:
+                with self._jobs_lock:
+                    self.jobs_running -= 1
+
+        return self.hive.loop.run_in_executor(self.executor, job)
+
+    def _abort_response(self, message):
+        # Too late for a 500; all we can do is hang up
+        _log.exception('WSGI app failed mid-response')
+        self.send_message(
+            to=message.from_id,
+            directive='respond_chunk',
+            body={'request': message.id, 'abort': True})
+
+    def pool_stats(self):
+        """
+        How busy the thread pool is: how many `threads` it has, how
+        many of them are `busy`, how many jobs are `queued` waiting for
+        one, and how many requests are `in_flight` in it altogether.
+        """
+        with self._jobs_lock:
+            return {
+                'threads': self.threads or 0,
+                'busy': self.jobs_running,
+                'queued': self.jobs_queued,
+                'in_flight': self.requests_in_flight}
+
+    def get_pool_stats(self, message):
+        message.reply(self.pool_stats())
+
+
+class AppResponse(object):
+    """
+    One call of a WSGI app, and the response it's giving us.
+    """
+    def __init__(self, app, environ):
+        self.app = app
+        self.environ = environ
+
+        self.status = '200 OK'
+        self.headers = []
+        # Anything the app hands to the write() callable
+        self.written = []
+
+        self.app_iter = None
+        self.chunks = None
+        # The chunk after the one we last handed out, if there is one
+        self.following = None
+
+    def start_response(self, status, response_headers, exc_info=None):
+        self.status = status
+        self.headers = response_headers
+
+        return self.written.append
+
+    def start(self):
+        """
+        Call the app, and return the body of the 'respond' message for
+        the HTTP actor.
+        """
+        try:
+            self.app_iter = self.app(self.environ, self.start_response)
+
+            if isinstance(self.app_iter, FileWrapper) \
+               and self.app_iter.sendable():
+                # Let the server sendfile() it (and close it after)
+                fileobj, self.app_iter = self.app_iter, None
+                return {
+                    'status': self.status,
+                    'headers': self.headers,
+                    'body': b''.join(self.written),
+                    'file': fileobj,
+                    'offset': fileobj.tell()}
+
+            self.chunks = _iter_chunks(self.app_iter, self.written)
+            body = next(self.chunks, None)
+            if body is not None:
+                self.following = next(self.chunks, None)
+        except Exception:
+            _log.exception('WSGI app failed')
+            return INTERNAL_SERVER_ERROR
+
+        response = {
+            'status': self.status,
+            'headers': self.headers,
+            'body': body or b''}
+
+        if self.following is not None:
+            # Send everything on as we get it, rather than holding onto
+            # it until the app's done
+            response['more'] = True
+
+        return response
+
+    def next_chunk(self):
+        """
+        Get the body of the next 'respond_chunk' message for the HTTP
+        actor, or None if that's everything.
+        """
+        if self.following is None:
+            return None
+
+        body, self.following = self.following, next(self.chunks, None)
+        return {'body': body, 'more': self.following is not None}
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
             try:
-                response_iterator = iter(app_return_value)
-                for i in response_iterator:
-                    response.append(i)
-            except TypeError as exc:
-                _log.error('response: {0}; error: {1}'.format(
-                    response_iterator,
-                    traceback.format_exc()))
-
-        _log.info('response: {0}'.format(response))
-
-        message.reply(
-            directive='respond',
-            body={
-                'response': 'HTTP/1.1 {status}\r\n{headers}\r\n\r\n{body}'.format(
-                    status=data.get('status'),
-                    headers='\r\n'.join(
-                        [': '.join(i) for i in data.get('headers')]),
-                    body=''.join(response))
-            })
+                self.app_iter.close()
+            except Exception:
+                _log.exception('Closing WSGI response failed')
+
+
+def _iter_chunks(app_iter, written):
+    """
+    Iterate over the non-empty bytes of a WSGI response, including
+    anything written with the write() callable along the way.
+    """
+    for data in app_iter or ():
+        if written:
+            data = b''.join(escape.utf8(i) for i in written) + escape.utf8(data)
+            del written[:]
+        if data:
+            yield escape.utf8(data)
+
+    if written:
+        yield b''.join(escape.utf8(i) for i in written)
+
+
+class FileWrapper(object):
+    """
+    wsgi.file_wrapper: if an app returns one of these around a real
+    file, the server sends it with sendfile() instead of reading it
+    through Python.
+    """
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def sendable(self):
+        try:
+            self.filelike.fileno()
+            self.filelike.tell()
+        except (AttributeError, OSError, ValueError):
+            return False
+        return True
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def tell(self):
+        return self.filelike.tell()
+
+    # For when the transport can't really sendfile(), and asyncio reads
+    # the file itself instead
+    def seek(self, offset, whence=0):
+        return self.filelike.seek(offset, whence)
+
+    def readinto(self, buffer):
+        return self.filelike.readinto(buffer)
 
+    def __iter__(self):
+        read = self.filelike.read
+        block_size = self.block_size
+        while True:
+            data = read(block_size)
+            if not data:
+                break
+            yield data
 
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
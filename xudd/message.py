@@ -1,5 +1,27 @@
 import json
 
+
+class FrozenDict(dict):
+    """
+    A dictionary that can't be modified.
+
+    Messages without a body all share a single one of these, rather
+    than each allocating their own empty dict.
+    """
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s is immutable" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+    __ior__ = _immutable
+
+
+# Shared body for messages that don't have one
+EMPTY_BODY = FrozenDict()
+
+
 class Message(object):
     """Encapsulation of message data.
 
@@ -32,7 +54,8 @@ class Message(object):
       Hive itself (but available to the actor sending the message also,
       often used to track "waiting on replies" for coroutines-in-waiting)
     - **body:** a dictionary of data; the payload of the message.
-      (if None, will be converted to an empty dict.)
+      (if None, will be converted to EMPTY_BODY, an immutable empty
+      dict shared by all messages without a body.)
       This can be anything, with a couple of caveats:
 
       - If there's any possibility of sending this across the wire via
@@ -70,12 +93,18 @@ class Message(object):
       the actor.
 
     """
+    # There are a *lot* of these around at any given time, so keep
+    # them small.
+    __slots__ = (
+        "to", "directive", "from_id", "body", "id", "in_reply_to",
+        "wants_reply", "replied", "deferred_reply", "hive_proxy")
+
     def __init__(self, to, directive, from_id, id, body=None, in_reply_to=None,
                  wants_reply=False, hive_proxy=None):
         self.to = to
         self.directive = directive
         self.from_id = from_id
-        self.body = body or {}
+        self.body = body or EMPTY_BODY
         self.id = id
         self.in_reply_to = in_reply_to
         self.wants_reply = wants_reply
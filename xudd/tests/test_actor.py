@@ -0,0 +1,298 @@
+import asyncio
+import socket
+
+from xudd.hive import Hive
+from xudd.actor import Actor, MessageTimeout
+
+
+def run_hive(hive, timeout=5):
+    """
+    Run the hive until something sends shutdown (or TIMEOUT passes,
+    in case something went wrong).
+    """
+    hive.loop.call_later(timeout, hive.loop.stop)
+    hive.run()
+
+
+class Answerer(Actor):
+    def __init__(self, hive, id):
+        super(Answerer, self).__init__(hive, id)
+        self.message_routing.update(
+            {"answer": self.answer,
+             "ignore": self.ignore})
+
+    def answer(self, message):
+        message.reply({"answer": message.body["question"] * 2})
+
+    def ignore(self, message):
+        message.defer_reply()
+
+
+class AsyncAsker(Actor):
+    def __init__(self, hive, id, results):
+        super(AsyncAsker, self).__init__(hive, id)
+        self.message_routing.update(
+            {"ask_around": self.ask_around,
+             "ask_me": self.ask_me})
+        self.results = results
+
+    async def ask_around(self, message):
+        answerer = message.body["answerer"]
+
+        response = await self.ask(
+            to=answerer, directive="answer", body={"question": 21})
+        self.results.append(response.body["answer"])
+
+        # Ask ourselves something too; we should get autoreplied to
+        # once our other handler finishes
+        response = await self.ask(to=self.id, directive="ask_me")
+        self.results.append(response.directive)
+
+        try:
+            await self.ask(to=answerer, directive="ignore", timeout=.01)
+        except MessageTimeout:
+            self.results.append("timed out")
+
+        # Plain old asyncio stuff works too
+        await asyncio.sleep(0)
+        self.results.append("slept")
+
+        self.hive.send_shutdown()
+
+    async def ask_me(self, message):
+        await asyncio.sleep(0)
+
+
+def test_async_handlers():
+    hive = Hive(loop=asyncio.new_event_loop())
+    results = []
+    answerer = hive.create_actor(Answerer)
+    asker = hive.create_actor(AsyncAsker, results=results)
+
+    hive.send_message(
+        to=asker, directive="ask_around", body={"answerer": answerer})
+    run_hive(hive)
+
+    assert results == [42, "reply", "timed out", "slept"]
+    # Nothing should be left waiting around
+    assert hive._actor_registry[asker.local_id]._waiting_coroutines == {}
+    hive.loop.close()
+
+
+class Breaker(Actor):
+    def __init__(self, hive, id, results):
+        super(Breaker, self).__init__(hive, id)
+        self.message_routing.update(
+            {"break_down": self.break_down,
+             "ask_breaker": self.ask_breaker})
+        self.results = results
+
+    async def break_down(self, message):
+        await asyncio.sleep(0)
+        raise ValueError("broken")
+
+    async def ask_breaker(self, message):
+        # We should hear about the failure rather than wait forever
+        response = await self.ask(to=self.id, directive="break_down")
+        self.results.append((response.directive, response.body["error"]))
+        self.hive.send_shutdown()
+
+
+def test_async_handler_failure():
+    hive = Hive(loop=asyncio.new_event_loop())
+    results = []
+    breaker = hive.create_actor(Breaker, results=results)
+
+    hive.send_message(to=breaker, directive="ask_breaker")
+    run_hive(hive)
+
+    assert results == [("error.handler_failed", "ValueError('broken')")]
+    hive.loop.close()
+
+
+class PatientAsker(Actor):
+    def __init__(self, hive, id, results):
+        super(PatientAsker, self).__init__(hive, id)
+        self.message_routing.update(
+            {"ask_around": self.ask_around})
+        self.results = results
+
+    def ask_around(self, message):
+        answerer = message.body["answerer"]
+
+        response = yield self.wait_on_message(
+            to=answerer, directive="answer", body={"question": 1},
+            timeout=5)
+        self.results.append(response.body["answer"])
+
+        try:
+            # The answerer never gets back to us on this one, and the
+            # hive's wait_timeout kicks in
+            yield self.wait_on_message(to=answerer, directive="ignore")
+        except MessageTimeout:
+            self.results.append("timed out")
+
+        self.hive.send_shutdown()
+
+
+def test_wait_timeouts():
+    hive = Hive(loop=asyncio.new_event_loop(), wait_timeout=.01)
+    results = []
+    answerer = hive.create_actor(Answerer)
+    asker = hive.create_actor(PatientAsker, results=results)
+
+    hive.send_message(
+        to=asker, directive="ask_around", body={"answerer": answerer})
+    run_hive(hive)
+
+    assert results == [2, "timed out"]
+    assert hive.pending_waits()[asker] == 0
+    assert hive._actor_registry[asker.local_id]._wait_deadlines == {}
+    hive.loop.close()
+
+
+def test_pending_waits():
+    hive = Hive(loop=asyncio.new_event_loop())
+    answerer = hive.create_actor(Answerer)
+    asker_id = hive.create_actor(Actor)
+    asker = hive._actor_registry[asker_id.local_id]
+
+    for i in range(100):
+        message_id = asker.wait_on_message(
+            to=answerer, directive="ignore", timeout=60)
+        asker._waiting_coroutines[message_id] = object()
+
+    assert hive.pending_waits()[asker_id] == 100
+    assert len(hive._wait_deadlines) == 100
+
+    # Cancelled deadlines get cleaned out of the heap once they pile up
+    for message_id in list(asker._waiting_coroutines):
+        asker._pop_waiting(message_id)
+
+    assert hive.pending_waits()[asker_id] == 0
+    assert len(hive._wait_deadlines) < 50
+    hive.loop.close()
+
+
+class Gatherer(Actor):
+    def __init__(self, hive, id, results):
+        super(Gatherer, self).__init__(hive, id)
+        self.message_routing.update(
+            {"gather_around": self.gather_around,
+             "async_gather_around": self.async_gather_around})
+        self.results = results
+
+    def gather_around(self, message):
+        answerer = message.body["answerer"]
+        questions = [{"to": answerer, "directive": "answer",
+                      "body": {"question": i}} for i in range(5)]
+
+        replies = yield self.wait_on_all(questions)
+        self.results.append([reply.body["answer"] for reply in replies])
+
+        reply = yield self.wait_on_any(questions)
+        self.results.append(reply.body["answer"])
+
+        # Some of these never get answered
+        replies = yield self.wait_on_all(
+            questions + [{"to": answerer, "directive": "ignore"}],
+            timeout=.01)
+        self.results.append(
+            [reply and reply.body["answer"] for reply in replies])
+
+        reply = yield self.wait_on_any(
+            [{"to": answerer, "directive": "ignore"}], timeout=.01)
+        self.results.append(reply)
+
+        replies = yield self.wait_on_all([])
+        self.results.append(replies)
+
+        self.hive.send_shutdown()
+
+    async def async_gather_around(self, message):
+        answerer = message.body["answerer"]
+        questions = [{"to": answerer, "directive": "answer",
+                      "body": {"question": i}} for i in range(3)]
+
+        replies = await self.ask_all(questions)
+        self.results.append([reply.body["answer"] for reply in replies])
+
+        reply = await self.ask_any(questions)
+        self.results.append(reply.body["answer"])
+
+        self.hive.send_shutdown()
+
+
+def test_wait_on_all_and_any():
+    hive = Hive(loop=asyncio.new_event_loop())
+    results = []
+    answerer = hive.create_actor(Answerer)
+    gatherer = hive.create_actor(Gatherer, results=results)
+
+    hive.send_message(
+        to=gatherer, directive="gather_around", body={"answerer": answerer})
+    run_hive(hive)
+
+    assert results == [
+        [0, 2, 4, 6, 8],
+        0,
+        [0, 2, 4, 6, 8, None],
+        None,
+        []]
+    assert hive.pending_waits()[gatherer] == 0
+
+    del results[:]
+    hive.send_message(
+        to=gatherer, directive="async_gather_around",
+        body={"answerer": answerer})
+    run_hive(hive)
+
+    assert results == [[0, 2, 4], 0]
+    assert hive.pending_waits()[gatherer] == 0
+    hive.loop.close()
+
+
+class Listener(Actor):
+    def __init__(self, hive, id, sock, received):
+        super(Listener, self).__init__(hive, id)
+        self.message_routing.update(
+            {"listen": self.listen})
+        self.sock = sock
+        self.received = received
+
+    def listen(self, message):
+        while True:
+            yield self.wait_on_readable(self.sock)
+            data = self.sock.recv(1024)
+            if not data:
+                break
+            self.received.append(data)
+
+        self.hive.send_shutdown()
+
+
+def test_wait_on_readable():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ours, theirs = socket.socketpair()
+    ours.setblocking(False)
+    received = []
+    listener = hive.create_actor(Listener, sock=ours, received=received)
+    hive.send_message(to=listener, directive="listen")
+
+    # Nothing to read, so the hive should have gone quiet rather than
+    # keep poking the listener
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+    assert not hive._drain_scheduled
+    assert not hive._run_queue
+
+    loop.call_soon(theirs.sendall, b"hello")
+    loop.call_later(.01, theirs.close)
+    run_hive(hive)
+
+    assert b"".join(received) == b"hello"
+    ours.close()
+    loop.close()
@@ -0,0 +1,218 @@
+import asyncio
+
+from tornado.httputil import HTTPHeaders
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.cache import ResponseCache
+
+
+class Backend(Actor):
+    def __init__(self, hive, id, calls):
+        super(Backend, self).__init__(hive, id)
+        self.message_routing.update({'handle_request': self.handle_request})
+        self.calls = calls
+
+    async def handle_request(self, message):
+        options = message.body['options']
+        uri = options['uri']
+        self.calls.append((options['method'], uri))
+        # Give other requests a chance to pile up behind this one
+        await asyncio.sleep(.01)
+
+        headers = [('Content-Type', 'text/plain')]
+        body = ('%s #%d' % (uri, len(self.calls))).encode('ascii')
+        if uri == '/private':
+            headers.append(('Cache-Control', 'private'))
+        elif uri == '/dated':
+            headers.append(('Cache-Control', 'max-age=60'))
+            headers.append(('Last-Modified', 'Sat, 01 Jan 2022 00:00:00 GMT'))
+        elif uri == '/vary':
+            headers.append(('Cache-Control', 'max-age=60'))
+            headers.append(('Vary', 'Accept-Language'))
+            body += options['headers'].get('Accept-Language', '').encode()
+        elif uri == '/broken':
+            raise RuntimeError('broken')
+        elif uri == '/silent':
+            # Leave it to the autoreply
+            return
+        elif uri == '/stream':
+            message.reply(directive='respond', body={
+                'status': '200 OK', 'headers': headers, 'body': b'a',
+                'more': True})
+            self.send_message(
+                to=message.from_id, directive='respond_chunk',
+                body={'request': message.id, 'body': b'b', 'more': False})
+            return
+        elif uri == '/held':
+            message.reply(directive='respond', body={
+                'status': '200 OK', 'headers': headers, 'body': b'a',
+                'more': True})
+            sent = await self.ask(
+                message.from_id, 'respond_chunk',
+                body={'request': message.id, 'body': b'hold', 'more': True})
+            self.calls.append(('sent', sent.body))
+            return
+        else:
+            headers.append(('Cache-Control', 'max-age=60'))
+            body += b'x' * 500
+
+        message.reply(directive='respond', body={
+            'status': '200 OK', 'headers': headers, 'body': body})
+
+
+def request(uri, method='GET', **headers):
+    return dict(to=None, directive='handle_request', body={
+        'options': {'method': method, 'uri': uri,
+                    'headers': HTTPHeaders(
+                        (name.replace('_', '-'), value)
+                        for name, value in headers.items())},
+        'body': b'', 'streaming': False})
+
+
+class Client(Actor):
+    def __init__(self, hive, id, results):
+        super(Client, self).__init__(hive, id)
+        self.message_routing.update({
+            'run': self.run,
+            'respond_chunk': self.respond_chunk})
+        self.results = results
+        self.chunks = []
+        self.held = None
+
+    def respond_chunk(self, message):
+        if message.body['body'] == b'hold':
+            # Like a client that isn't keeping up
+            message.defer_reply()
+            self.held = message
+            return
+        self.chunks.append(message.body)
+
+    async def get(self, *args, **kwargs):
+        req = request(*args, **kwargs)
+        req['to'] = self.cache
+        reply, = await self.ask_all([req])
+        return reply.body
+
+    async def run(self, message):
+        try:
+            await self.check()
+        except Exception as exc:
+            self.results['error'] = exc
+        finally:
+            self.hive.send_shutdown()
+
+    async def check(self):
+        calls = self.results['calls']
+        backend = self.hive.create_actor(Backend, calls=calls)
+        self.cache = self.hive.create_actor(
+            ResponseCache, backend=backend, max_bytes=2000)
+
+        # Cached, and revalidated against our ETag
+        first = await self.get('/a')
+        second = await self.get('/a')
+        assert first['body'] == second['body'] == b'/a #1' + b'x' * 500
+        assert ('Age', '0') in second['headers']
+        etag = dict(second['headers'])['ETag']
+        not_modified = await self.get('/a', If_None_Match=etag)
+        assert not_modified['status'] == '304 Not Modified'
+        assert not_modified['body'] == b''
+        assert dict(not_modified['headers'])['ETag'] == etag
+        assert calls == [('GET', '/a')]
+
+        # Last-Modified
+        dated = await self.get('/dated')
+        later = await self.get(
+            '/dated', If_Modified_Since='Sun, 02 Jan 2022 00:00:00 GMT')
+        earlier = await self.get(
+            '/dated', If_Modified_Since='Fri, 31 Dec 2021 00:00:00 GMT')
+        assert later['status'].startswith('304')
+        assert earlier['body'] == dated['body']
+
+        # Not to be shared
+        await self.get('/private')
+        await self.get('/private')
+        assert calls.count(('GET', '/private')) == 2
+
+        # Concurrent misses only go to the backend once
+        del calls[:]
+        replies = await self.ask_all(
+            [dict(request('/b'), to=self.cache) for i in range(3)])
+        assert len(set(reply.body['body'] for reply in replies)) == 1
+        assert calls == [('GET', '/b')]
+
+        # Different variants
+        en = await self.get('/vary', Accept_Language='en')
+        fr = await self.get('/vary', Accept_Language='fr')
+        en_again = await self.get('/vary', Accept_Language='en')
+        assert en['body'].endswith(b'en') and fr['body'].endswith(b'fr')
+        assert en_again['body'] == en['body']
+        assert calls.count(('GET', '/vary')) == 2
+
+        # A POST throws out what we had for its URI
+        await self.get('/b', 'POST')
+        await self.get('/b')
+        assert calls.count(('GET', '/b')) == 2
+
+        # Three of these don't fit in 2000 bytes, so /c goes first
+        del calls[:]
+        for uri in ['/c', '/d', '/e', '/d', '/c']:
+            await self.get(uri)
+        assert calls == [('GET', '/c'), ('GET', '/d'), ('GET', '/e'),
+                         ('GET', '/c')]
+
+        # Streamed responses are passed through
+        streamed = await self.ask_all([dict(request('/stream'), to=self.cache)])
+        await asyncio.sleep(.01)
+        assert streamed[0].body['more']
+        assert self.chunks == [
+            {'request': streamed[0].in_reply_to, 'body': b'b', 'more': False}]
+
+        # ... and the backend only hears its chunk's gone out once it
+        # really has
+        await self.ask_all([dict(request('/held'), to=self.cache)])
+        await asyncio.sleep(.02)
+        assert calls[-1] == ('GET', '/held')
+        self.held.reply({'closed': True})
+        await asyncio.sleep(.01)
+        assert calls[-1] == ('sent', {'closed': True})
+
+        # HEAD requests get the headers (with the length of the body
+        # they'd have got), but not the body
+        del calls[:]
+        for i in range(2):
+            head = await self.get('/h', 'HEAD')
+            assert head['body'] == b''
+            assert dict(head['headers'])['Content-Length'] == '505'
+        assert calls == [('HEAD', '/h')]
+
+        # Everyone waiting on a backend that fails (or doesn't respond)
+        # gets an error, and the next request tries again
+        del calls[:]
+        for uri in ('/broken', '/silent'):
+            for i in range(2):
+                replies = await self.ask_all(
+                    [dict(request(uri), to=self.cache) for i in range(2)])
+                assert [reply.body['status'] for reply in replies] == [
+                    '500 Internal Server Error'] * 2
+        assert calls == [('GET', '/broken')] * 2 + [('GET', '/silent')] * 2
+
+        stats = (await self.ask(self.cache, 'get_cache_stats')).body
+        self.results['stats'] = stats
+
+
+def test_response_cache():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    results = {'calls': []}
+    client = hive.create_actor(Client, results=results)
+    hive.send_message(to=client, directive='run')
+    hive.run()
+
+    if 'error' in results:
+        raise results['error']
+    stats = results['stats']
+    assert stats['collapsed'] == 6
+    assert stats['not_modified'] == 2
+    assert stats['entries'] == 2
+    assert stats['bytes'] <= 2000
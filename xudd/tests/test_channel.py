@@ -0,0 +1,69 @@
+import asyncio
+import json
+
+from xudd.lib.channel import Channel, Batcher, channel_pair
+
+
+def test_channel():
+    loop = asyncio.new_event_loop()
+    left_sock, right_sock = channel_pair()
+
+    received = []
+    closed = []
+
+    def on_frame(frame):
+        received.append(frame)
+        if len(received) == len(frames):
+            right.close()
+
+    left = Channel(left_sock, loop, on_frame=lambda frame: None,
+                   on_close=lambda: closed.append(True) or loop.stop())
+    right = Channel(right_sock, loop, on_frame=on_frame)
+    left.start()
+    right.start()
+
+    # Small frames, an empty one, and one far too big for the socket
+    # buffers, so it has to go out (and come in) in pieces
+    frames = [b'hello', b'', b'x' * (4 * 1024 * 1024)] + [
+        ('frame %d' % i).encode('ascii') for i in range(1000)]
+    for frame in frames:
+        left.send(frame)
+
+    loop.call_later(5, loop.stop)
+    loop.run_forever()
+    loop.close()
+
+    assert received == frames
+    # The other end closing is noticed too
+    assert closed == [True]
+
+
+def test_batcher():
+    loop = asyncio.new_event_loop()
+    left_sock, right_sock = channel_pair()
+
+    batches = []
+    left = Channel(left_sock, loop, on_frame=lambda frame: None)
+    right = Channel(
+        right_sock, loop, on_frame=lambda frame: batches.append(
+            json.loads(frame.decode('utf-8'))))
+    right.start()
+
+    batcher = Batcher(
+        left, lambda items: json.dumps(items).encode('utf-8'), max_items=4)
+
+    # Everything added in one turn of the loop goes out together,
+    # bar the batches that fill up along the way
+    for i in range(10):
+        batcher.add(i)
+
+    loop.call_later(.05, loop.stop)
+    loop.run_forever()
+
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert batcher.batches_sent == 3
+    assert batcher.items_sent == 10
+
+    left.close()
+    right.close()
+    loop.close()
@@ -15,13 +15,75 @@ def test_lotsamessages():
     assert lotsamessages.main(num_experiments=20, num_steps=20) is True
 
 
-## Commenting out for now due to Travis issue:
-##   https://github.com/travis-ci/travis-cookbooks/issues/155
-## easier than researching a workaround ;p
-#
-# def test_lotsamessages_ihc():
-#     """
-#     Test the lotsamessages demo with inter-hive communication
-#     """
-#     assert lotsamessages.main(
-#         num_experiments=20, num_steps=20, subprocesses=4) is True
+def test_lotsamessages_ihc():
+    """
+    Test the lotsamessages demo with inter-hive communication
+    """
+    assert lotsamessages.main(
+        num_experiments=20, num_steps=20, subprocesses=4) is True
+
+
+def test_lotsamessages_cross_process():
+    """
+    Test the lotsamessages demo with every errand going between hives
+    """
+    assert lotsamessages.main(
+        num_experiments=20, num_steps=20, subprocesses=2,
+        cross_process=True, timing=True) is True
+
+
+def test_lotsamessages_shared_memory():
+    """
+    Test the lotsamessages demo with the hives talking through shared
+    memory
+    """
+    assert lotsamessages.main(
+        num_experiments=20, num_steps=20, subprocesses=2,
+        cross_process=True, shared_memory=True) is True
+
+
+def test_hive_benchmark():
+    """
+    Make sure the hive benchmark runs (on a very small workload)
+    """
+    from xudd.demos import hive_benchmark
+
+    for label, hive_class in hive_benchmark.BENCHMARK_HIVES:
+        num_messages, elapsed = hive_benchmark.run_benchmark(
+            hive_class, num_pairs=2, num_steps=10)
+        assert num_messages == 40
+
+
+def test_message_benchmark():
+    """
+    Make sure the message memory benchmark runs (on not very many messages)
+    """
+    from xudd.demos import message_benchmark
+
+    for label, message_class in message_benchmark.BENCHMARK_CLASSES:
+        allocated, allocations, elapsed = message_benchmark.run_benchmark(
+            message_class, num_messages=100)
+        assert allocated > 0
+
+
+def test_routing_benchmark():
+    """
+    Make sure the routing benchmark runs (on a very small workload)
+    """
+    from xudd.demos import routing_benchmark
+
+    trie_elapsed, regex_elapsed = routing_benchmark.run_lookup_benchmark(
+        num_routes=20, num_lookups=100)
+    assert trie_elapsed > 0 and regex_elapsed > 0
+    assert routing_benchmark.run_dispatch_benchmark(
+        num_routes=20, num_requests=200, concurrency=10) > 0
+
+
+def test_wsgi_benchmark():
+    """
+    Make sure the WSGI benchmark runs (on not very many requests)
+    """
+    from xudd.demos import wsgi_benchmark
+
+    assert wsgi_benchmark.run_benchmark(
+        num_requests=200, concurrency=10) > 0
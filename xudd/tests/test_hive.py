@@ -0,0 +1,274 @@
+import asyncio
+
+from xudd import tools
+from xudd.hive import Hive
+from xudd.actor import Actor
+
+
+def run_once(loop):
+    """
+    Run everything that's currently ready to go on the loop, once.
+    """
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+
+
+class Counter(Actor):
+    def __init__(self, hive, id):
+        super(Counter, self).__init__(hive, id)
+        self.message_routing.update(
+            {"count": self.count,
+             "explode": self.explode})
+        self.counted = 0
+
+    def count(self, message):
+        self.counted += 1
+
+    def explode(self, message):
+        raise RuntimeError("kaboom")
+
+
+def test_run_queue_batches():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop, batch_size=10)
+    counter_id = hive.create_actor(Counter)
+    counter = hive._actor_registry[counter_id.local_id]
+
+    for i in range(25):
+        hive.send_message(to=counter_id, directive="count")
+
+    run_once(loop)
+    assert counter.counted == 10
+    run_once(loop)
+    assert counter.counted == 20
+    run_once(loop)
+    assert counter.counted == 25
+    assert not hive._drain_scheduled
+    loop.close()
+
+
+def test_run_queue_survives_errors():
+    loop = asyncio.new_event_loop()
+    loop.set_exception_handler(lambda loop, context: None)
+    hive = Hive(loop=loop)
+    counter_id = hive.create_actor(Counter)
+    counter = hive._actor_registry[counter_id.local_id]
+
+    hive.send_message(to=counter_id, directive="explode")
+    hive.send_message(to=counter_id, directive="count")
+
+    run_once(loop)
+    run_once(loop)
+    assert counter.counted == 1
+    loop.close()
+
+
+class Recorder(Actor):
+    def __init__(self, hive, id, log):
+        super(Recorder, self).__init__(hive, id)
+        self.message_routing.update(
+            {"record": self.record})
+        self.log = log
+
+    def record(self, message):
+        self.log.append((self.local_id, message.body["n"]))
+
+
+def test_round_robin_scheduling():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop, max_messages=2)
+    log = []
+    chatty = hive.create_actor(Recorder, id="chatty", log=log)
+    quiet = hive.create_actor(Recorder, id="quiet", log=log)
+
+    for i in range(6):
+        hive.send_message(to=chatty, directive="record", body={"n": i})
+    hive.send_message(to=quiet, directive="record", body={"n": 0})
+
+    assert hive.queue_depths()[chatty] == 6
+    assert hive.queue_depths()[quiet] == 1
+
+    run_once(loop)
+
+    # The quiet actor doesn't have to wait for the chatty one to
+    # get through everything
+    assert log == [
+        ("chatty", 0), ("chatty", 1),
+        ("quiet", 0),
+        ("chatty", 2), ("chatty", 3),
+        ("chatty", 4), ("chatty", 5)]
+    assert hive.queue_depths()[chatty] == 0
+    loop.close()
+
+
+def test_message_ids():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    other_hive = Hive(loop=loop)
+
+    message_id = hive.gen_message_id()
+    assert isinstance(message_id, int)
+    assert hive.gen_message_id() == message_id + 1
+
+    # Message ids get qualified on their way out of the hive...
+    qualified = hive.qualify_message_id(message_id)
+    assert qualified == u"%s:%s" % (hive.message_uuid, message_id)
+    assert other_hive.qualify_message_id(message_id) != qualified
+    assert hive.qualify_message_id(qualified) == qualified
+    assert hive.qualify_message_id(None) is None
+
+    # ... and come back as the same local id
+    assert hive.localize_message_id(qualified) == message_id
+    # but other hives' ids are left alone
+    assert other_hive.localize_message_id(qualified) == qualified
+    assert hive.localize_message_id(None) is None
+    loop.close()
+
+
+class Ambassador(Actor):
+    def __init__(self, hive, id, forwarded):
+        super(Ambassador, self).__init__(hive, id)
+        self.message_routing.update(
+            {"forward_message": self.forward_message})
+        self.forwarded = forwarded
+
+    def forward_message(self, message):
+        self.forwarded.append(message.body["to"])
+
+
+def test_routing_doesnt_intern_ids():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    forwarded = []
+    ambassador = hive.create_actor(Ambassador, forwarded=forwarded)
+    hive.send_message(
+        to=hive.id, directive="register_ambassador",
+        from_id=ambassador, body={"hive_id": "elsewhere"})
+    run_once(loop)
+
+    # Messages to other hives' actors, and to actors that don't exist,
+    # shouldn't leave their ids behind
+    remote_id = "someone@elsewhere"
+    missing_id = tools.join_id("nobody", hive.hive_id)
+    hive.send_message(to=remote_id, directive="hello")
+    hive.send_message(to=missing_id, directive="hello")
+    run_once(loop)
+
+    assert forwarded == [remote_id]
+    assert remote_id not in tools._actor_refs
+    assert missing_id not in tools._actor_refs
+    loop.close()
+
+
+class Asker(Actor):
+    def __init__(self, hive, id, log):
+        super(Asker, self).__init__(hive, id)
+        self.message_routing.update(
+            {"ask": self.ask,
+             "record": self.record,
+             "answer": self.answer})
+        self.log = log
+
+    def ask(self, message):
+        response = yield self.wait_on_message(
+            to=message.body["to"], directive="answer")
+        self.log.append(("answered", response.body["n"]))
+
+    def answer(self, message):
+        # Before we answer, sneak another message into the asker's mailbox
+        self.hive.send_message(
+            to=message.from_id, directive="record", body={"n": "first"})
+        message.reply({"n": 42})
+
+    def record(self, message):
+        self.log.append(("recorded", message.body["n"]))
+
+
+def test_reply_fast_path():
+    for reply_fast_path in (True, False):
+        loop = asyncio.new_event_loop()
+        hive = Hive(loop=loop, reply_fast_path=reply_fast_path)
+        log = []
+        asker = hive.create_actor(Asker, log=log)
+        answerer = hive.create_actor(Asker, log=log)
+
+        hive.send_message(
+            to=asker, directive="ask", body={"to": answerer})
+        run_once(loop)
+
+        # Either way, the reply doesn't jump the queue
+        assert log == [("recorded", "first"), ("answered", 42)]
+        assert hive._actor_registry[asker.local_id]._waiting_coroutines == {}
+        loop.close()
+
+
+class Ticker(Actor):
+    def __init__(self, hive, id):
+        super(Ticker, self).__init__(hive, id)
+        self.message_routing.update(
+            {"tick": self.tick,
+             "nap": self.nap})
+        self.ticks = []
+        # Cancel this (a send_every() handle) after so many ticks
+        self.recurrence = None
+        self.max_ticks = None
+
+    def tick(self, message):
+        self.ticks.append(self.hive.loop.time())
+        if len(self.ticks) == self.max_ticks:
+            self.recurrence.cancel()
+            # Give any stray ticks a chance to turn up
+            self.hive.loop.call_later(.1, self.hive.loop.stop)
+
+    def nap(self, message):
+        start = self.hive.loop.time()
+        yield self.wait_on_self(message.body["delay"])
+        self.ticks.append(self.hive.loop.time() - start)
+        self.hive.send_shutdown()
+
+
+def test_send_after():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ticker_id = hive.create_actor(Ticker)
+    ticker = hive._actor_registry[ticker_id.local_id]
+
+    start = loop.time()
+    hive.send_after(.02, to=ticker_id, directive="tick")
+    scheduled = hive.send_after(.01, to=ticker_id, directive="tick")
+    scheduled.cancel()
+    loop.call_later(.05, loop.stop)
+    loop.run_forever()
+
+    assert len(ticker.ticks) == 1
+    assert ticker.ticks[0] - start >= .02
+    loop.close()
+
+
+def test_send_every():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ticker_id = hive.create_actor(Ticker)
+    ticker = hive._actor_registry[ticker_id.local_id]
+
+    ticker.recurrence = hive.send_every(.02, to=ticker_id, directive="tick")
+    ticker.max_ticks = 5
+    loop.run_forever()
+
+    # Five ticks, in order, before it was cancelled, and none after
+    assert len(ticker.ticks) == 5
+    assert ticker.ticks == sorted(ticker.ticks)
+    loop.close()
+
+
+def test_wait_on_self_delay():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ticker_id = hive.create_actor(Ticker)
+    ticker = hive._actor_registry[ticker_id.local_id]
+
+    hive.send_message(to=ticker_id, directive="nap", body={"delay": .02})
+    hive.run()
+
+    assert ticker.ticks[0] >= .02
+    loop.close()
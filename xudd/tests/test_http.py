@@ -0,0 +1,380 @@
+import asyncio
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.tcp import ConnectionServer
+from xudd.lib.http import (
+    HTTP, HTTPRequestParser, HTTPParseError, BodyChunk)
+
+
+PIPELINED = (
+    b'GET /first HTTP/1.1\r\nHost: example.org\r\n\r\n'
+    b'POST /second HTTP/1.1\r\nHost: example.org\r\n'
+    b'Content-Type: application/x-www-form-urlencoded\r\n'
+    b'Content-Length: 7\r\n\r\na=1&b=2'
+    b'GET /third HTTP/1.0\r\n\r\n')
+
+
+def test_parser_pipelined():
+    parser = HTTPRequestParser()
+    requests = parser.feed(PIPELINED)
+
+    assert [r['uri'] for r in requests] == ['/first', '/second', '/third']
+    assert requests[1]['method'] == 'POST'
+    assert requests[1]['body'] == b'a=1&b=2'
+    assert requests[1]['headers']['Host'] == 'example.org'
+    assert [r['keep_alive'] for r in requests] == [True, True, False]
+
+
+def test_parser_partial_reads():
+    parser = HTTPRequestParser()
+    requests = []
+    # One byte at a time is about as partial as reads get
+    for i in range(len(PIPELINED)):
+        requests.extend(parser.feed(PIPELINED[i:i + 1]))
+
+    assert [r['uri'] for r in requests] == ['/first', '/second', '/third']
+    assert requests[1]['body'] == b'a=1&b=2'
+
+
+def test_parser_errors():
+    def status(data, **kwargs):
+        try:
+            HTTPRequestParser(**kwargs).feed(data)
+        except HTTPParseError as exc:
+            return exc.status
+
+    assert status(b'nonsense\r\n\r\n').startswith('400')
+    assert status(b'GET / SPDY/3\r\n\r\n').startswith('505')
+    assert status(
+        b'POST / HTTP/1.1\r\nContent-Length: 100\r\n\r\n',
+        max_body_size=10).startswith('413')
+    assert status(
+        b'GET / HTTP/1.1\r\nX-Junk: ' + b'x' * 100,
+        max_header_size=50).startswith('431')
+
+
+def test_parser_streaming():
+    parser = HTTPRequestParser(stream_bodies_over=8, max_body_size=10)
+    upload = (b'PUT /upload HTTP/1.1\r\nContent-Length: 20\r\n'
+              b'Expect: 100-continue\r\n\r\n')
+
+    items = parser.feed(upload)
+    assert len(items) == 1
+    assert items[0]['streaming'] and items[0]['body'] is None
+    assert parser.needs_continue
+
+    # (HTTP/1.0 clients don't get one, since they don't know what it is)
+    old_parser = HTTPRequestParser(stream_bodies_over=8)
+    old_parser.feed(upload.replace(b'HTTP/1.1', b'HTTP/1.0'))
+    assert not old_parser.needs_continue
+
+    # Body data that's all body is handed over as is
+    data = b'0123456789'
+    items = parser.feed(data)
+    assert isinstance(items[0], BodyChunk) and items[0].data is data
+    assert not items[0].final
+
+    # ... and the rest of the body runs right into the next request
+    items = parser.feed(b'abcdefghij' + PIPELINED[:10])
+    assert items[0].data == b'abcdefghij' and items[0].final
+    items = parser.feed(PIPELINED[10:])
+    assert [r['uri'] for r in items] == ['/first', '/second', '/third']
+    assert not any(r['streaming'] for r in items)
+
+
+class Greeter(Actor):
+    def __init__(self, hive, id, seen):
+        super(Greeter, self).__init__(hive, id)
+        self.message_routing.update(
+            {"handle_request": self.handle_request})
+        self.seen = seen
+
+    def handle_request(self, message):
+        options = message.body['options']
+        self.seen.append((options['uri'], message.body['arguments']))
+        body = 'Hello from {0}'.format(options['uri']).encode('ascii')
+        message.reply(
+            directive='respond',
+            body={'response': b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n'
+                              b'\r\n%s' % (len(body), body)})
+
+
+class Starter(Actor):
+    def __init__(self, hive, id, greeter, ports):
+        super(Starter, self).__init__(hive, id)
+        self.message_routing.update({"start": self.start})
+        self.greeter = greeter
+        self.ports = ports
+
+    async def start(self, message):
+        http = self.hive.create_actor(HTTP, request_handler=self.greeter)
+        server = self.hive.create_actor(ConnectionServer, handler=http)
+        listening = await self.ask(server, "listen", {"port": 0})
+        self.ports.append(listening.body["port"])
+
+
+def test_keep_alive_and_pipelining():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    seen = []
+    ports = []
+    greeter = hive.create_actor(Greeter, seen=seen)
+    starter = hive.create_actor(Starter, greeter=greeter, ports=ports)
+    hive.send_message(to=starter, directive="start")
+
+    async def client():
+        while not ports:
+            await asyncio.sleep(.001)
+        reader, writer = await asyncio.open_connection('127.0.0.1', ports[0])
+
+        # Three requests on one connection, dribbled in
+        for i in range(0, len(PIPELINED), 10):
+            writer.write(PIPELINED[i:i + 10])
+            await asyncio.sleep(0)
+
+        # The last one was HTTP/1.0 without keep-alive, so we should
+        # get all three responses and then be hung up on
+        response = await reader.read()
+        writer.close()
+        hive.send_shutdown()
+        return response
+
+    task = loop.create_task(client())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    response = task.result()
+    assert response.count(b'HTTP/1.1 200 OK') == 3
+    assert response.index(b'/first') < response.index(b'/second') \
+        < response.index(b'/third')
+    assert response.count(b'Connection: keep-alive') == 2
+    assert response.count(b'Connection: close') == 1
+    assert seen == [
+        ('/first', {}),
+        ('/second', {'a': [b'1'], 'b': [b'2']}),
+        ('/third', {})]
+    loop.close()
+
+
+class HelloWorld(Actor):
+    """
+    Says hello world to everything (even when it shouldn't be saying
+    anything at all).
+    """
+    def __init__(self, hive, id):
+        super(HelloWorld, self).__init__(hive, id)
+        self.message_routing.update(
+            {"handle_request": self.handle_request})
+
+    def handle_request(self, message):
+        if message.body['options']['uri'] == '/silent':
+            # Leave it to the autoreply
+            return
+        elif message.body['options']['uri'] == '/nothing':
+            status = '204 No Content'
+        else:
+            status = '200 OK'
+        response = {'status': status,
+                    'headers': [('Content-Type', 'text/plain')],
+                    'body': b'hello world'}
+
+        if message.body['options']['uri'] == '/slow':
+            message.defer_reply()
+            self.hive.loop.call_later(
+                .02, lambda: message.reply(directive='respond', body=response))
+            return
+        message.reply(directive='respond', body=response)
+
+
+def test_bodiless_responses():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ports = []
+    hello_world = hive.create_actor(HelloWorld)
+    starter = hive.create_actor(Starter, greeter=hello_world, ports=ports)
+    hive.send_message(to=starter, directive="start")
+
+    async def client():
+        while not ports:
+            await asyncio.sleep(.001)
+        reader, writer = await asyncio.open_connection('127.0.0.1', ports[0])
+        writer.write(
+            b'HEAD / HTTP/1.1\r\n\r\n'
+            b'GET / HTTP/1.1\r\n\r\n'
+            b'GET /nothing HTTP/1.1\r\n\r\n'
+            b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        hive.send_shutdown()
+        return response
+
+    task = loop.create_task(client())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    # The HEAD response says how long the body would be, but doesn't
+    # send it, so the GET's response comes straight after it
+    assert task.result() == (
+        b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+        b'Content-Length: 11\r\nConnection: keep-alive\r\n\r\n'
+        b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+        b'Content-Length: 11\r\nConnection: keep-alive\r\n\r\n'
+        b'hello world'
+        b'HTTP/1.1 204 No Content\r\nContent-Type: text/plain\r\n'
+        b'Connection: keep-alive\r\n\r\n'
+        b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+        b'Content-Length: 11\r\nConnection: close\r\n\r\n'
+        b'hello world')
+    loop.close()
+
+
+def test_continue_waits_its_turn():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ports = []
+    hello_world = hive.create_actor(HelloWorld)
+    starter = hive.create_actor(Starter, greeter=hello_world, ports=ports)
+    hive.send_message(to=starter, directive="start")
+
+    async def client():
+        while not ports:
+            await asyncio.sleep(.001)
+        reader, writer = await asyncio.open_connection('127.0.0.1', ports[0])
+        writer.write(
+            b'GET /slow HTTP/1.1\r\n\r\n'
+            b'POST / HTTP/1.1\r\nContent-Length: 5\r\n'
+            b'Expect: 100-continue\r\n\r\n')
+        before_continue = await reader.readuntil(b'100 Continue\r\n\r\n')
+        writer.write(b'hello'
+                     b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n')
+        response = before_continue + await reader.read()
+        writer.close()
+        hive.send_shutdown()
+        return response
+
+    task = loop.create_task(client())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    # The "100 Continue" doesn't jump ahead of the slow response
+    hello = (b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n'
+             b'Content-Length: 11\r\nConnection: keep-alive\r\n\r\n'
+             b'hello world')
+    assert task.result() == (
+        hello + b'HTTP/1.1 100 Continue\r\n\r\n' + hello
+        + hello.replace(b'keep-alive', b'close'))
+    loop.close()
+
+
+def test_unanswered_request():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ports = []
+    hello_world = hive.create_actor(HelloWorld)
+    starter = hive.create_actor(Starter, greeter=hello_world, ports=ports)
+    hive.send_message(to=starter, directive="start")
+
+    async def client():
+        while not ports:
+            await asyncio.sleep(.001)
+        reader, writer = await asyncio.open_connection('127.0.0.1', ports[0])
+        writer.write(b'GET /silent HTTP/1.1\r\nConnection: close\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        hive.send_shutdown()
+        return response
+
+    task = loop.create_task(client())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    assert task.result().startswith(b'HTTP/1.1 500 Internal Server Error')
+    loop.close()
+
+
+class Uploadee(Actor):
+    """
+    Takes its time over streamed uploads, keeping track of how many
+    chunks it's been juggling at once.
+    """
+    def __init__(self, hive, id, uploads):
+        super(Uploadee, self).__init__(hive, id)
+        self.message_routing.update(
+            {"handle_request": self.handle_request,
+             "handle_request_chunk": self.handle_request_chunk})
+        self.uploads = uploads
+        self.requests = {}
+        self.busy = 0
+        self.most_busy = 0
+
+    def handle_request(self, message):
+        assert message.body['streaming']
+        message.defer_reply()
+        self.requests[message.id] = (message, [])
+
+    async def handle_request_chunk(self, message):
+        self.busy += 1
+        self.most_busy = max(self.most_busy, self.busy)
+        await asyncio.sleep(.001)
+        self.busy -= 1
+
+        request, chunks = self.requests[message.body['request']]
+        chunks.append(message.body['chunk'])
+        if message.body['final']:
+            self.uploads.append(b''.join(chunks))
+            request.reply(
+                directive='respond',
+                body={'response': b'HTTP/1.1 201 Created\r\n'
+                                  b'Content-Length: 0\r\n\r\n'})
+
+
+class UploadStarter(Actor):
+    def __init__(self, hive, id, uploadee, ports):
+        super(UploadStarter, self).__init__(hive, id)
+        self.message_routing.update({"start": self.start})
+        self.uploadee = uploadee
+        self.ports = ports
+
+    async def start(self, message):
+        http = self.hive.create_actor(
+            HTTP, request_handler=self.uploadee,
+            stream_bodies_over=1024, max_chunks_in_flight=2)
+        server = self.hive.create_actor(ConnectionServer, handler=http)
+        listening = await self.ask(server, "listen", {"port": 0})
+        self.ports.append(listening.body["port"])
+
+
+def test_streaming_upload():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    uploads = []
+    ports = []
+    uploadee_id = hive.create_actor(Uploadee, uploads=uploads)
+    uploadee = hive._actor_registry[uploadee_id.local_id]
+    starter = hive.create_actor(
+        UploadStarter, uploadee=uploadee_id, ports=ports)
+    hive.send_message(to=starter, directive="start")
+
+    upload = bytes(range(256)) * 4096  # 1M
+
+    async def client():
+        while not ports:
+            await asyncio.sleep(.001)
+        reader, writer = await asyncio.open_connection('127.0.0.1', ports[0])
+        writer.write(b'PUT /upload HTTP/1.1\r\nContent-Length: %d\r\n'
+                     b'Connection: close\r\n\r\n' % len(upload))
+        writer.write(upload)
+        response = await reader.read()
+        writer.close()
+        hive.send_shutdown()
+        return response
+
+    task = loop.create_task(client())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    assert task.result().startswith(b'HTTP/1.1 201 Created')
+    assert uploads == [upload]
+    assert uploadee.most_busy <= 2
+    loop.close()
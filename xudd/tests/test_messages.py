@@ -51,3 +51,39 @@ def test_message_to_dict():
     assert dict_message["wants_reply"] == False
     assert dict_message["in_reply_to"] == "catch-ball-message-id"
 
+
+
+def test_message_empty_body():
+    from xudd.message import EMPTY_BODY
+
+    message = Message(
+        to="to-uuid",
+        directive="reply",
+        from_id="from-uuid",
+        in_reply_to="catch-ball-message-id",
+        id="caught-ball-message-id")
+
+    # Bodyless messages all share the same immutable empty body
+    assert message.body is EMPTY_BODY
+    assert message.body == {}
+    try:
+        message.body["sneaky"] = "change"
+    except TypeError:
+        pass
+    else:
+        assert False, "EMPTY_BODY should be immutable"
+    assert EMPTY_BODY == {}
+
+    # ... but it still round trips as a plain old empty dict
+    dict_message = message.to_dict()
+    assert dict_message["body"] == {}
+    assert Message.from_dict(dict_message).body is EMPTY_BODY
+
+
+def test_message_slots():
+    message = Message(
+        to="to-uuid",
+        directive="catch_ball",
+        from_id="from-uuid",
+        id="catch-ball-message-id")
+    assert not hasattr(message, "__dict__")
@@ -0,0 +1,13 @@
+import json
+
+from xudd.lib.multiprocess import _encode_batch
+
+
+def test_encode_batch():
+    messages = [
+        {"to": "a@b", "directive": "ok", "body": {"data": [1, 2]}},
+        {"to": "a@b", "directive": "not_ok", "body": {"data": b"\x00"}},
+        {"to": "a@b", "directive": "also_ok", "body": None}]
+    # Whatever can't be sent is left out, rather than the whole batch
+    assert json.loads(_encode_batch(messages)) == [messages[0], messages[2]]
+    assert json.loads(_encode_batch(messages[:1])) == messages[:1]
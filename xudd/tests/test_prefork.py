@@ -0,0 +1,77 @@
+import asyncio
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.prefork import Supervisor
+
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'Hello World!']
+
+
+class Prober(Actor):
+    def __init__(self, hive, id, results):
+        super(Prober, self).__init__(hive, id)
+        self.message_routing.update({"run": self.run})
+        self.results = results
+
+    async def run(self, message):
+        supervisor = self.results["supervisor"] = self.hive.create_actor(
+            Supervisor, app=app, workers=2, port=0,
+            stats_interval=.05, check_interval=.05)
+        started = await self.ask(supervisor, "start")
+        port = started.body["port"]
+
+        try:
+            for i in range(10):
+                reader, writer = await self._connect(port)
+                writer.write(b'GET / HTTP/1.1\r\nHost: localhost\r\n'
+                             b'Connection: close\r\n\r\n')
+                self.results.setdefault("responses", []).append(
+                    await reader.read())
+                writer.close()
+
+            # Wait for the workers to tell us about them
+            for i in range(100):
+                stats = (await self.ask(supervisor, "get_stats")).body
+                if stats["requests"] == 10:
+                    break
+                await asyncio.sleep(.05)
+            self.results["stats"] = stats
+        finally:
+            self.send_message(to=supervisor, directive="stop")
+
+    async def _connect(self, port):
+        for i in range(100):
+            try:
+                return await asyncio.open_connection('127.0.0.1', port)
+            except OSError:
+                await asyncio.sleep(.05)
+
+
+def test_prefork():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    results = {}
+
+    tester = hive.create_actor(Prober, results=results)
+    hive.send_message(to=tester, directive="run")
+    hive.run()
+
+    responses, stats = results["responses"], results["stats"]
+    assert len(responses) == 10
+    for response in responses:
+        assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+        assert response.endswith(b'\r\n\r\nHello World!')
+
+    assert stats["workers"] == 2
+    assert stats["requests"] == 10
+    assert stats["in_flight"] == 0
+    assert sorted(stats["per_worker"]) == [0, 1]
+
+    # Stopping waited for the workers to go
+    supervisor = hive._actor_registry[results["supervisor"].local_id]
+    assert not any(
+        process.is_alive() for process in supervisor.workers.values())
+    loop.close()
@@ -0,0 +1,193 @@
+import asyncio
+
+from xudd.hive import Hive
+from xudd.actor import Actor, MessageTimeout
+from xudd.tools import join_id
+from xudd.lib.remote import RemoteAmbassador, RemoteHiveListener
+
+
+class Echo(Actor):
+    def __init__(self, hive, id):
+        super(Echo, self).__init__(hive, id)
+        self.message_routing.update({"echo": self.echo})
+
+    def echo(self, message):
+        message.reply({"echoed": message.body["data"]})
+
+
+class Host(Actor):
+    """
+    Starts up a RemoteHiveListener, and lets the test know where.
+    """
+    def __init__(self, hive, id, results, listen_body, **listener_kwargs):
+        super(Host, self).__init__(hive, id)
+        self.message_routing.update({"start": self.start})
+        self.results = results
+        self.listen_body = listen_body
+        self.listener_kwargs = listener_kwargs
+
+    async def start(self, message):
+        self.results["listener"] = self.hive.create_actor(
+            RemoteHiveListener, **self.listener_kwargs)
+        listening = await self.ask(
+            self.results["listener"], "listen", self.listen_body)
+        self.results["address"].set_result(listening.body["address"])
+
+
+class Caller(Actor):
+    """
+    Connects one hive to another, and has a chat with an Echo over
+    there, with the connection dropping out in the middle of it.
+    """
+    def __init__(self, hive, id, results, echo, drop_connection):
+        super(Caller, self).__init__(hive, id)
+        self.message_routing.update({"start": self.start})
+        self.results = results
+        self.echo = echo
+        self.drop_connection = drop_connection
+
+    async def start(self, message):
+        try:
+            address = await self.results["address"]
+            ambassador = self.hive.create_actor(
+                RemoteAmbassador, address=address, reconnect_delay=.01)
+            self.results["ambassador"] = ambassador
+            connected = await self.ask(ambassador, "connect")
+            self.results["remote_hive_id"] = connected.body["hive_id"]
+
+            reply = await self.ask(self.echo, "echo", {"data": b"hello"})
+            self.results["echoes"] = [reply.body["echoed"]]
+
+            # Pull the plug; these have to wait until we've reconnected
+            self.drop_connection(ambassador)
+            replies = await asyncio.gather(*[
+                self.ask(self.echo, "echo", {"data": i}, timeout=5)
+                for i in range(100)])
+            self.results["echoes"].extend(
+                reply.body["echoed"] for reply in replies)
+        except Exception as exc:
+            self.results["error"] = exc
+        finally:
+            self.hive.send_shutdown()
+
+
+def _run_pair(listen_body):
+    loop = asyncio.new_event_loop()
+    # Two independent hives, which happen to share a loop
+    hive = Hive(loop=loop)
+    other_hive = Hive(loop=loop)
+
+    results = {"address": loop.create_future()}
+    host = other_hive.create_actor(
+        Host, results=results, listen_body=listen_body)
+    other_hive.send_message(to=host, directive="start")
+    echo = other_hive.create_actor(Echo)
+
+    def drop_connection(ambassador_id):
+        ambassador = hive._actor_registry[ambassador_id.local_id]
+        ambassador.connection.transport.abort()
+
+    caller = hive.create_actor(
+        Caller, results=results, echo=echo,
+        drop_connection=drop_connection)
+    hive.send_message(to=caller, directive="start")
+
+    loop.call_later(10, loop.stop)
+    hive.run()
+
+    if "error" in results:
+        raise results["error"]
+
+    assert results["remote_hive_id"] == other_hive.hive_id
+    assert results["echoes"] == [b"hello"] + list(range(100))
+
+    # Each side has an ambassador registered for the other
+    assert hive._ambassadors[other_hive.hive_id] == results["ambassador"]
+    listener = other_hive._actor_registry[results["listener"].local_id]
+    assert other_hive._ambassadors[hive.hive_id] == \
+        listener.ambassadors[hive.hive_id]
+    # ... and the same one was used again after reconnecting
+    assert len(listener.ambassadors) == 1
+
+    loop.close()
+
+
+def test_remote_ambassador_tcp():
+    _run_pair({"host": "127.0.0.1", "port": 0})
+
+
+def test_remote_ambassador_unix_socket(tmp_path):
+    _run_pair({"path": str(tmp_path / "hive.sock")})
+
+
+class Intruder(Actor):
+    """
+    Connects to another hive and tries its luck.
+    """
+    def __init__(self, hive, id, results, echo):
+        super(Intruder, self).__init__(hive, id)
+        self.message_routing.update({"start": self.start})
+        self.results = results
+        self.echo = echo
+
+    async def start(self, message):
+        try:
+            address = await self.results["address"]
+            ambassador = self.hive.create_actor(
+                RemoteAmbassador, address=address)
+            connected = await self.ask(ambassador, "connect")
+            other_hive = join_id("hive", connected.body["hive_id"])
+
+            try:
+                await self.ask(
+                    other_hive, "create_actor",
+                    {"class": "xudd.tests.test_remote:Echo"}, timeout=.1)
+            except MessageTimeout:
+                self.results["create_actor"] = "dropped"
+
+            reply = await self.ask(self.echo, "echo", {"data": b"hello"})
+            self.results["echoed"] = reply.body["echoed"]
+        except Exception as exc:
+            self.results["error"] = exc
+        finally:
+            self.hive.send_shutdown()
+
+
+def test_remote_allowed_directives():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    other_hive = Hive(loop=loop)
+
+    results = {"address": loop.create_future()}
+    host = other_hive.create_actor(
+        Host, results=results, listen_body={"port": 0},
+        allowed_directives=["echo"])
+    other_hive.send_message(to=host, directive="start")
+    echo = other_hive.create_actor(Echo)
+    actor_count = len(other_hive._actor_registry)
+
+    intruder = hive.create_actor(Intruder, results=results, echo=echo)
+    hive.send_message(to=intruder, directive="start")
+    loop.call_later(10, loop.stop)
+    hive.run()
+
+    if "error" in results:
+        raise results["error"]
+    assert results["create_actor"] == "dropped"
+    assert results["echoed"] == b"hello"
+    # (The listener and the ambassador it made, but nothing else)
+    assert len(other_hive._actor_registry) == actor_count + 2
+    loop.close()
+
+
+def test_encode_batch():
+    import msgpack
+    from xudd.lib.remote import _encode_batch
+
+    messages = [
+        {"to": "a@b", "directive": "ok", "body": {"data": b"\x00\x01"}},
+        {"to": "a@b", "directive": "not_ok", "body": {"data": object()}},
+        {"to": "a@b", "directive": "also_ok", "body": None}]
+    # Whatever can't be sent is left out, rather than the whole batch
+    decoded = msgpack.unpackb(_encode_batch(messages), raw=False)
+    assert decoded == [messages[0], messages[2]]
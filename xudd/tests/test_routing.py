@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.routing import (
+    Router, RouteTrie, RouteError, METHOD_NOT_ALLOWED)
+
+
+def test_route_trie():
+    trie = RouteTrie()
+    trie.add('/', 'index')
+    trie.add('/users/me', 'me')
+    trie.add('/users/{user_id}', 'user')
+    trie.add('/users/{user_id}/posts/{post_id}', 'post', ['GET'])
+    trie.add('/static/{path:path}', 'static', ['GET'])
+    trie.add('/static/{path:path}', 'upload', ['PUT'])
+    trie.add('/a/{x}', 'a', ['POST'])
+    trie.add('/a/{y:path}', 'any_a')
+
+    def match(path, method='GET'):
+        route, params = trie.match(method, path)
+        if route is None or route is METHOD_NOT_ALLOWED:
+            return route, params
+        return route.next_target(), params
+
+    assert match('/') == ('index', {})
+    assert match('/users/me') == ('me', {})
+    assert match('/users/42/') == ('user', {'user_id': '42'})
+    assert match('/users/42/posts/7') == (
+        'post', {'user_id': '42', 'post_id': '7'})
+    assert match('/users/42/posts/7', 'POST') == (METHOD_NOT_ALLOWED, {})
+    assert match('/static/css/site.css') == (
+        'static', {'path': 'css/site.css'})
+    assert match('/static/css/site.css', 'PUT') == (
+        'upload', {'path': 'css/site.css'})
+    assert match('/static/css/site.css', 'DELETE') == (METHOD_NOT_ALLOWED, {})
+    assert match('/static') == (None, {})
+
+    # HEAD goes wherever GET does, unless it's routed itself
+    assert match('/users/42/posts/7', 'HEAD') == (
+        'post', {'user_id': '42', 'post_id': '7'})
+    assert match('/static/a', 'HEAD') == ('static', {'path': 'a'})
+
+    # The best match isn't for this method, but the next best is
+    assert match('/a/b', 'POST') == ('a', {'x': 'b'})
+    assert match('/a/b') == ('any_a', {'y': 'b'})
+
+    assert trie.allowed_methods('/static/a') == {'GET', 'HEAD', 'PUT'}
+    assert trie.allowed_methods('/users/42') == {None}
+    assert match('/users/42/comments') == (None, {})
+
+    with pytest.raises(RouteError):
+        trie.add('/users/{name}/friends', 'clash')
+    with pytest.raises(RouteError):
+        trie.add('/users/me', 'again')
+    with pytest.raises(RouteError):
+        trie.add('/files/{path:path}/edit', 'nope')
+    with pytest.raises(RouteError):
+        trie.add('/static/{path:path}', 'again', ['GET'])
+    with pytest.raises(RouteError):
+        trie.add('/static/{file:path}', 'clash', ['POST'])
+
+
+class Handler(Actor):
+    def __init__(self, hive, id, name):
+        super(Handler, self).__init__(hive, id)
+        self.message_routing.update({
+            'handle_request': self.handle_request,
+            'handle_request_chunk': self.handle_request_chunk})
+        self.name = name
+        self.chunks = []
+
+    def handle_request(self, message):
+        if message.body.get('streaming'):
+            message.defer_reply()
+            self.streaming = message
+            return
+        message.reply(directive='respond', body={
+            'handler': self.name,
+            'route': message.body['route'],
+            'params': message.body['route_params']})
+
+    def handle_request_chunk(self, message):
+        self.chunks.append(message.body['chunk'])
+        message.reply()
+        if message.body['final']:
+            self.streaming.reply(directive='respond', body={
+                'handler': self.name, 'body': b''.join(self.chunks)})
+
+
+def request(uri, method='GET', streaming=False):
+    return {'options': {'method': method, 'uri': uri, 'headers': {}},
+            'body': None if streaming else b'', 'streaming': streaming}
+
+
+class Client(Actor):
+    def __init__(self, hive, id, results):
+        super(Client, self).__init__(hive, id)
+        self.message_routing.update({"run": self.run})
+        self.results = results
+
+    async def run(self, message):
+        pool = [self.hive.create_actor(Handler, name='pool%d' % i)
+                for i in range(2)]
+        users = self.hive.create_actor(Handler, name='users')
+        router = self.hive.create_actor(Router, routes=[
+            ('/users/{user_id}', users, ['GET']),
+            ('/work/{job}', pool),
+        ])
+
+        for uri in ['/users/bob%20smith?x=1', '/work/a', '/work/b',
+                    '/work/c', '/nowhere']:
+            reply = await self.ask(router, 'handle_request', request(uri))
+            self.results.append(reply.body)
+
+        reply = await self.ask(
+            router, 'handle_request', request('/users/bob', 'DELETE'))
+        self.results.append(reply.body)
+
+        # A streamed upload's chunks follow it to the same handler
+        upload_id = self.hive.gen_message_id()
+        replies = await self.ask_all(
+            [dict(to=router, directive='handle_request', id=upload_id,
+                  body=request('/work/upload', 'PUT', streaming=True))]
+            + [dict(to=router, directive='handle_request_chunk',
+                    body={'request': upload_id, 'chunk': chunk,
+                          'final': final})
+               for chunk, final in [(b'abc', False), (b'def', True)]])
+        self.results.append(replies[0].body)
+
+        reply = await self.ask(
+            router, 'handle_request', request('/users/bob', 'HEAD'))
+        self.results.append(reply.body)
+
+        self.hive.send_shutdown()
+
+
+def test_router():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    results = []
+    client = hive.create_actor(Client, results=results)
+    hive.send_message(to=client, directive="run")
+    hive.run()
+
+    assert results[0] == {
+        'handler': 'users', 'route': '/users/{user_id}',
+        'params': {'user_id': 'bob smith'}}
+    assert [r['handler'] for r in results[1:4]] == ['pool0', 'pool1', 'pool0']
+    assert results[1]['params'] == {'job': 'a'}
+    assert results[4]['status'].startswith('404')
+    assert results[5]['status'].startswith('405')
+    assert ('Allow', 'GET, HEAD') in results[5]['headers']
+    assert results[6] == {'handler': 'pool1', 'body': b'abcdef'}
+    assert results[7]['handler'] == 'users'
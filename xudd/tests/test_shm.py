@@ -0,0 +1,100 @@
+import asyncio
+
+from xudd.lib.shm import (
+    RingBuffer, SharedMemoryChannel, shared_memory_channel_pair)
+
+
+def test_shared_memory_channel():
+    loop = asyncio.new_event_loop()
+    # A tiny ring, so we go round it plenty of times and fill it up
+    ours, theirs = shared_memory_channel_pair(capacity=4096)
+
+    received = []
+    closed = []
+
+    def on_frame(frame):
+        # (Only good for the duration of the call, so hang onto a copy)
+        received.append(bytes(frame))
+        if len(received) == len(frames):
+            right.close()
+
+    left = SharedMemoryChannel.create(
+        ours, loop, on_frame=lambda frame: None,
+        on_close=lambda: closed.append(True) or loop.stop())
+    right = SharedMemoryChannel.attach(theirs, loop, on_frame=on_frame)
+    # Nobody else needs to find the rings now
+    left.unlink()
+    left.start()
+    right.start()
+
+    # Small frames, an empty one, and one far too big for the ring, so
+    # it has to go in (and come out) in pieces
+    frames = [b'hello', b'', b'x' * 20000] + [
+        ('frame %d' % i).encode('ascii') for i in range(1000)]
+    for frame in frames:
+        left.send(frame)
+
+    loop.call_later(5, loop.stop)
+    loop.run_forever()
+    loop.close()
+
+    assert received == frames
+    # The other end closing is noticed too
+    assert closed == [True]
+
+
+def test_shared_memory_channel_flush_after_hangup():
+    loop = asyncio.new_event_loop()
+    ours, theirs = shared_memory_channel_pair(capacity=4096)
+    closed = []
+    channel = SharedMemoryChannel.create(
+        ours, loop, on_frame=lambda frame: None,
+        on_close=lambda: closed.append(True))
+    channel.start()
+
+    # More than fits in the ring, with nobody reading it, and then the
+    # other side goes away
+    for i in range(10):
+        channel.send(b'x' * 1000)
+    theirs[0].close()
+
+    # Flushing notices, and gives up (just the once)
+    channel.close(flush=True)
+    assert channel.closed
+    assert closed == [True]
+    loop.close()
+
+
+def test_ring_buffer():
+    ring = RingBuffer.create(capacity=64)
+    other_end = RingBuffer.attach(ring.name)
+    try:
+        assert ring.write(b'abc')
+        assert ring.write(b'defgh', more=True)
+        records = [(bytes(data), more) for data, more in other_end.read()]
+        assert records == [(b'abc', False), (b'defgh', True)]
+        assert list(other_end.read()) == []
+
+        # Fill it up...
+        assert ring.write(b'12345678')
+        assert ring.write(b'12345678')
+        assert ring.write(b'x' * 12)
+        # ... and there's no room until those are read
+        assert not ring.write(b'y' * 20)
+        assert not other_end.producer_waiting()
+        ring.set_waiting(True)
+
+        records = [bytes(data) for data, more in other_end.read()]
+        assert records == [b'12345678', b'12345678', b'x' * 12]
+        assert other_end.producer_waiting()
+        assert not other_end.producer_waiting()
+
+        # There's only 4 bytes left before the end of the ring, so
+        # this goes back round to the start
+        assert ring.write(b'y' * 20)
+        records = [bytes(data) for data, more in other_end.read()]
+        assert records == [b'y' * 20]
+        assert ring.head == other_end.tail == 64 + 24
+    finally:
+        other_end.close()
+        ring.close()
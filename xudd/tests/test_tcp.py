@@ -0,0 +1,257 @@
+import asyncio
+import socket
+
+import pytest
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.tcp import ConnectionServer, Server
+
+
+class Echoer(Actor):
+    """
+    Starts up a ConnectionServer, echoes back whatever it's sent, and
+    keeps track of what happened to each connection.
+    """
+    def __init__(self, hive, id, events):
+        super(Echoer, self).__init__(hive, id)
+        self.message_routing.update(
+            {"start": self.start,
+             "connection_made": self.connection_made,
+             "data_received": self.data_received,
+             "connection_lost": self.connection_lost})
+        self.events = events
+        self.server = None
+
+    async def start(self, message):
+        self.server = self.hive.create_actor(
+            ConnectionServer, handler=self.id)
+        listening = await self.ask(
+            self.server, "listen", {"port": 0})
+        self.events.append(("listening", listening.body["port"]))
+
+    def connection_made(self, message):
+        self.events.append(("made", message.body["connection"]))
+
+    def data_received(self, message):
+        data = message.body["data"]
+        if data == b"bye":
+            self.send_message(
+                to=self.server, directive="close",
+                body={"connection": message.body["connection"]})
+        else:
+            self.send_message(
+                to=self.server, directive="write",
+                body={"connection": message.body["connection"],
+                      "data": data})
+
+    def connection_lost(self, message):
+        self.events.append(("lost", message.body["connection"]))
+
+
+def test_connection_server():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    events = []
+    echoer_id = hive.create_actor(Echoer, events=events)
+    echoer = hive._actor_registry[echoer_id.local_id]
+    hive.send_message(to=echoer_id, directive="start")
+
+    async def talk(port):
+        clients = [await asyncio.open_connection("127.0.0.1", port)
+                   for i in range(3)]
+        echoed = []
+        for i, (reader, writer) in enumerate(clients):
+            writer.write(b"hello %d" % i)
+            echoed.append(await reader.readexactly(7))
+        for reader, writer in clients:
+            writer.write(b"bye")
+            # Server hangs up on us
+            assert await reader.read() == b""
+            writer.close()
+        return echoed
+
+    async def main():
+        while not events:
+            await asyncio.sleep(.001)
+        echoed = await talk(events[0][1])
+        # Give the server a moment to hear about the closes
+        for i in range(100):
+            if len(events) == 7:
+                break
+            await asyncio.sleep(.001)
+        hive.send_shutdown()
+        return echoed
+
+    task = loop.create_task(main())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    assert task.result() == [b"hello 0", b"hello 1", b"hello 2"]
+    assert sorted(e for e in events[1:] if e[0] == "made") == [
+        ("made", 1), ("made", 2), ("made", 3)]
+    assert sorted(e for e in events[1:] if e[0] == "lost") == [
+        ("lost", 1), ("lost", 2), ("lost", 3)]
+    server = hive._actor_registry[echoer.server.local_id]
+    assert server.connections == {}
+    loop.close()
+
+
+class Firehose(Actor):
+    """
+    Writes a lot more than the client is reading, waiting on the
+    server to say the buffer's drained in between.
+    """
+    def __init__(self, hive, id, log):
+        super(Firehose, self).__init__(hive, id)
+        self.message_routing.update(
+            {"start": self.start,
+             "connection_made": self.connection_made,
+             "data_received": self.ignore,
+             "connection_lost": self.ignore})
+        self.log = log
+        self.port = None
+
+    async def start(self, message):
+        server = self.hive.create_actor(
+            ConnectionServer, handler=self.id,
+            write_high_water=1024, write_low_water=512)
+        listening = await self.ask(server, "listen", {"port": 0})
+        self.port = listening.body["port"]
+
+    def connection_made(self, message):
+        server = message.from_id
+        connection = message.body["connection"]
+        for i in range(16):
+            yield self.wait_on_message(
+                to=server, directive="write",
+                body={"connection": connection, "data": b"x" * 1048576})
+            self.log.append(i)
+        self.send_message(
+            to=server, directive="close", body={"connection": connection})
+
+    def ignore(self, message):
+        pass
+
+
+class BrokenFile(object):
+    # Not a real file, so the server has to read it itself, and then
+    # it can't
+    def readinto(self, buffer):
+        raise OSError("Disk on fire")
+
+
+class FileSender(Actor):
+    """
+    Tries to send everyone who connects a file that can't be read.
+    """
+    def __init__(self, hive, id, events):
+        super(FileSender, self).__init__(hive, id)
+        self.message_routing.update(
+            {"start": self.start,
+             "connection_made": self.connection_made,
+             "data_received": self.ignore,
+             "connection_lost": self.connection_lost})
+        self.events = events
+
+    async def start(self, message):
+        server = self.hive.create_actor(ConnectionServer, handler=self.id)
+        listening = await self.ask(server, "listen", {"port": 0})
+        self.events.append(("listening", listening.body["port"]))
+
+    async def connection_made(self, message):
+        sent = await self.ask(
+            message.from_id, "sendfile",
+            {"connection": message.body["connection"], "file": BrokenFile()})
+        self.events.append(("sent", sent.body))
+
+    def connection_lost(self, message):
+        self.events.append(("lost", message.body["connection"]))
+
+    def ignore(self, message):
+        pass
+
+
+def test_connection_server_sendfile_failure():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    events = []
+    sender = hive.create_actor(FileSender, events=events)
+    hive.send_message(to=sender, directive="start")
+
+    async def main():
+        while not events:
+            await asyncio.sleep(.001)
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", events[0][1])
+        # The server hangs up on us rather than leaving us waiting
+        try:
+            received = await reader.read()
+        except ConnectionResetError:
+            received = b""
+        writer.close()
+        for i in range(100):
+            if len(events) == 3:
+                break
+            await asyncio.sleep(.001)
+        hive.send_shutdown()
+        return received
+
+    task = loop.create_task(main())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    assert task.result() == b""
+    assert sorted(events[1:]) == [("lost", 1), ("sent", {"closed": True})]
+    loop.close()
+
+
+def test_connection_server_backpressure():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    log = []
+    firehose_id = hive.create_actor(Firehose, log=log)
+    firehose = hive._actor_registry[firehose_id.local_id]
+    hive.send_message(to=firehose_id, directive="start")
+
+    async def slow_reader():
+        while firehose.port is None:
+            await asyncio.sleep(.001)
+
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(("127.0.0.1", firehose.port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+
+        # Don't read anything for a bit; the firehose should get stuck
+        # waiting for its writes to drain
+        await asyncio.sleep(.05)
+        stalled_at = list(log)
+
+        received = 0
+        while True:
+            data = await reader.read(1048576)
+            if not data:
+                break
+            received += len(data)
+        writer.close()
+        hive.send_shutdown()
+        return stalled_at, received
+
+    task = loop.create_task(slow_reader())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    stalled_at, received = task.result()
+    assert len(stalled_at) < 16
+    assert log == list(range(16))
+    assert received == 16 * 1048576
+    loop.close()
+
+
+def test_server_is_deprecated():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    with pytest.warns(DeprecationWarning):
+        hive.create_actor(Server)
+    loop.close()
@@ -37,3 +37,28 @@ def test_possibly_qualify_id():
     # If the actor_id is None, return None.
     assert tools.possibly_qualify_id(None, "hive") == None
     
+
+
+def test_actor_ref():
+    ref = tools.actor_ref(u"actor@hive")
+    assert isinstance(ref, tools.ActorRef)
+    assert ref.local_id == u"actor"
+    assert ref.hive_id == u"hive"
+
+    # Still looks just like the string it came from
+    assert ref == u"actor@hive"
+    assert hash(ref) == hash(u"actor@hive")
+    assert {u"actor@hive": "found it"}[ref] == "found it"
+    assert str(ref) == u"actor@hive"
+
+    # Refs are interned
+    assert tools.actor_ref(u"actor@hive") is ref
+    assert tools.actor_ref(ref) is ref
+    tools.release_actor_ref(ref)
+    assert tools.actor_ref(u"actor@hive") is not ref
+
+    unqualified = tools.actor_ref(u"actor")
+    assert unqualified.local_id == u"actor"
+    assert unqualified.hive_id is None
+
+    assert tools.actor_ref(None) is None
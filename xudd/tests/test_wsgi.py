@@ -0,0 +1,292 @@
+import asyncio
+import tempfile
+import threading
+
+from xudd.hive import Hive
+from xudd.actor import Actor
+from xudd.lib.tcp import ConnectionServer
+from xudd.lib.http import HTTP
+from xudd.lib.wsgi import WSGI
+
+
+def app(environ, start_response):
+    path = environ['PATH_INFO']
+
+    if path == '/small':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'Hello World!']
+
+    elif path == '/stream':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (b'line %d\n' % i for i in range(3))
+
+    elif path == '/file':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        fileobj = open(environ['test.filename'], 'rb')
+        fileobj.seek(5)
+        return environ['wsgi.file_wrapper'](fileobj)
+
+    elif path == '/echo':
+        body = environ['wsgi.input'].read()
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+
+class Starter(Actor):
+    def __init__(self, hive, id, filename, ports, stream_bodies_over=None):
+        super(Starter, self).__init__(hive, id)
+        self.message_routing.update({"start": self.start})
+        self.filename = filename
+        self.ports = ports
+        self.stream_bodies_over = stream_bodies_over
+
+    async def start(self, message):
+        def wrapped_app(environ, start_response):
+            environ['test.filename'] = self.filename
+            return app(environ, start_response)
+
+        wsgi = self.hive.create_actor(WSGI, app=wrapped_app)
+        http = self.hive.create_actor(
+            HTTP, request_handler=wsgi,
+            stream_bodies_over=self.stream_bodies_over)
+        server = self.hive.create_actor(ConnectionServer, handler=http)
+        listening = await self.ask(server, "listen", {"port": 0})
+        self.ports.append(listening.body["port"])
+
+
+def _check_responses(native_sendfile=True):
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ports = []
+
+    if not native_sendfile:
+        # Like an SSL transport, where asyncio has to read the file and
+        # send it itself
+        async def no_native_sendfile(*args):
+            raise asyncio.SendfileNotAvailableError()
+        loop._sendfile_native = no_native_sendfile
+
+    with tempfile.NamedTemporaryFile() as tmp:
+        tmp.write(b'0123456789' * 1000)
+        tmp.flush()
+
+        starter = hive.create_actor(
+            Starter, filename=tmp.name, ports=ports)
+        hive.send_message(to=starter, directive="start")
+
+        async def client():
+            while not ports:
+                await asyncio.sleep(.001)
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', ports[0])
+
+            responses = []
+            for path in ['/small', '/stream', '/file']:
+                writer.write(
+                    b'GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                    % path.encode('ascii'))
+                head = await reader.readuntil(b'\r\n\r\n')
+                if b'Transfer-Encoding: chunked' in head:
+                    body = b''
+                    while True:
+                        size = int(await reader.readuntil(b'\r\n'), 16)
+                        chunk = await reader.readexactly(size + 2)
+                        if not size:
+                            break
+                        body += chunk[:-2]
+                else:
+                    length = int(head.split(b'Content-Length: ')[1]
+                                 .split(b'\r\n')[0])
+                    body = await reader.readexactly(length)
+                responses.append((head, body))
+
+            writer.close()
+            # Let the server notice we've gone before shutting down
+            await asyncio.sleep(.01)
+            hive.send_shutdown()
+            return responses
+
+        task = loop.create_task(client())
+        loop.call_later(5, loop.stop)
+        hive.run()
+
+    (small_head, small), (stream_head, stream), (file_head, file_body) = \
+        task.result()
+
+    assert small == b'Hello World!'
+    assert b'Content-Length: 12' in small_head
+    assert b'Connection: keep-alive' in small_head
+
+    assert stream == b'line 0\nline 1\nline 2\n'
+    assert b'Transfer-Encoding: chunked' in stream_head
+
+    # Picks up from wherever the app left the file
+    assert file_body == (b'0123456789' * 1000)[5:]
+    assert b'Content-Length: 9995' in file_head
+    loop.close()
+
+
+def test_wsgi_responses():
+    _check_responses()
+
+
+def test_wsgi_responses_without_sendfile():
+    _check_responses(native_sendfile=False)
+
+
+def test_wsgi_streamed_upload():
+    # The app gets all of a body the HTTP actor streamed to us
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ports = []
+
+    starter = hive.create_actor(
+        Starter, filename=None, ports=ports, stream_bodies_over=8)
+    hive.send_message(to=starter, directive="start")
+
+    async def client():
+        while not ports:
+            await asyncio.sleep(.001)
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', ports[0])
+        writer.write(b'POST /echo HTTP/1.1\r\nHost: localhost\r\n'
+                     b'Content-Length: 20\r\nConnection: close\r\n\r\n'
+                     b'0123456789')
+        await asyncio.sleep(.01)
+        writer.write(b'abcdefghij')
+        response = await reader.read()
+        writer.close()
+        hive.send_shutdown()
+        return response
+
+    task = loop.create_task(client())
+    loop.call_later(5, loop.stop)
+    hive.run()
+
+    head, body = task.result().split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.1 200 OK')
+    assert body == b'0123456789abcdefghij'
+    loop.close()
+
+
+class PoolStarter(Actor):
+    def __init__(self, hive, id, app, ports, stats):
+        super(PoolStarter, self).__init__(hive, id)
+        self.message_routing.update(
+            {"start": self.start,
+             "check_pool": self.check_pool})
+        self.app = app
+        self.ports = ports
+        self.stats = stats
+        self.wsgi = None
+
+    async def start(self, message):
+        self.wsgi = self.hive.create_actor(
+            WSGI, app=self.app, threads=2)
+        http = self.hive.create_actor(HTTP, request_handler=self.wsgi)
+        server = self.hive.create_actor(ConnectionServer, handler=http)
+        listening = await self.ask(server, "listen", {"port": 0})
+        self.ports.append(listening.body["port"])
+
+    async def check_pool(self, message):
+        reply = await self.ask(self.wsgi, "get_pool_stats")
+        self.stats.append(dict(reply.body))
+
+
+def test_wsgi_thread_pool():
+    loop = asyncio.new_event_loop()
+    hive = Hive(loop=loop)
+    ports = []
+    stats = []
+    unblock = threading.Event()
+    multithread = []
+
+    def blocking_app(environ, start_response):
+        multithread.append(environ['wsgi.multithread'])
+        if environ['PATH_INFO'] == '/slow':
+            unblock.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'].encode('ascii')]
+
+    starter = hive.create_actor(
+        PoolStarter, app=blocking_app, ports=ports, stats=stats)
+    hive.send_message(to=starter, directive="start")
+
+    async def get(path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', ports[0])
+        writer.write(b'GET %s HTTP/1.0\r\n\r\n' % path)
+        response = await reader.read()
+        writer.close()
+        return response.split(b'\r\n\r\n', 1)[1]
+
+    async def client():
+        while not ports:
+            await asyncio.sleep(.001)
+
+        slow = loop.create_task(get(b'/slow'))
+        # The slow request's got its thread tied up, but everything
+        # else carries on
+        assert await get(b'/fast') == b'/fast'
+        assert not slow.done()
+
+        hive.send_message(to=starter, directive="check_pool")
+        while not stats:
+            await asyncio.sleep(.001)
+
+        unblock.set()
+        assert await slow == b'/slow'
+        hive.send_shutdown()
+
+    task = loop.create_task(client())
+    loop.call_later(5, loop.stop)
+    try:
+        hive.run()
+    finally:
+        unblock.set()
+
+    task.result()
+    assert multithread == [True, True]
+    assert stats == [
+        {'threads': 2, 'busy': 1, 'queued': 0, 'in_flight': 1}]
+    loop.close()
+
+
+def test_make_environ():
+    from tornado.httputil import HTTPHeaders
+
+    hive = Hive(loop=asyncio.new_event_loop())
+    wsgi = hive._actor_registry[hive.create_actor(WSGI, app=app).local_id]
+
+    headers = HTTPHeaders({
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Content-Length': '3',
+        'X-Forwarded-For': '10.0.0.1'})
+    request = {
+        'body': b'a=1',
+        'options': {
+            'method': 'POST', 'uri': '/caf%C3%A9/a+b?x=1&y=%20',
+            'version': 'HTTP/1.1', 'headers': headers,
+            'remote_ip': '127.0.0.1', 'server_name': 'localhost',
+            'port': 8000}}
+
+    environ = wsgi.make_environ(request)
+    assert environ['REQUEST_METHOD'] == 'POST'
+    assert environ['PATH_INFO'] == u'/caf\xc3\xa9/a+b'
+    assert environ['QUERY_STRING'] == 'x=1&y=%20'
+    assert environ['CONTENT_TYPE'] == 'application/x-www-form-urlencoded'
+    assert environ['CONTENT_LENGTH'] == '3'
+    assert environ['HTTP_X_FORWARDED_FOR'] == '10.0.0.1'
+    assert environ['SERVER_PORT'] == '8000'
+    assert environ['wsgi.input'].read() == b'a=1'
+    # The request's headers are left alone
+    assert len(headers) == 3
+
+    # Each request gets its own environ
+    assert wsgi.make_environ(request) is not environ
+
+    request['options']['uri'] = 'http://example.org/proxied?q'
+    environ = wsgi.make_environ(request)
+    assert environ['PATH_INFO'] == '/proxied'
+    assert environ['QUERY_STRING'] == 'q'
+    hive.loop.close()
@@ -34,6 +34,75 @@ def split_id(actor_id):
     return components
 
 
+class ActorRef(str):
+    """
+    A pre-parsed actor id.
+
+    Compares, hashes and serializes exactly like the "actor-id@hive-id"
+    string it was made from (it *is* that string), but has local_id
+    and hive_id already split out, so nobody needs to split_id() it
+    again.  Its hash is computed once, up front.
+
+    You usually want actor_ref() rather than constructing these
+    directly, so that each id only gets parsed once.
+    """
+    __slots__ = ("local_id", "hive_id")
+
+    def __new__(cls, actor_id):
+        ref = str.__new__(cls, actor_id)
+        ref.local_id, ref.hive_id = split_id(actor_id)
+        # str caches its hash, so this is the only time it's computed
+        hash(ref)
+        return ref
+
+    def __reduce__(self):
+        return (actor_ref, (str(self),))
+
+
+# Interned ActorRefs, keyed by actor id
+_actor_refs = {}
+
+
+def actor_ref(actor_id):
+    """
+    Return the interned ActorRef for ACTOR_ID, creating it if need be.
+
+    If ACTOR_ID is None, then return None.
+    """
+    if actor_id is None or isinstance(actor_id, ActorRef):
+        return actor_id
+
+    try:
+        return _actor_refs[actor_id]
+    except KeyError:
+        ref = _actor_refs[actor_id] = ActorRef(actor_id)
+        return ref
+
+
+def parse_actor_ref(actor_id):
+    """
+    Like actor_ref(), but only hands back an interned ActorRef if
+    there already is one, rather than interning ACTOR_ID for good.
+
+    For ids we're only passing along (other hives' actors, or ids
+    that don't belong to anyone), which would otherwise pile up.
+    """
+    if actor_id is None or isinstance(actor_id, ActorRef):
+        return actor_id
+
+    ref = _actor_refs.get(actor_id)
+    if ref is None:
+        ref = ActorRef(actor_id)
+    return ref
+
+
+def release_actor_ref(actor_id):
+    """
+    Forget the interned ActorRef for ACTOR_ID, if there is one.
+    """
+    _actor_refs.pop(actor_id, None)
+
+
 def join_id(actor_id, hive, assert_not_qualified=True):
     if assert_not_qualified:
         assert not is_qualified_id(actor_id)